@@ -1,14 +1,21 @@
 # pyusnvc package
 
-import pkg_resources
-
 from . import usnvc
 
-__version__ = pkg_resources.require("pyusnvc")[0].version
+
+def __getattr__(name):
+    # The version is only read from the installed metadata when it is asked for, which keeps the import fast
+    if name == "__version__":
+        from importlib.metadata import PackageNotFoundError, version
+        try:
+            return version("pyusnvc")
+        except PackageNotFoundError:
+            return "unknown"
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 def get_package_metadata():
-    d = pkg_resources.get_distribution('pyusnvc')
-    for i in d._get_metadata(d.PKG_INFO):
-        print(i)
+    from importlib.metadata import metadata
 
+    for key, value in metadata("pyusnvc").items():
+        print(f"{key}: {value}")
@@ -0,0 +1,411 @@
+"""
+Command line entry point for the pyusnvc package, run as python -m pyusnvc <command>.
+"""
+
+import argparse
+import sys
+
+
+def export_command(args):
+    import contextlib
+    from pyusnvc.export import export_units, progress_printer
+    from pyusnvc.instrumentation import instrument
+
+    if args.metrics is not None and args.workers is not None:
+        raise ValueError("--metrics only covers builds in this process and cannot be used with --workers")
+
+    ids = None
+    if args.num_shards is not None:
+        from pyusnvc.usnvc import all_keys
+        ids = all_keys(args.source_data_filename, shard=args.shard, num_shards=args.num_shards,
+                       strategy=args.shard_strategy)
+
+    with instrument(trace=args.trace) if args.metrics is not None else contextlib.nullcontext() as recorder:
+        export_units(
+            args.source_data_filename,
+            args.version_number,
+            args.output_filename,
+            compression=args.compression,
+            ids=ids,
+            workers=args.workers,
+            batch_size=args.batch_size,
+            include_root=not args.no_root and args.shard == 0,
+            progress=progress_printer(),
+            progress_interval=args.progress_interval
+        )
+    if recorder is not None:
+        recorder.save(args.metrics)
+
+
+def columnar_command(args):
+    from pyusnvc.columnar import export_columnar
+    from pyusnvc.validation import load_schema
+
+    def progress(status):
+        print(f'{status["documents"]} documents, {sum(status["rows"].values())} rows written, '
+              f'{status["documents_per_second"]:.1f} documents/s', file=sys.stderr)
+
+    schema = load_schema(schema_path=args.schema) if args.schema is not None else None
+    status = export_columnar(
+        args.source_data_filename,
+        args.version_number,
+        args.output_folder,
+        output_format=args.format,
+        schema=schema,
+        workers=args.workers,
+        batch_size=args.batch_size,
+        row_group_size=args.row_group_size,
+        compression=None if args.compression == "none" else args.compression,
+        progress=progress,
+        progress_interval=args.progress_interval
+    )
+    for name, rows in status["rows"].items():
+        print(f"{name}: {rows} rows", file=sys.stderr)
+
+
+def changes_command(args):
+    import os
+    from pyusnvc.export import dumps, open_export
+    from pyusnvc.incremental import incremental_build, load_manifest, save_manifest
+
+    previous_manifest = None
+    if args.previous_manifest is not None and os.path.exists(args.previous_manifest):
+        previous_manifest = load_manifest(args.previous_manifest)
+
+    manifest, changes, change_documents = incremental_build(
+        args.source_data_filename,
+        args.version_number,
+        previous_manifest,
+        args.batch_size
+    )
+    print(f'{len(changes["add"])} to add, {len(changes["update"])} to update, {len(changes["delete"])} to delete',
+          file=sys.stderr)
+
+    with open_export(args.output_filename, "w", args.compression) as f:
+        for change in change_documents:
+            f.write(dumps(change) + "\n")
+
+    save_manifest(manifest, args.manifest)
+
+
+def cache_command(args):
+    from pyusnvc.cache import DocumentCache
+
+    with DocumentCache(args.cache_filename) as cache:
+        if args.clear or args.source_data_filename is not None or args.version_number is not None:
+            removed = cache.invalidate(args.source_data_filename, None, args.version_number)
+            print(f"{removed} documents removed", file=sys.stderr)
+        if args.max_bytes is not None:
+            removed = cache.evict(args.max_bytes)
+            print(f"{removed} documents evicted", file=sys.stderr)
+        print(f"{cache.size()} bytes cached", file=sys.stderr)
+
+
+def validate_command(args):
+    import json
+    from pyusnvc.validation import load_schema, validate_export, validate_units
+
+    if args.schema is not None:
+        schema = load_schema(schema_path=args.schema)
+    else:
+        schema = load_schema(args.version_number)
+
+    if args.export_filename is not None:
+        report = validate_export(args.export_filename, schema, workers=args.workers, batch_size=args.batch_size,
+                                 max_examples=args.max_examples)
+    elif args.source_data_filename is not None:
+        report = validate_units(args.source_data_filename, args.version_number, schema, workers=args.workers,
+                                batch_size=args.batch_size, max_examples=args.max_examples)
+    else:
+        raise ValueError("Either an export file or --source-data-filename is required")
+
+    print(json.dumps(report, indent=2))
+    print(f'{report["invalid_documents"]} of {report["documents"]} documents invalid, '
+          f'{report["documents_per_second"]:.1f} documents/s', file=sys.stderr)
+    return 0 if report["valid"] else 1
+
+
+def synthetic_command(args):
+    from pyusnvc.synthetic import generate_database
+
+    generate_database(args.filename, args.units, depth=args.depth, fanout=args.fanout, density=args.density,
+                      seed=args.seed)
+
+
+def benchmark_command(args):
+    from pyusnvc.benchmark import compare_results, load_results, run_benchmarks, save_results
+
+    def progress(result):
+        print(f'{result["benchmark"]} ({result["units"]} units): {result["seconds"]:.3f}s, '
+              f'{result["items_per_second"]:.1f} items/s', file=sys.stderr)
+
+    results = run_benchmarks(args.sizes, args.benchmarks, args.repeat, args.version_number, args.sample_size,
+                             progress=progress, depth=args.depth, fanout=args.fanout, density=args.density,
+                             seed=args.seed)
+    if args.output is not None:
+        save_results(results, args.output)
+
+    if args.baseline is not None:
+        regressions = compare_results(results, load_results(args.baseline), args.tolerance)
+        for regression in regressions:
+            print(f'Regression in {regression["benchmark"]} ({regression["units"]} units): '
+                  f'{regression["baseline_items_per_second"]:.1f} to {regression["items_per_second"]:.1f} items/s '
+                  f'({regression["change"]:.0%})', file=sys.stderr)
+        if len(regressions) > 0:
+            return 1
+    return 0
+
+
+def import_time_command(args):
+    from pyusnvc.benchmark import check_import_budget
+
+    result, problems = check_import_budget(args.budget, args.module, args.repeat)
+    print(f'Importing {result["module"]} took {result["seconds"]:.3f}s', file=sys.stderr)
+    for problem in problems:
+        print(problem, file=sys.stderr)
+    return 1 if len(problems) > 0 else 0
+
+
+def search_index_command(args):
+    from pyusnvc.search import SearchIndex
+
+    with SearchIndex(args.index_filename) as index:
+        changes = index.refresh(args.source_data_filename, args.version_number, args.batch_size, full=args.full)
+        print(f'{len(changes["add"])} added, {len(changes["update"])} updated, {len(changes["delete"])} deleted, '
+              f'{len(index)} units indexed', file=sys.stderr)
+
+
+def search_command(args):
+    from pyusnvc.search import SearchIndex
+
+    with SearchIndex(args.index_filename) as index:
+        for result in index.search(args.query, level=args.level, limit=args.limit, raw=args.raw):
+            print(f'{result["element_global_id"]}\t{result["hierarchyLevel"]}\t{result["title"]}\t{result["snippet"]}')
+
+
+def geography_command(args):
+    from pyusnvc.geography import GeographicIndex, parse_place
+
+    try:
+        places = [parse_place(p) for p in args.places]
+    except ValueError as e:
+        args.parser.error(str(e))
+
+    index = GeographicIndex.build(args.source_data_filename)
+    qualifiers = {n: getattr(args, n) for n in ["presence", "confidence", "occurrence", "linkage"]
+                  if getattr(args, n) is not None}
+    for element_global_id in index.units(places, combine="all" if args.all else "any", level=args.level,
+                                         roll_up=args.roll_up, subregions=args.subregions, **qualifiers):
+        print(element_global_id)
+
+
+def serve_command(args):
+    from pyusnvc.server import make_server
+
+    document_cache = None
+    if args.document_cache is not None:
+        from pyusnvc.cache import DocumentCache
+        document_cache = DocumentCache(args.document_cache)
+
+    server = make_server(
+        args.host,
+        args.port,
+        export_filename=args.export_filename,
+        source_data_filename=args.source_data_filename,
+        version_number=args.version_number,
+        workers=args.workers,
+        cache_size=args.cache_size,
+        document_cache=document_cache,
+        quiet=args.quiet
+    )
+    host, port = server.server_address[:2]
+    print(f"Serving {len(server.store)} units on http://{host}:{port}/", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if document_cache is not None:
+            document_cache.close()
+
+
+def _add_database_arguments(parser):
+    parser.add_argument("--depth", type=int, default=8, help="Hierarchy levels to use, from 1 (Class) to 8")
+    parser.add_argument("--fanout", type=int, default=4, help="Maximum number of children of each unit")
+    parser.add_argument("--density", type=int, default=3, help="Scales the number of related rows per unit")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the random values")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m pyusnvc", description="USNVC distribution processing")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    export_parser = subparsers.add_parser("export", help="Export every unit document to newline-delimited JSON")
+    export_parser.add_argument("source_data_filename", help="Source SQLite database")
+    export_parser.add_argument("output_filename", help="Output file; .gz and .zst extensions are compressed")
+    export_parser.add_argument("--version-number", type=float, default=2.03, help="USNVC source version")
+    export_parser.add_argument("--compression", choices=["gzip", "zstd", "none"], default=None,
+                               help="Compression to use instead of inferring it from the output extension")
+    export_parser.add_argument("--workers", type=int, default=None,
+                               help="Build with this many worker processes instead of in a single process")
+    export_parser.add_argument("--batch-size", type=int, default=500, help="Units fetched per round of queries")
+    export_parser.add_argument("--no-root", action="store_true", help="Leave out the logical root document")
+    export_parser.add_argument("--progress-interval", type=float, default=10, help="Seconds between progress reports")
+    export_parser.add_argument("--metrics", default=None,
+                               help="Write query and section timings to this file, in the Prometheus text format if "
+                                    "it ends in .prom and as JSON otherwise")
+    export_parser.add_argument("--trace", action="store_true", help="Also trace SQLite statements for --metrics")
+    export_parser.add_argument("--num-shards", type=int, default=None,
+                               help="Split the units into this many shards and only export one of them")
+    export_parser.add_argument("--shard", type=int, default=0,
+                               help="Shard to export, from 0; the logical root is written with shard 0")
+    export_parser.add_argument("--shard-strategy", choices=["cost", "modulo"], default="cost",
+                               help="Balance shards by estimated build cost or assign units by id modulo the shards")
+    export_parser.set_defaults(func=export_command)
+
+    columnar_parser = subparsers.add_parser(
+        "columnar", help="Export the distribution, crosswalk, reference and hierarchy data as Parquet or Arrow tables")
+    columnar_parser.add_argument("source_data_filename", help="Source SQLite database")
+    columnar_parser.add_argument("output_folder", help="Folder to write a partitioned sub-folder per table to")
+    columnar_parser.add_argument("--format", choices=["parquet", "arrow"], default="parquet", help="File format")
+    columnar_parser.add_argument("--version-number", type=float, default=2.03, help="USNVC source version")
+    columnar_parser.add_argument("--schema", default=None,
+                                 help="Unit schema giving the table columns; defaults to the packaged schema")
+    columnar_parser.add_argument("--workers", type=int, default=None,
+                                 help="Build with this many worker processes instead of in a single process")
+    columnar_parser.add_argument("--batch-size", type=int, default=500, help="Units fetched per round of queries")
+    columnar_parser.add_argument("--row-group-size", type=int, default=65536, help="Rows per row group")
+    columnar_parser.add_argument("--compression", default="zstd", help="Compression codec, or none")
+    columnar_parser.add_argument("--progress-interval", type=float, default=10, help="Seconds between progress reports")
+    columnar_parser.set_defaults(func=columnar_command)
+
+    changes_parser = subparsers.add_parser(
+        "changes", help="Write the add/update/delete changeset since a previous build as newline-delimited JSON")
+    changes_parser.add_argument("source_data_filename", help="Source SQLite database")
+    changes_parser.add_argument("output_filename", help="Changeset file; .gz and .zst extensions are compressed")
+    changes_parser.add_argument("--previous-manifest", default=None,
+                                help="Manifest saved by the previous build; everything is added when missing")
+    changes_parser.add_argument("--manifest", required=True, help="Where to save the manifest for this build")
+    changes_parser.add_argument("--version-number", type=float, default=2.03, help="USNVC source version")
+    changes_parser.add_argument("--compression", choices=["gzip", "zstd", "none"], default=None,
+                                help="Compression to use instead of inferring it from the output extension")
+    changes_parser.add_argument("--batch-size", type=int, default=500, help="Units fetched per round of queries")
+    changes_parser.set_defaults(func=changes_command)
+
+    cache_parser = subparsers.add_parser("cache", help="Report on, invalidate or shrink a document cache")
+    cache_parser.add_argument("cache_filename", help="Document cache file")
+    cache_parser.add_argument("--clear", action="store_true", help="Remove every cached document")
+    cache_parser.add_argument("--source-data-filename", default=None,
+                              help="Remove documents built from this source data")
+    cache_parser.add_argument("--version-number", type=float, default=None,
+                              help="Remove documents built with this version number")
+    cache_parser.add_argument("--max-bytes", type=int, default=None,
+                              help="Evict least recently used documents until the cache is no larger than this")
+    cache_parser.set_defaults(func=cache_command)
+
+    validate_parser = subparsers.add_parser(
+        "validate", help="Validate an export file, or documents built from source data, against the unit schema")
+    validate_parser.add_argument("export_filename", nargs="?", default=None, help="Export file to validate")
+    validate_parser.add_argument("--source-data-filename", default=None,
+                                 help="Build and validate documents from this source database instead of a file")
+    validate_parser.add_argument("--version-number", type=float, default=2.03, help="USNVC source version")
+    validate_parser.add_argument("--schema", default=None,
+                                 help="Schema file; defaults to the packaged schema for the version number")
+    validate_parser.add_argument("--workers", type=int, default=None,
+                                 help="Validate with this many worker processes instead of in a single process")
+    validate_parser.add_argument("--batch-size", type=int, default=500, help="Documents validated per batch")
+    validate_parser.add_argument("--max-examples", type=int, default=5,
+                                 help="Example element_global_id values to report for each path")
+    validate_parser.set_defaults(func=validate_command)
+
+    synthetic_parser = subparsers.add_parser("synthetic", help="Write a synthetic source database")
+    synthetic_parser.add_argument("filename", help="SQLite file to write")
+    synthetic_parser.add_argument("--units", type=int, default=1000, help="Number of units")
+    _add_database_arguments(synthetic_parser)
+    synthetic_parser.set_defaults(func=synthetic_command)
+
+    benchmark_parser = subparsers.add_parser("benchmark", help="Time the build paths against synthetic databases")
+    benchmark_parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000],
+                                  help="Numbers of units to benchmark with")
+    benchmark_parser.add_argument("--benchmarks", nargs="+", default=None,
+                                  help="Benchmarks to run; defaults to all of them")
+    benchmark_parser.add_argument("--repeat", type=int, default=3, help="Runs of each benchmark, keeping the best")
+    benchmark_parser.add_argument("--version-number", type=float, default=2.03, help="USNVC source version")
+    benchmark_parser.add_argument("--sample-size", type=int, default=200,
+                                  help="Units built by the per-unit benchmarks")
+    benchmark_parser.add_argument("--output", default=None, help="Save the results to this JSON file")
+    benchmark_parser.add_argument("--baseline", default=None,
+                                  help="Earlier results to compare with; exits non-zero on a regression")
+    benchmark_parser.add_argument("--tolerance", type=float, default=0.25,
+                                  help="Fraction by which throughput may drop before it counts as a regression")
+    _add_database_arguments(benchmark_parser)
+    benchmark_parser.set_defaults(func=benchmark_command)
+
+    import_time_parser = subparsers.add_parser(
+        "import-time", help="Check that importing the package stays within a time budget and loads no heavy packages")
+    import_time_parser.add_argument("--budget", type=float, default=0.15, help="Seconds the import may take")
+    import_time_parser.add_argument("--module", default="pyusnvc", help="Module to import")
+    import_time_parser.add_argument("--repeat", type=int, default=5, help="Fresh interpreters to time the import in")
+    import_time_parser.set_defaults(func=import_time_command)
+
+    search_index_parser = subparsers.add_parser(
+        "search-index", help="Build or incrementally refresh the full-text search index")
+    search_index_parser.add_argument("source_data_filename", help="Source SQLite database")
+    search_index_parser.add_argument("index_filename", help="Search index file")
+    search_index_parser.add_argument("--version-number", type=float, default=2.03, help="USNVC source version")
+    search_index_parser.add_argument("--batch-size", type=int, default=500, help="Units fetched per round of queries")
+    search_index_parser.add_argument("--full", action="store_true", help="Re-index every unit")
+    search_index_parser.set_defaults(func=search_index_command)
+
+    search_parser = subparsers.add_parser("search", help="Search the full-text search index")
+    search_parser.add_argument("index_filename", help="Search index file")
+    search_parser.add_argument("query", help="Words to search for")
+    search_parser.add_argument("--level", default=None, help="Only return units at this hierarchy level")
+    search_parser.add_argument("--limit", type=int, default=20, help="Maximum number of results")
+    search_parser.add_argument("--raw", action="store_true", help="Use the query as an FTS5 query expression")
+    search_parser.set_defaults(func=search_command)
+
+    geography_parser = subparsers.add_parser(
+        "geography", help="List the units occurring in any or all of a set of states, nations or ecoregions")
+    geography_parser.add_argument("source_data_filename", help="Source SQLite database")
+    geography_parser.add_argument("places", nargs="+",
+                                  help="Places as kind:code, such as subnation:US-OR, nation:US, ecoregion_2007:M242 "
+                                       "or crosswalk:US-OR")
+    geography_parser.add_argument("--all", action="store_true", help="Units in all of the places rather than any")
+    geography_parser.add_argument("--level", default=None, help="Only list units at this hierarchy level")
+    geography_parser.add_argument("--roll-up", action="store_true",
+                                  help="Count a unit as occurring in a place when any unit below it does")
+    geography_parser.add_argument("--subregions", action="store_true",
+                                  help="Include units recorded in ecoregions within the given ecoregions")
+    geography_parser.add_argument("--presence", nargs="+", default=None, help="Presence codes for states and nations")
+    geography_parser.add_argument("--confidence", nargs="+", default=None,
+                                  help="Distribution confidence codes for states and nations")
+    geography_parser.add_argument("--occurrence", nargs="+", default=None, help="Occurrence codes for ecoregions")
+    geography_parser.add_argument("--linkage", nargs="+", default=None, help="Linkages for the state crosswalk")
+    geography_parser.set_defaults(func=geography_command, parser=geography_parser)
+
+    serve_parser = subparsers.add_parser(
+        "serve", help="Serve unit documents, children and ancestors over HTTP from an export or the source data")
+    serve_source = serve_parser.add_mutually_exclusive_group(required=True)
+    serve_source.add_argument("--export-filename", default=None, help="Export file to serve the documents of")
+    serve_source.add_argument("--source-data-filename", default=None,
+                              help="Source SQLite database to build documents from on demand")
+    serve_parser.add_argument("--version-number", type=float, default=2.03, help="USNVC source version")
+    serve_parser.add_argument("--host", default="127.0.0.1", help="Address to listen on")
+    serve_parser.add_argument("--port", type=int, default=8080, help="Port to listen on")
+    serve_parser.add_argument("--workers", type=int, default=4,
+                              help="Threads, and so source connections, to build documents with")
+    serve_parser.add_argument("--cache-size", type=int, default=1000, help="Responses kept in the LRU cache")
+    serve_parser.add_argument("--document-cache", default=None,
+                              help="Document cache file to read built documents from and store them in")
+    serve_parser.add_argument("--quiet", action="store_true", help="Do not log each request")
+    serve_parser.set_defaults(func=serve_command)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,272 @@
+"""
+Benchmarks for the build paths, run against synthetic databases from the synthetic module so that they need no
+download. Each benchmark is timed at every database size, taking the best of a number of repeats, and reported as
+seconds and items per second. Results can be saved as JSON and compared with an earlier run to catch performance
+regressions, or read across sizes to estimate what a bigger release will need. The cost of importing the package,
+which short-lived pipeline workers pay on every start, is checked against a budget separately.
+"""
+
+import contextlib
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+from pyusnvc import usnvc
+from pyusnvc.synthetic import generate_database
+
+# Default number of units sampled by the per-unit benchmarks
+SAMPLE_SIZE = 200
+
+# Seconds that importing pyusnvc may take in a fresh interpreter
+IMPORT_BUDGET_SECONDS = 0.15
+
+# Packages that importing pyusnvc must not load; the functions that need them import them when called
+LAZY_DEPENDENCIES = ["pandas", "numpy", "sciencebasepy", "pycountry", "genson", "jsonschema", "requests",
+                     "pkg_resources"]
+
+
+def _sample(ids, sample_size):
+    step = max(len(ids) // sample_size, 1)
+    return ids[::step][:sample_size]
+
+
+def bench_all_keys(context):
+    return len(usnvc.all_keys(context["source_data_filename"]))
+
+
+def bench_build_hierarchy(context):
+    with usnvc.UsnvcSource(context["source_data_filename"]) as source:
+        for element_global_id in context["sample"]:
+            usnvc.build_hierarchy(element_global_id, source)
+    return len(context["sample"])
+
+
+def bench_build_unit(context):
+    with usnvc.UsnvcSource(context["source_data_filename"]) as source:
+        for element_global_id in context["sample"]:
+            usnvc.build_unit(element_global_id, source, context["version_number"])
+    return len(context["sample"])
+
+
+def bench_build_all_units(context):
+    return sum(1 for _ in usnvc.build_all_units(context["source_data_filename"], context["version_number"]))
+
+
+def bench_get_schema(context):
+    usnvc.get_schema(context["source_data_filename"], cache_file=False, version_number=context["version_number"])
+    return context["units"]
+
+
+# Module settings of the bis pipeline that _pipeline changes for the length of a benchmark
+_PIPELINE_SETTINGS = ["file_name", "version", "document_cache", "document_validator"]
+
+
+@contextlib.contextmanager
+def _pipeline(context):
+    """
+    Points the bis pipeline at the synthetic database, putting its settings back afterwards. The packaged schema
+    describes the real data, so documents are validated against a schema inferred from the synthetic database
+    instead.
+    """
+    from pyusnvc import bis_pipeline
+    from pyusnvc.validation import DocumentValidator
+
+    if "validator" not in context:
+        context["validator"] = DocumentValidator(usnvc.get_schema(
+            context["source_data_filename"], cache_file=False, version_number=context["version_number"]))
+
+    settings = {name: getattr(bis_pipeline, name) for name in _PIPELINE_SETTINGS}
+    try:
+        bis_pipeline.file_name = os.path.basename(context["source_data_filename"])
+        bis_pipeline.version = context["version_number"]
+        bis_pipeline.document_cache = None
+        bis_pipeline.document_validator = context["validator"]
+        yield bis_pipeline, os.path.dirname(context["source_data_filename"]) + os.sep
+    finally:
+        for name, value in settings.items():
+            setattr(bis_pipeline, name, value)
+
+
+class _Ledger(object):
+    def log_change_event(self, *args):
+        pass
+
+
+def bench_pipeline_process_1(context):
+    with _pipeline(context) as (bis_pipeline, path):
+        results = list()
+        return bis_pipeline.process_1(path, _Ledger(), results.append, lambda obj, stage: results.append(obj), None)
+
+
+def bench_pipeline_process_2(context):
+    with _pipeline(context) as (bis_pipeline, path):
+        results = list()
+        for element_global_id in context["sample"]:
+            bis_pipeline.process_2(path, _Ledger(), results.append, None, {"element_global_id": element_global_id})
+        return len(results)
+
+
+BENCHMARKS = {
+    "all_keys": bench_all_keys,
+    "build_hierarchy": bench_build_hierarchy,
+    "build_unit": bench_build_unit,
+    "build_all_units": bench_build_all_units,
+    "get_schema": bench_get_schema,
+    "pipeline_process_1": bench_pipeline_process_1,
+    "pipeline_process_2": bench_pipeline_process_2
+}
+
+
+def run_benchmarks(sizes=(1000, 10000), benchmarks=None, repeat=3, version_number=2.03, sample_size=SAMPLE_SIZE,
+                   working_folder=None, progress=None, **database_options):
+    """
+    Runs the benchmarks against synthetic databases of each size.
+
+    :param sizes: Numbers of units to generate databases with
+    :param benchmarks: Names of the benchmarks to run (see BENCHMARKS); defaults to all of them
+    :param repeat: Number of times to run each benchmark, keeping the best time
+    :param version_number: version_number to build documents with
+    :param sample_size: Number of units the per-unit benchmarks build
+    :param working_folder: Folder to write the databases to; defaults to a temporary folder that is removed after
+    :param progress: Optional function called with each result as it is measured
+    :param database_options: Further arguments for synthetic.generate_database (depth, fanout, density, seed)
+    :return: Dictionary with the environment the benchmarks ran in and a list of results, each with the benchmark
+    name, number of units, items processed, best seconds and items per second
+    """
+    if benchmarks is None:
+        benchmarks = list(BENCHMARKS)
+
+    temporary_folder = None
+    if working_folder is None:
+        temporary_folder = tempfile.TemporaryDirectory()
+        working_folder = temporary_folder.name
+
+    results = list()
+    try:
+        for units in sizes:
+            source_data_filename = os.path.join(working_folder, f"synthetic_{units}.db")
+            generate_database(source_data_filename, units, **database_options)
+            ids = usnvc.all_keys(source_data_filename)
+            context = {
+                "source_data_filename": source_data_filename,
+                "version_number": version_number,
+                "units": units,
+                "sample": _sample(ids, sample_size)
+            }
+
+            for name in benchmarks:
+                best = None
+                items = 0
+                for _ in range(repeat):
+                    start_time = time.perf_counter()
+                    items = BENCHMARKS[name](context)
+                    seconds = time.perf_counter() - start_time
+                    best = seconds if best is None else min(best, seconds)
+                result = {
+                    "benchmark": name,
+                    "units": units,
+                    "items": items,
+                    "seconds": best,
+                    "items_per_second": items / best if best > 0 else 0
+                }
+                results.append(result)
+                if progress is not None:
+                    progress(result)
+    finally:
+        if temporary_folder is not None:
+            temporary_folder.cleanup()
+
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "version_number": version_number,
+        "repeat": repeat,
+        "results": results
+    }
+
+
+def measure_import(module="pyusnvc", repeat=5):
+    """
+    Times importing a module in fresh interpreters, the way a short-lived pipeline worker starts.
+
+    :param module: Module to import
+    :param repeat: Number of interpreters to start, keeping the best time
+    :return: Dictionary with the module, the best seconds and the LAZY_DEPENDENCIES the import loaded
+    """
+    code = (
+        "import json, sys, time\n"
+        "start_time = time.perf_counter()\n"
+        f"import {module}\n"
+        "seconds = time.perf_counter() - start_time\n"
+        f"print(json.dumps({{'seconds': seconds, 'loaded': [m for m in {LAZY_DEPENDENCIES!r} if m in sys.modules]}}))"
+    )
+    best = None
+    for _ in range(repeat):
+        result = json.loads(subprocess.run([sys.executable, "-c", code], check=True, capture_output=True,
+                                           text=True).stdout)
+        if best is None or result["seconds"] < best["seconds"]:
+            best = result
+    return {"module": module, "seconds": best["seconds"], "loaded": best["loaded"]}
+
+
+def check_import_budget(budget_seconds=IMPORT_BUDGET_SECONDS, module="pyusnvc", repeat=5):
+    """
+    Checks that importing a module stays within a time budget and leaves the heavy dependencies unloaded.
+
+    :param budget_seconds: Seconds the import may take
+    :param module: Module to import
+    :param repeat: Number of interpreters to start, keeping the best time
+    :return: Tuple of the measure_import result and a list of problems, which is empty when the import is within
+    budget
+    """
+    result = measure_import(module, repeat)
+    problems = list()
+    if result["seconds"] > budget_seconds:
+        problems.append(f"Importing {module} took {result['seconds']:.3f}s, over the {budget_seconds}s budget")
+    for dependency in result["loaded"]:
+        problems.append(f"Importing {module} loaded {dependency}")
+    return result, problems
+
+
+def compare_results(results, baseline, tolerance=0.25):
+    """
+    Compares benchmark results with an earlier run.
+
+    :param results: Dictionary returned by run_benchmarks
+    :param baseline: Dictionary returned by an earlier run_benchmarks
+    :param tolerance: Fraction by which throughput may drop before it counts as a regression
+    :return: List of dictionaries for the benchmarks whose items per second dropped by more than the tolerance, with
+    the benchmark name, units, baseline and current items per second and the change as a fraction
+    """
+    baseline_results = {(r["benchmark"], r["units"]): r for r in baseline["results"]}
+
+    regressions = list()
+    for result in results["results"]:
+        previous = baseline_results.get((result["benchmark"], result["units"]))
+        if previous is None or previous["items_per_second"] == 0:
+            continue
+        change = result["items_per_second"] / previous["items_per_second"] - 1
+        if change < -tolerance:
+            regressions.append({
+                "benchmark": result["benchmark"],
+                "units": result["units"],
+                "baseline_items_per_second": previous["items_per_second"],
+                "items_per_second": result["items_per_second"],
+                "change": change
+            })
+    return regressions
+
+
+def save_results(results, filename):
+    with open(filename, "w") as f:
+        json.dump(results, f, indent=2)
+
+
+def load_results(filename):
+    with open(filename, "r") as f:
+        return json.load(f)
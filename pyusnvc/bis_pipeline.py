@@ -6,7 +6,12 @@ see https://github.com/bgotthold-usgs/bis_pipeline/blob/master/README.md for mor
 """
 
 import os
+import copy
 import json
+import time
+import asyncio
+import threading
+import concurrent.futures
 from pyusnvc.usnvc import *
 
 version = 2.03
@@ -14,11 +19,89 @@ file_name = "NVC v2.03 2019-03.db"
 
 json_schema = None
 try:
-    with open(os.path.join(os.path.dirname(__file__), './usnvc_unit_schema_2.03.json'), 'r') as json_schema_file:
+    with open(os.path.join(os.path.dirname(__file__), './resources/usnvc_unit_schema_2.03.json'), 'r') as json_schema_file:
         json_schema = json.load(json_schema_file)
 except FileNotFoundError as e:
     pass
 
+# Set PYUSNVC_VALIDATE=1 to validate every document against the packaged unit schema for the version before it is
+# published, stopping the stage at the first invalid document. The validator is compiled when the first document is
+# built, so workers that only run process_1 never load it.
+validate_documents = os.environ.get("PYUSNVC_VALIDATE", "0") == "1"
+document_validator = None
+
+
+def _document_validator():
+    global document_validator
+    if document_validator is None and validate_documents:
+        from pyusnvc.validation import DocumentValidator, load_schema
+        document_validator = DocumentValidator(load_schema(version))
+    return document_validator
+
+
+# Set PYUSNVC_DOCUMENT_CACHE to the path of a cache file to reuse documents built by earlier runs
+document_cache = None
+if os.environ.get("PYUSNVC_DOCUMENT_CACHE"):
+    from pyusnvc.cache import DocumentCache
+    document_cache = DocumentCache(os.environ["PYUSNVC_DOCUMENT_CACHE"])
+
+# Detail recorded in the change ledger for each unit: off, summary, delta or full. The ledger receives the previous
+# and current document at each step by default; set PYUSNVC_CHANGE_LOG_LEVEL=delta to send None and the list of
+# operations made in the step instead.
+change_log_level = os.environ.get("PYUSNVC_CHANGE_LOG_LEVEL", "full")
+
+# Set PYUSNVC_BATCH_SIZE to have process_1 send batches of this many ids to process_2 instead of one message per unit
+batch_size = int(os.environ.get("PYUSNVC_BATCH_SIZE", "0"))
+
+# Set PYUSNVC_BULK_RESULTS=1 to send each batch's documents as a single final result instead of one per document
+bulk_results = os.environ.get("PYUSNVC_BULK_RESULTS", "0") == "1"
+
+# Set PYUSNVC_NUM_SHARDS and PYUSNVC_SHARD (0 to PYUSNVC_NUM_SHARDS - 1) to have process_1 only send the units of one
+# shard, so that several nodes can each build a share of the units. Shards are balanced by estimated build cost unless
+# PYUSNVC_SHARD_STRATEGY=modulo.
+num_shards = int(os.environ.get("PYUSNVC_NUM_SHARDS", "1"))
+shard = int(os.environ.get("PYUSNVC_SHARD", "0"))
+shard_strategy = os.environ.get("PYUSNVC_SHARD_STRATEGY", "cost")
+
+# Open source and UnitTree shared by every message this process handles, keyed by the source's path, size and
+# modification time
+_shared_sources = dict()
+
+# File stage 2 builds from for each source path, resolved once per process
+_prepared_sources = dict()
+
+
+def _prepared_source(source_data_filename):
+    """
+    Finds the working copy process_1 prepared, without preparing it again: only process_1 calls prepare_source. The
+    source itself is used when there is no up to date working copy, such as on a node that has not run process_1.
+
+    :param source_data_filename: location of source data
+    :return: Filename to build from, which is only looked up on the first message this process handles
+    """
+    if source_data_filename not in _prepared_sources:
+        _prepared_sources[source_data_filename] = prepared_filename(source_data_filename) \
+            if is_prepared(source_data_filename) else source_data_filename
+    return _prepared_sources[source_data_filename]
+
+
+def _shared_source(source_data_filename):
+    """
+    :param source_data_filename: location of source data
+    :return: Tuple of a UsnvcSource and UnitTree reused across messages, so a message does not open its own
+    connection or reload the hierarchy
+    """
+    stat = os.stat(source_data_filename)
+    key = (os.path.abspath(source_data_filename), stat.st_size, stat.st_mtime_ns)
+    if key not in _shared_sources:
+        for source, unit_tree in _shared_sources.values():
+            source.close()
+        _shared_sources.clear()
+        source = UsnvcSource(source_data_filename)
+        _shared_sources[key] = (source, UnitTree.load(source))
+    return _shared_sources[key]
+
+
 # # # # # # # # TO RUN THIS BIS PIPELINE FILE LOCALLY UNCOMMENT BELOW # # # # # # # # #
 
 # # file should exist here
@@ -55,26 +138,65 @@ except FileNotFoundError as e:
 
 # The first processing stage.
 # It creates 1 final result and many other results that it sends to the next
-#  stage for further processing.
+#  stage for further processing. With batch_size set, each message holds a
+#  batch of ids instead of a single one.
 # It returns count which is the number of rows created by this stage.
 def process_1(path, ch_ledger, send_final_result,
               send_to_stage, previous_stage_result):
     count = 0
-    for element_global_id in all_keys(path + file_name):
+    # Index and analyze a working copy of the source once per release; later calls return the same copy
+    source_data_filename = prepare_source(path + file_name)
+    _prepared_sources[path + file_name] = source_data_filename
+    if num_shards > 1:
+        ids = all_keys(source_data_filename, shard=shard, num_shards=num_shards, strategy=shard_strategy)
+    else:
+        ids = all_keys(source_data_filename)
+    if batch_size > 0:
+        for batch_start in range(0, len(ids), batch_size):
+            send_to_stage({'element_global_ids': ids[batch_start:batch_start + batch_size]}, 2)
+        return len(ids)
+
+    for element_global_id in ids:
         send_to_stage({'element_global_id': element_global_id}, 2)
         count += 1
     return count
 
 
 # The second processing stage used the previous_stage_result and sends
-#  a singe document to be handled as a final result.
-# It returns 1
+#  a singe document to be handled as a final result. A batch message is built
+#  in one round of queries through the shared connection, and its documents
+#  are sent one at a time or, with bulk_results, as a single final result.
+# It returns the number of documents built
 def process_2(path, ch_ledger, send_final_result,
               send_to_stage, previous_stage_result):
+    source, unit_tree = _shared_source(_prepared_source(path + file_name))
+
+    if 'element_global_ids' in previous_stage_result:
+        ids = previous_stage_result['element_global_ids']
+        process_results = list(build_units(
+            ids, source, version, change_log_function=ch_ledger.log_change_event, batch_size=max(len(ids), 1),
+            unit_tree=unit_tree, cache=document_cache, change_log_level=change_log_level))
+        validator = _document_validator()
+        if validator is not None:
+            for process_result in process_results:
+                validator.validate(process_result)
+
+        if bulk_results:
+            send_final_result({'data': process_results,
+                               'row_ids': [str(i) for i in ids]})
+        else:
+            for element_global_id, process_result in zip(ids, process_results):
+                send_final_result({'data': process_result,
+                                   'row_id': str(element_global_id)})
+        return len(process_results)
 
     element_global_id = previous_stage_result['element_global_id']
     process_result = build_unit(
-        element_global_id, source_data_filename=path + file_name, version_number=version, change_log_function=ch_ledger.log_change_event)
+        element_global_id, source_data_filename=source, version_number=version, change_log_function=ch_ledger.log_change_event,
+        unit_tree=unit_tree, cache=document_cache, change_log_level=change_log_level)
+    validator = _document_validator()
+    if validator is not None:
+        validator.validate(process_result)
 
     final_result = {'data': process_result,
                     'row_id': str(element_global_id)}
@@ -82,5 +204,156 @@ def process_2(path, ch_ledger, send_final_result,
     return 1
 
 
+class _RecordingLedger(object):
+    """
+    Keeps the change events of a message for the driver to pass on once it is built. At the full level the result
+    of each event is the document itself, which keeps changing until the build is done, so it is copied when it is
+    logged; the other levels already log values that do not change afterwards.
+    """
+    def __init__(self, copy_results=False):
+        self.events = list()
+        self.copy_results = copy_results
+
+    def log_change_event(self, *args):
+        if self.copy_results:
+            args = args[:-1] + (copy.deepcopy(args[-1]),)
+        self.events.append(args)
+
+
+def _run_stage_2(path, message):
+    """
+    Runs process_2 for a message in a driver worker, collecting the change events and final results so that the
+    driver can pass them on from its own thread.
+    """
+    ledger = _RecordingLedger(copy_results=change_log_level == "full")
+    final_results = list()
+    count = process_2(path, ledger, final_results.append, None, message)
+    return count, ledger.events, final_results
+
+
+# Module settings process_2 reads. run_pipeline hands them to its worker processes, which do not see changes made to
+# this module in the driver when they are started with spawn or forkserver.
+_STAGE_2_SETTINGS = ["file_name", "version", "change_log_level", "bulk_results", "validate_documents"]
+
+
+def _stage_2_settings():
+    """
+    :return: Dictionary of the stage 2 settings of this process, with the document cache given by its arguments
+    """
+    settings = {name: globals()[name] for name in _STAGE_2_SETTINGS}
+    settings["document_cache"] = None if document_cache is None else \
+        (document_cache.cache_filename, document_cache.max_bytes, document_cache.package_version)
+    return settings
+
+
+def _init_stage_2_worker(settings):
+    """
+    Applies the driver's stage 2 settings in a worker process, opening the worker's own connection to the document
+    cache.
+    """
+    global document_cache
+    globals().update({name: settings[name] for name in _STAGE_2_SETTINGS})
+    document_cache = None
+    if settings["document_cache"] is not None:
+        from pyusnvc.cache import DocumentCache
+        document_cache = DocumentCache(*settings["document_cache"])
+
+
+class _PipelineStopped(Exception):
+    pass
+
+
+async def run_pipeline(path, ch_ledger, send_final_result, concurrency=None, max_queue_size=None, processes=True):
+    """
+    Runs both stages locally end to end. process_1 runs in a thread and puts its messages on a bounded queue, which
+    blocks it whenever the stage 2 workers fall behind, and up to concurrency messages are built at a time in a pool
+    of worker processes (or threads). Change events and final results are passed to ch_ledger and send_final_result
+    from the event loop's thread, so neither needs to be thread safe. Set batch_size (and bulk_results) first to run
+    the batched mode; the module settings stage 2 reads are passed to the worker processes when they start, whatever
+    the multiprocessing start method.
+
+    :param path: Folder holding the source data file
+    :param ch_ledger: Object with a log_change_event method
+    :param send_final_result: Function called with each final result
+    :param concurrency: Number of messages built at a time; defaults to the number of CPUs
+    :param max_queue_size: Number of messages allowed to wait for a worker; defaults to twice the concurrency
+    :param processes: Build in worker processes rather than threads
+    :return: Dictionary with the number of units, messages and documents and the seconds taken
+    """
+    start_time = time.time()
+    loop = asyncio.get_running_loop()
+    if concurrency is None:
+        concurrency = os.cpu_count() or 1
+    queue = asyncio.Queue(max_queue_size or 2 * concurrency)
+    stopped = threading.Event()
+    errors = list()
+    totals = {"messages": 0, "documents": 0}
+
+    def send_to_stage(obj, stage):
+        if stopped.is_set():
+            raise _PipelineStopped()
+        asyncio.run_coroutine_threadsafe(queue.put(obj), loop).result()
+
+    async def produce():
+        try:
+            return await loop.run_in_executor(None, process_1, path, ch_ledger, send_final_result, send_to_stage,
+                                              None)
+        except _PipelineStopped:
+            return 0
+        except Exception as e:
+            errors.append(e)
+            stopped.set()
+            return 0
+        finally:
+            for _ in range(concurrency):
+                await queue.put(None)
+
+    async def consume(executor):
+        while True:
+            message = await queue.get()
+            if message is None:
+                return
+            if stopped.is_set():
+                # Drain the queue so that process_1 is never left blocked on it
+                continue
+            try:
+                count, events, final_results = await loop.run_in_executor(executor, _run_stage_2, path, message)
+                for event in events:
+                    ch_ledger.log_change_event(*event)
+                for final_result in final_results:
+                    send_final_result(final_result)
+            except Exception as e:
+                errors.append(e)
+                stopped.set()
+                continue
+            totals["messages"] += 1
+            totals["documents"] += count
+
+    if processes:
+        executor = concurrent.futures.ProcessPoolExecutor(
+            concurrency, initializer=_init_stage_2_worker, initargs=(_stage_2_settings(),))
+    else:
+        executor = concurrent.futures.ThreadPoolExecutor(concurrency)
+    with executor:
+        results = await asyncio.gather(produce(), *[consume(executor) for _ in range(concurrency)])
+
+    if len(errors) > 0:
+        raise errors[0]
+
+    return {
+        "units": results[0],
+        "messages": totals["messages"],
+        "documents": totals["documents"],
+        "seconds": time.time() - start_time
+    }
+
+
+def run_local(path, ch_ledger, send_final_result, concurrency=None, max_queue_size=None, processes=True):
+    """
+    Runs run_pipeline in a new event loop.
+    """
+    return asyncio.run(run_pipeline(path, ch_ledger, send_final_result, concurrency, max_queue_size, processes))
+
+
 if __name__ == "__main__":
     main()
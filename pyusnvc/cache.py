@@ -0,0 +1,228 @@
+"""
+Persistent on-disk cache of built unit documents. Documents are stored in a local SQLite file keyed by a content
+hash of the source database, the element_global_id, the version_number and the pyusnvc package version, so a cached
+document is only ever reused for exactly the source and code that produced it. The cache is opt-in: pass a
+DocumentCache as the cache parameter of build_unit, build_units, build_all_units or get_schema.
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+from pyusnvc.export import dumps
+
+_fingerprints = dict()
+
+# Number of ids removed per statement by DocumentCache.invalidate, well under SQLite's limit on parameters
+INVALIDATE_CHUNK_SIZE = 500
+
+
+def source_fingerprint(source_data_filename):
+    """
+    Computes a content hash of the source database file. Hashes are remembered for as long as the file's size and
+    modification time stay the same, so the file is only read once per process.
+
+    :param source_data_filename: location of source data or a UsnvcSource
+    :return: Hex digest of the file contents
+    """
+    source_data_filename = getattr(source_data_filename, "source_data_filename", source_data_filename)
+    path = os.path.abspath(source_data_filename)
+    stat = os.stat(path)
+    key = (path, stat.st_size, stat.st_mtime_ns)
+
+    if key not in _fingerprints:
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1048576), b""):
+                h.update(block)
+        _fingerprints[key] = h.hexdigest()
+
+    return _fingerprints[key]
+
+
+class DocumentCache(object):
+    """
+    Size-bounded store of unit documents in a SQLite file. When the stored documents grow past max_bytes, the least
+    recently used documents are evicted.
+    """
+    def __init__(self, cache_filename, max_bytes=1073741824, package_version=None):
+        """
+        :param cache_filename: SQLite file to keep the cache in; created if it does not exist
+        :param max_bytes: Upper bound on the total size of the stored (compressed) documents
+        :param package_version: Package version to key documents on; defaults to the installed pyusnvc version
+        """
+        if package_version is None:
+            from pyusnvc import __version__
+            package_version = __version__
+
+        self.cache_filename = cache_filename
+        self.max_bytes = max_bytes
+        self.package_version = str(package_version)
+        self._lock = threading.Lock()
+
+        self.db = sqlite3.connect(cache_filename, timeout=30, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS documents (\
+            source_fingerprint TEXT, element_global_id INTEGER, version_number REAL, package_version TEXT,\
+            document BLOB, size INTEGER, last_access REAL,\
+            PRIMARY KEY (source_fingerprint, element_global_id, version_number, package_version))"
+        )
+        self.db.execute("CREATE INDEX IF NOT EXISTS documents_last_access ON documents (last_access)")
+        self.db.commit()
+
+    def size(self):
+        """
+        :return: Total size in bytes of the stored documents
+        """
+        with self._lock:
+            return self.db.execute("SELECT COALESCE(SUM(size), 0) FROM documents").fetchone()[0]
+
+    def get_many(self, source_data_filename, ids, version_number):
+        """
+        Looks up cached documents for a set of units.
+
+        :param source_data_filename: location of source data or a UsnvcSource
+        :param ids: List of integer element_global_id values
+        :param version_number: version_number the documents were built with
+        :return: Dictionary of element_global_id to document for the units found in the cache
+        """
+        fingerprint = source_fingerprint(source_data_filename)
+        ids = [int(i) for i in ids]
+        documents = dict()
+
+        with self._lock:
+            for chunk_start in range(0, len(ids), 500):
+                chunk = ids[chunk_start:chunk_start + 500]
+                placeholders = ", ".join("?" * len(chunk))
+                parameters = [fingerprint, version_number, self.package_version] + chunk
+                for element_global_id, document in self.db.execute(
+                        f"SELECT element_global_id, document FROM documents\
+                        WHERE source_fingerprint = ? AND version_number = ? AND package_version = ?\
+                        AND element_global_id IN ({placeholders})", parameters):
+                    documents[element_global_id] = json.loads(zlib.decompress(document))
+                if len(documents) > 0:
+                    self.db.execute(
+                        f"UPDATE documents SET last_access = ?\
+                        WHERE source_fingerprint = ? AND version_number = ? AND package_version = ?\
+                        AND element_global_id IN ({placeholders})", [time.time()] + parameters)
+            self.db.commit()
+
+        return documents
+
+    def get(self, source_data_filename, element_global_id, version_number):
+        """
+        :return: Cached document for a single unit or None
+        """
+        return self.get_many(source_data_filename, [element_global_id], version_number).get(int(element_global_id))
+
+    def put_many(self, source_data_filename, documents, version_number):
+        """
+        Stores built documents, evicting the least recently used documents if the cache grows past max_bytes.
+
+        :param source_data_filename: location of source data or a UsnvcSource
+        :param documents: List of unit documents
+        :param version_number: version_number the documents were built with
+        """
+        fingerprint = source_fingerprint(source_data_filename)
+        now = time.time()
+        rows = list()
+        for document in documents:
+            data = zlib.compress(dumps(document).encode("utf-8"), 1)
+            rows.append((fingerprint, int(document["Identifiers"]["element_global_id"]), version_number,
+                         self.package_version, data, len(data), now))
+
+        with self._lock:
+            self.db.executemany("INSERT OR REPLACE INTO documents VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            self.db.commit()
+        self.evict()
+
+    def put(self, source_data_filename, document, version_number):
+        self.put_many(source_data_filename, [document], version_number)
+
+    def evict(self, max_bytes=None):
+        """
+        Removes the least recently used documents until the cache is no larger than max_bytes.
+
+        :param max_bytes: Size to shrink to; defaults to the cache's max_bytes
+        :return: Number of documents removed
+        """
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+
+        removed = 0
+        with self._lock:
+            total = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM documents").fetchone()[0]
+            if total <= max_bytes:
+                return removed
+
+            cursor = self.db.execute("SELECT rowid, size FROM documents ORDER BY last_access")
+            evicted = list()
+            for rowid, size in cursor:
+                if total <= max_bytes:
+                    break
+                evicted.append((rowid,))
+                total -= size
+            cursor.close()
+
+            self.db.executemany("DELETE FROM documents WHERE rowid = ?", evicted)
+            self.db.commit()
+            removed = len(evicted)
+
+        return removed
+
+    def invalidate(self, source_data_filename=None, element_global_ids=None, version_number=None):
+        """
+        Removes cached documents matching all of the given criteria. With no criteria every document is removed.
+
+        :param source_data_filename: Only remove documents built from this source data
+        :param element_global_ids: Only remove documents for these units
+        :param version_number: Only remove documents built with this version_number
+        :return: Number of documents removed
+        """
+        conditions = list()
+        parameters = list()
+        if source_data_filename is not None:
+            conditions.append("source_fingerprint = ?")
+            parameters.append(source_fingerprint(source_data_filename))
+        if version_number is not None:
+            conditions.append("version_number = ?")
+            parameters.append(version_number)
+        sql = "DELETE FROM documents"
+        if len(conditions) > 0:
+            sql += " WHERE " + " AND ".join(conditions)
+
+        with self._lock:
+            if element_global_ids is None:
+                removed = self.db.execute(sql, parameters).rowcount
+            else:
+                sql += " AND " if len(conditions) > 0 else " WHERE "
+                element_global_ids = [int(i) for i in element_global_ids]
+                removed = 0
+                for chunk_start in range(0, len(element_global_ids), INVALIDATE_CHUNK_SIZE):
+                    chunk = element_global_ids[chunk_start:chunk_start + INVALIDATE_CHUNK_SIZE]
+                    removed += self.db.execute(f"{sql}element_global_id IN ({', '.join('?' * len(chunk))})",
+                                               parameters + chunk).rowcount
+            self.db.commit()
+        return removed
+
+    def clear(self):
+        """
+        Removes every document from the cache.
+
+        :return: Number of documents removed
+        """
+        return self.invalidate()
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -0,0 +1,345 @@
+"""
+Exports the tabular data behind the unit documents as columnar Parquet or Arrow IPC files for analytics. Each raw
+data section of the documents (the state and province distribution, the USFS ecoregions, the state crosswalk and the
+references) becomes a table with one row per record, keyed by element_global_id and the record's position in the
+section, alongside a hierarchy table with one row per unit. The rows are taken from the built documents themselves,
+so the tables always agree with the JSON export, and are written in row groups as the documents stream from the
+build. Each table is partitioned by hierarchyLevel in the hive layout (<table>/hierarchyLevel=<level>/part-0.parquet)
+that pyarrow.dataset, pandas, DuckDB and Spark read directly. Requires the pyarrow package.
+"""
+
+import json
+import math
+import os
+import time
+
+from pyusnvc.usnvc import UsnvcSource, UnitTree, all_keys, build_units, section_queries
+
+# Tables of document records: name to the path of the list of records in the document and the unit query the records
+# come from. A table is written for a version when the query is among those usnvc.section_queries gives for it.
+SECTION_TABLES = {
+    "distribution": {
+        "path": ["Distribution", "States/Provinces Raw Data"],
+        "query": "distribution"
+    },
+    "usfs_ecoregion_1994": {
+        "path": ["Distribution", "1994 USFS Ecoregion Raw Data"],
+        "query": "usfs_1994"
+    },
+    "usfs_ecoregion_2007": {
+        "path": ["Distribution", "2007 USFS Ecoregion Raw Data"],
+        "query": "usfs_2007"
+    },
+    "crosswalk": {
+        "path": ["State Crosswalk", "Crosswalk Raw Data"],
+        "query": "crosswalk"
+    },
+    "references": {
+        "path": ["References"],
+        "query": "references"
+    }
+}
+
+# Columns of the hierarchy table: name, Arrow type name and function taking the document to the value. The
+# hierarchyLevel comes from the partition, as it does for every other table.
+HIERARCHY_COLUMNS = [
+    ("element_global_id", "int64", lambda d: d["Identifiers"]["element_global_id"]),
+    ("Database Code", "string", lambda d: d["Identifiers"]["Database Code"]),
+    ("Classification Code", "string", lambda d: d["Identifiers"]["Classification Code"]),
+    ("Scientific Name", "string", lambda d: d["Overview"]["Scientific Name"]),
+    ("Translated Name", "string", lambda d: d["Overview"]["Translated Name"]),
+    ("Colloquial Name", "string", lambda d: d["Overview"].get("Colloquial Name")),
+    ("title", "string", lambda d: d["title"]),
+    ("parent", "int64", lambda d: d["parent"]),
+    ("parent_id", "string", lambda d: d["Hierarchy"]["parent_id"]),
+    ("d_classification_level_id", "int64", lambda d: d["Hierarchy"]["d_classification_level_id"]),
+    ("unitsort", "string", lambda d: d["Hierarchy"]["unitsort"]),
+    ("parentkey", "string", lambda d: d["Hierarchy"]["parentkey"]),
+    ("parentname", "string", lambda d: d["Hierarchy"]["parentname"]),
+    ("ancestors", "list<int64>", lambda d: d["ancestors"]),
+    ("children", "list<int64>", lambda d: d.get("children", []))
+]
+
+# Partition directory name used by hive for a missing value
+DEFAULT_PARTITION = "__HIVE_DEFAULT_PARTITION__"
+
+FORMATS = {
+    "parquet": ".parquet",
+    "arrow": ".arrow"
+}
+
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("Columnar export requires the pyarrow package (pip install pyarrow)")
+    return pyarrow
+
+
+def _json_schema_types(schema):
+    """
+    :param schema: JSON Schema of a single property
+    :return: Set of JSON types the property can take
+    """
+    types = schema.get("type", [])
+    types = set(types if isinstance(types, list) else [types])
+    for alternative in schema.get("anyOf", []):
+        types |= _json_schema_types(alternative)
+    return types
+
+
+def _column_kind(schema):
+    """
+    Chooses the Arrow type for a record property from the JSON types genson inferred for it: integers stay int64,
+    any mix of integers and numbers is float64 (the build turns integer columns with NULLs into floats) and anything
+    else, including mixes with strings, is a string.
+    """
+    types = _json_schema_types(schema) - {"null"}
+    if types == {"integer"}:
+        return "int64"
+    if len(types) > 0 and types <= {"integer", "number"}:
+        return "float64"
+    if types == {"boolean"}:
+        return "bool"
+    return "string"
+
+
+def _arrow_type(pa, kind):
+    if kind == "list<int64>":
+        return pa.list_(pa.int64())
+    return {"int64": pa.int64(), "float64": pa.float64(), "bool": pa.bool_(), "string": pa.string()}[kind]
+
+
+def _coerce(value, kind):
+    """
+    Converts a document value to the column's type. Values already of that type, which is almost all of them, are
+    passed through unchanged.
+    """
+    if value is None:
+        return None
+    if kind == "string":
+        return value if isinstance(value, str) else json.dumps(value.item() if hasattr(value, "item") else value)
+    if kind == "int64":
+        if isinstance(value, float):
+            return None if math.isnan(value) else int(value)
+        return int(value)
+    if kind == "float64":
+        return float(value)
+    if kind == "bool":
+        return bool(value)
+    return [int(v) for v in value]
+
+
+def _section(document, path):
+    value = document
+    for key in path:
+        if not isinstance(value, dict) or key not in value:
+            return []
+        value = value[key]
+    return value
+
+
+def table_columns(schema, version_number):
+    """
+    Works out the columns of each table from the unit schema.
+
+    :param schema: Unit JSON Schema, as returned by get_schema or validation.load_schema
+    :param version_number: version_number the documents are built with
+    :return: Dictionary of table name to a list of (column name, Arrow type name) tuples
+    """
+    queries = section_queries(version_number)
+    columns = {"hierarchy": [(name, kind) for name, kind, _ in HIERARCHY_COLUMNS]}
+    for name, table in SECTION_TABLES.items():
+        if table["query"] not in queries:
+            continue
+        section_schema = schema
+        for key in table["path"]:
+            section_schema = section_schema.get("properties", {}).get(key, {})
+        properties = section_schema.get("items", {}).get("properties", {})
+        columns[name] = [("element_global_id", "int64"), ("position", "int64")] + [
+            (k, _column_kind(v)) for k, v in properties.items() if k != "element_global_id"
+        ]
+    return columns
+
+
+def document_rows(document, columns):
+    """
+    Flattens a unit document into rows for each table.
+
+    :param document: Unit document
+    :param columns: Table columns, as returned by table_columns
+    :return: Dictionary of table name to a list of row dictionaries
+    :raises ValueError: if a record has a property the schema does not list, as it would have no column to go in
+    """
+    rows = {"hierarchy": [{name: _coerce(value(document), kind) for name, kind, value in HIERARCHY_COLUMNS}]}
+    element_global_id = int(document["Identifiers"]["element_global_id"])
+
+    for name, section_columns in columns.items():
+        if name == "hierarchy":
+            continue
+        data_columns = section_columns[2:]
+        known = {c for c, _ in data_columns} | {"element_global_id"}
+        rows[name] = list()
+        for position, record in enumerate(_section(document, SECTION_TABLES[name]["path"])):
+            unknown = set(record) - known
+            if len(unknown) > 0:
+                raise ValueError(f"Unit {element_global_id} has {name} properties missing from the schema: "
+                                 f"{sorted(unknown)}; pass a schema built from this source (see get_schema)")
+            row = {"element_global_id": element_global_id, "position": position}
+            row.update((c, _coerce(record.get(c), kind)) for c, kind in data_columns)
+            rows[name].append(row)
+    return rows
+
+
+def _partition(value):
+    return DEFAULT_PARTITION if value is None else str(value).replace("/", "_")
+
+
+class _PartitionedWriter(object):
+    """
+    Buffers the rows of one table and writes them as row groups to a file per hierarchyLevel partition.
+    """
+    def __init__(self, output_folder, name, columns, output_format, row_group_size, compression):
+        self.pa = _pyarrow()
+        self.folder = os.path.join(output_folder, name)
+        self.schema = self.pa.schema([(c, _arrow_type(self.pa, kind)) for c, kind in columns])
+        self.output_format = output_format
+        self.row_group_size = row_group_size
+        self.compression = compression
+        self.buffers = dict()
+        self.writers = dict()
+        self.rows = 0
+
+    def append(self, level, rows):
+        buffer = self.buffers.setdefault(level, list())
+        buffer.extend(rows)
+        if len(buffer) >= self.row_group_size:
+            self._flush(level)
+
+    def _flush(self, level):
+        rows = self.buffers.pop(level, [])
+        if len(rows) == 0:
+            return
+        if level not in self.writers:
+            folder = os.path.join(self.folder, f"hierarchyLevel={_partition(level)}")
+            os.makedirs(folder, exist_ok=True)
+            filename = os.path.join(folder, "part-0" + FORMATS[self.output_format])
+            if self.output_format == "parquet":
+                self.writers[level] = self.pa.parquet.ParquetWriter(filename, self.schema,
+                                                                    compression=self.compression)
+            else:
+                options = self.pa.ipc.IpcWriteOptions(compression=self.compression)
+                self.writers[level] = self.pa.ipc.new_file(filename, self.schema, options=options)
+        table = self.pa.Table.from_pylist(rows, schema=self.schema)
+        if self.output_format == "parquet":
+            self.writers[level].write_table(table, row_group_size=self.row_group_size)
+        else:
+            self.writers[level].write_table(table)
+        self.rows += len(rows)
+
+    def close(self):
+        for level in list(self.buffers):
+            self._flush(level)
+        for writer in self.writers.values():
+            writer.close()
+
+
+def export_columnar(source_data_filename, version_number, output_folder, output_format="parquet", schema=None,
+                    ids=None, workers=None, batch_size=500, row_group_size=65536, compression="zstd",
+                    progress=None, progress_interval=10):
+    """
+    Builds unit documents and writes their tabular sections as partitioned columnar tables.
+
+    :param source_data_filename: location of source data or a UsnvcSource
+    :param version_number: do some specific processing based on version
+    :param output_folder: Folder to write a sub-folder per table to
+    :param output_format: "parquet" or "arrow" (Arrow IPC files)
+    :param schema: Unit JSON Schema giving the record properties and their types; defaults to the packaged schema
+    for the version, which is only packaged for 2.03
+    :param ids: Optional list of element_global_id values to export; defaults to every unit
+    :param workers: Number of worker processes to build with; units are built in this process when None
+    :param batch_size: Number of units to fetch per round of queries when building in this process
+    :param row_group_size: Number of rows buffered per partition before they are written as a row group
+    :param compression: Compression codec, such as "zstd", "snappy" (Parquet only) or None
+    :param progress: Optional function called with a status dictionary every progress_interval seconds and at the end
+    :param progress_interval: Seconds between progress reports
+    :return: Dictionary with the number of documents, the rows written to each table, elapsed seconds and documents
+    per second
+    """
+    if output_format not in FORMATS:
+        raise ValueError(f"output_format must be one of {list(FORMATS)}")
+    if schema is None:
+        from pyusnvc.validation import load_schema
+        try:
+            schema = load_schema(version_number)
+        except FileNotFoundError:
+            raise ValueError(f"No unit schema is packaged for version {version_number}; pass schema, such as one "
+                             f"built with usnvc.get_schema")
+
+    start_time = time.time()
+    columns = table_columns(schema, version_number)
+    writers = {name: _PartitionedWriter(output_folder, name, section_columns, output_format, row_group_size,
+                                        compression)
+               for name, section_columns in columns.items()}
+    status = {
+        "documents": 0,
+        "rows": {name: 0 for name in columns},
+        "seconds": 0,
+        "documents_per_second": 0
+    }
+
+    def update_status():
+        status["seconds"] = time.time() - start_time
+        status["rows"] = {name: w.rows + sum(len(b) for b in w.buffers.values()) for name, w in writers.items()}
+        if status["seconds"] > 0:
+            status["documents_per_second"] = status["documents"] / status["seconds"]
+
+    try:
+        with UsnvcSource(source_data_filename) as source:
+            if ids is None:
+                ids = all_keys(source)
+            if workers is None:
+                documents = build_units(ids, source, version_number, batch_size=batch_size,
+                                        unit_tree=UnitTree.load(source))
+            else:
+                from pyusnvc.parallel import build_units_parallel
+                documents = build_units_parallel(ids, source, version_number, workers=workers)
+
+            last_report = time.time()
+            for document in documents:
+                level = document["Hierarchy"]["hierarchyLevel"]
+                for name, rows in document_rows(document, columns).items():
+                    writers[name].append(level, rows)
+                status["documents"] += 1
+
+                if progress is not None and time.time() - last_report >= progress_interval:
+                    update_status()
+                    progress(dict(status))
+                    last_report = time.time()
+    finally:
+        for writer in writers.values():
+            writer.close()
+
+    update_status()
+    if progress is not None:
+        progress(dict(status))
+    return status
+
+
+def read_table(output_folder, name):
+    """
+    Reads one of the exported tables back, with hierarchyLevel restored from the partitions.
+
+    :param output_folder: Folder passed to export_columnar
+    :param name: Table name, such as "distribution" or "hierarchy"
+    :return: pyarrow Table
+    """
+    _pyarrow()
+    import pyarrow.dataset
+
+    folder = os.path.join(output_folder, name)
+    is_parquet = any(f.endswith(".parquet") for _, _, files in os.walk(folder) for f in files)
+    dataset = pyarrow.dataset.dataset(folder, format="parquet" if is_parquet else "ipc", partitioning="hive")
+    return dataset.to_table()
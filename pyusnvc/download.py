@@ -0,0 +1,292 @@
+"""
+Streaming retrieval of the USNVC source data. Archives are downloaded in chunks to a .part file that later attempts
+resume with an HTTP range request, checked against the size and checksum ScienceBase lists for the file, and only
+the database member is streamed out of them. A local mirror directory or another server holding the same files can
+stand in for ScienceBase, so build nodes do not all have to fetch from it.
+"""
+
+import hashlib
+import json
+import os
+from zipfile import ZipFile
+
+CHUNK_SIZE = 1048576
+
+
+def _is_url(location):
+    return str(location).startswith("http://") or str(location).startswith("https://")
+
+
+def _hash(algorithm):
+    try:
+        return hashlib.new(algorithm.lower().replace("-", ""))
+    except ValueError:
+        raise ValueError(f"Unsupported checksum type: {algorithm}")
+
+
+def file_checksum(filename, algorithm="sha256"):
+    """
+    :param filename: File to hash
+    :param algorithm: hashlib algorithm name; ScienceBase names such as MD5 or SHA-1 are accepted
+    :return: Hex digest of the file contents
+    """
+    h = _hash(algorithm)
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(CHUNK_SIZE), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def expected_checksum(file_metadata):
+    """
+    :param file_metadata: Entry from the files list of a ScienceBase item
+    :return: Tuple of the checksum type and value listed for the file, or (None, None) when there is none
+    """
+    checksum = file_metadata.get("checksum") or dict()
+    if checksum.get("value") is None:
+        return None, None
+    return checksum.get("type", "MD5"), checksum["value"].lower()
+
+
+def verify_file(filename, size=None, checksum_type=None, checksum=None):
+    """
+    Checks a file against its expected size and checksum.
+
+    :raises ValueError: if the file does not match
+    """
+    if size is not None and os.path.getsize(filename) != size:
+        raise ValueError(f"{filename} is {os.path.getsize(filename)} bytes rather than the expected {size}")
+    if checksum is not None:
+        actual = file_checksum(filename, checksum_type)
+        if actual != checksum:
+            raise ValueError(f"{filename} has {checksum_type} checksum {actual} rather than the expected {checksum}")
+
+
+def matches(filename, size=None, checksum_type=None, checksum=None):
+    """
+    :return: True if the file exists and matches its expected size and checksum
+    """
+    if not os.path.exists(filename):
+        return False
+    try:
+        verify_file(filename, size, checksum_type, checksum)
+    except ValueError:
+        return False
+    return True
+
+
+def _range_length(response):
+    """
+    :param response: 416 response to a range request
+    :return: Length of the file from the response's Content-Range header (bytes */length), or None if it has none
+    """
+    content_range = response.headers.get("Content-Range", "")
+    if content_range.startswith("bytes */") and content_range[8:].isdigit():
+        return int(content_range[8:])
+    return None
+
+
+def download(url, filename, size=None, checksum_type=None, checksum=None, session=None, timeout=60):
+    """
+    Streams a URL to a file. The data is written to filename.part first, and when that already exists from an
+    interrupted attempt the download resumes from its end if the server supports range requests. The completed file
+    is checked against the expected size and checksum before it is moved into place.
+
+    :param url: URL to download
+    :param filename: File to write
+    :param size: Expected size in bytes, if known
+    :param checksum_type: hashlib algorithm of the expected checksum, such as MD5
+    :param checksum: Expected hex digest, if known
+    :param session: Optional requests session to download with
+    :param timeout: Seconds to wait for the server to respond
+    :return: filename
+    :raises ValueError: if the downloaded file does not match the expected size or checksum; the partial file is
+    removed so that the next attempt starts again
+    """
+    import requests
+
+    session = session or requests.Session()
+    part_filename = filename + ".part"
+    offset = os.path.getsize(part_filename) if os.path.exists(part_filename) else 0
+    if size is not None and offset > size:
+        os.remove(part_filename)
+        offset = 0
+
+    headers = {"Range": f"bytes={offset}-"} if offset > 0 else {}
+    with session.get(url, headers=headers, stream=True, timeout=timeout) as response:
+        if response.status_code == 416 and offset > 0:
+            # The range starts at or past the end of the file. The partial file is complete when it is as long as
+            # the expected size or the size the server reports, or failing both when it matches the checksum;
+            # otherwise it is started again without a range.
+            length = size if size is not None else _range_length(response)
+            if length is None and checksum is not None:
+                complete = matches(part_filename, None, checksum_type, checksum)
+            else:
+                complete = offset == length
+            if not complete:
+                os.remove(part_filename)
+                return download(url, filename, size, checksum_type, checksum, session, timeout)
+        else:
+            response.raise_for_status()
+            mode = "ab" if offset > 0 and response.status_code == 206 else "wb"
+            with open(part_filename, mode) as f:
+                for block in response.iter_content(CHUNK_SIZE):
+                    f.write(block)
+
+    try:
+        verify_file(part_filename, size, checksum_type, checksum)
+    except ValueError:
+        os.remove(part_filename)
+        raise
+    os.replace(part_filename, filename)
+    return filename
+
+
+def fetch_metadata(item_id, metadata_filename, mirror=None, force=False):
+    """
+    Reads the cached ScienceBase item metadata, fetching and caching it when it is missing or force is set.
+
+    :param item_id: ScienceBase item id
+    :param metadata_filename: JSON file the metadata is cached in
+    :param mirror: Optional directory or base URL holding <item_id>.json to use instead of ScienceBase
+    :param force: Fetch the metadata even if it is cached
+    :return: Item metadata dictionary
+    """
+    if os.path.exists(metadata_filename) and not force:
+        with open(metadata_filename, "r") as f:
+            return json.load(f)
+
+    if mirror is None:
+        from sciencebasepy import SbSession
+        metadata = SbSession().get_item(item_id)
+    elif _is_url(mirror):
+        import requests
+        response = requests.get(f"{mirror.rstrip('/')}/{item_id}.json", timeout=60)
+        response.raise_for_status()
+        metadata = response.json()
+    else:
+        with open(os.path.join(mirror, f"{item_id}.json"), "r") as f:
+            metadata = json.load(f)
+
+    with open(metadata_filename, "w") as f:
+        json.dump(metadata, f)
+    return metadata
+
+
+def fetch_archive(file_metadata, archive_filename, mirror=None, force=False):
+    """
+    Makes a verified copy of a ScienceBase file available locally. A file already on disk that matches the listed
+    checksum is used as it is. A mirror directory is read in place rather than copied.
+
+    :param file_metadata: Entry from the files list of the ScienceBase item
+    :param archive_filename: Where to download the file to
+    :param mirror: Optional directory or base URL holding the file under its ScienceBase name
+    :param force: Download the file even if a matching copy is on disk
+    :return: Path to the verified file
+    """
+    size = file_metadata.get("size")
+    checksum_type, checksum = expected_checksum(file_metadata)
+
+    if mirror is not None and not _is_url(mirror):
+        mirror_filename = os.path.join(mirror, file_metadata["name"])
+        verify_file(mirror_filename, size, checksum_type, checksum)
+        return mirror_filename
+
+    if not force and matches(archive_filename, size, checksum_type, checksum):
+        return archive_filename
+
+    if mirror is None:
+        url = file_metadata["url"]
+    else:
+        url = f"{mirror.rstrip('/')}/{file_metadata['name']}"
+    return download(url, archive_filename, size, checksum_type, checksum)
+
+
+def extract_database(archive_filename, data_filename, member_name=None):
+    """
+    Streams the database member of a zip archive to a file, without extracting anything else.
+
+    :param archive_filename: Zip archive
+    :param data_filename: File to write the database to
+    :param member_name: Name of the member to extract; defaults to the only .db member, or the one named like
+    data_filename when there are several
+    :return: Tuple of the member name and the SHA-256 hex digest of the extracted data
+    """
+    with ZipFile(archive_filename, "r") as zip_ref:
+        if member_name is None:
+            members = [m for m in zip_ref.namelist() if m.lower().endswith(".db")]
+            if len(members) > 1:
+                members = [m for m in members if os.path.basename(m) == os.path.basename(data_filename)] or members
+            if len(members) != 1:
+                raise ValueError(f"Could not identify the database in {archive_filename} among {zip_ref.namelist()}")
+            member_name = members[0]
+
+        h = hashlib.sha256()
+        temporary_filename = data_filename + ".tmp"
+        with zip_ref.open(member_name) as source, open(temporary_filename, "wb") as destination:
+            for block in iter(lambda: source.read(CHUNK_SIZE), b""):
+                h.update(block)
+                destination.write(block)
+        os.replace(temporary_filename, data_filename)
+
+    return member_name, h.hexdigest()
+
+
+def _record_filename(data_filename):
+    return data_filename + ".source.json"
+
+
+def extraction_record(data_filename):
+    """
+    :param data_filename: Extracted database
+    :return: Record written by record_extraction for the database, or None if there is none or it no longer matches
+    the file on disk
+    """
+    if not os.path.exists(data_filename) or not os.path.exists(_record_filename(data_filename)):
+        return None
+    with open(_record_filename(data_filename), "r") as f:
+        record = json.load(f)
+
+    stat = os.stat(data_filename)
+    if (stat.st_size, stat.st_mtime_ns) != (record["size"], record["mtime_ns"]):
+        # The file was touched since it was extracted; it still counts if the contents are the same
+        if stat.st_size != record["size"] or file_checksum(data_filename) != record["sha256"]:
+            return None
+    return record
+
+
+def record_extraction(data_filename, file_metadata, member_name, sha256, archive_filename=None):
+    """
+    Notes which archive a database was extracted from, so the next call can tell it is already up to date.
+
+    :param archive_filename: Archive file the database was extracted from, which may be in a mirror directory
+    """
+    checksum_type, checksum = expected_checksum(file_metadata)
+    stat = os.stat(data_filename)
+    record = {
+        "archive_name": file_metadata["name"],
+        "archive_filename": archive_filename,
+        "archive_size": file_metadata.get("size"),
+        "archive_checksum_type": checksum_type,
+        "archive_checksum": checksum,
+        "member_name": member_name,
+        "sha256": sha256,
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns
+    }
+    with open(_record_filename(data_filename), "w") as f:
+        json.dump(record, f, indent=2)
+    return record
+
+
+def is_current(data_filename, file_metadata):
+    """
+    :return: True if the database was extracted from the archive the metadata lists and is unchanged since
+    """
+    record = extraction_record(data_filename)
+    if record is None:
+        return False
+    checksum_type, checksum = expected_checksum(file_metadata)
+    return record["archive_name"] == file_metadata["name"] \
+        and record["archive_size"] == file_metadata.get("size") \
+        and record["archive_checksum"] == checksum
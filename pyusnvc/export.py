@@ -0,0 +1,183 @@
+"""
+Exports the full USNVC distribution to a newline-delimited JSON file, one unit document per line, starting with the
+logical root document. Documents are streamed from the batched or multi-processing build straight to the output
+file, optionally compressed, so memory use does not grow with the size of the classification.
+"""
+
+import gzip
+import io
+import json
+import sys
+import time
+
+from pyusnvc.usnvc import UsnvcSource, UnitTree, all_keys, build_units, logical_nvcs_root
+
+COMPRESSION_EXTENSIONS = {
+    ".gz": "gzip",
+    ".zst": "zstd"
+}
+
+
+def _compression_for(filename, compression):
+    """
+    Works out the compression to use, inferring it from the file extension when not given.
+
+    :param filename: Output or input filename
+    :param compression: "gzip", "zstd", "none" or None to infer from the filename
+    :return: "gzip", "zstd" or None
+    """
+    if compression is None:
+        compression = next((v for k, v in COMPRESSION_EXTENSIONS.items() if str(filename).endswith(k)), None)
+    if compression == "none":
+        compression = None
+    if compression not in [None, "gzip", "zstd"]:
+        raise ValueError(f"Unsupported compression: {compression}")
+    return compression
+
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError("zstd compression requires the zstandard package (pip install zstandard)")
+    return zstandard
+
+
+def open_export(filename, mode="r", compression=None):
+    """
+    Opens an export file as a text stream, compressing or decompressing it as needed.
+
+    :param filename: Export filename
+    :param mode: "r" to read or "w" to write
+    :param compression: "gzip", "zstd", "none" or None to infer from the filename extension
+    :return: Text file object
+    """
+    compression = _compression_for(filename, compression)
+
+    if compression == "gzip":
+        return gzip.open(filename, mode + "t", encoding="utf-8")
+    elif compression == "zstd":
+        zstandard = _zstandard()
+        raw_file = open(filename, mode + "b")
+        if mode == "w":
+            stream = zstandard.ZstdCompressor().stream_writer(raw_file)
+        else:
+            stream = zstandard.ZstdDecompressor().stream_reader(raw_file)
+        return io.TextIOWrapper(stream, encoding="utf-8")
+    else:
+        return open(filename, mode, encoding="utf-8")
+
+
+def _json_default(value):
+    """
+    Converts numpy scalar values that can come through from the source data into plain Python values.
+    """
+    if hasattr(value, "item"):
+        return value.item()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def dumps(document):
+    """
+    Serializes a unit document as a single line of JSON.
+
+    :param document: Unit document
+    :return: JSON string
+    """
+    return json.dumps(document, default=_json_default)
+
+
+def read_export(filename, compression=None):
+    """
+    Reads the documents back from an export file.
+
+    :param filename: Export filename
+    :param compression: "gzip", "zstd", "none" or None to infer from the filename extension
+    :return: Generator yielding documents
+    """
+    with open_export(filename, "r", compression) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def progress_printer(stream=sys.stderr):
+    """
+    Creates a progress function that prints the export status.
+
+    :param stream: Stream to print to
+    :return: Function suitable for the progress parameter of export_units
+    """
+    def progress(status):
+        print(
+            f'{status["documents"]} documents, {status["bytes"] / 1048576:.1f} MiB written, '
+            f'{status["documents_per_second"]:.1f} documents/s',
+            file=stream
+        )
+    return progress
+
+
+def export_units(source_data_filename, version_number, output_filename, compression=None, ids=None, workers=None,
+                 batch_size=500, include_root=True, progress=None, progress_interval=10):
+    """
+    Builds unit documents and writes them to a newline-delimited JSON file.
+
+    :param source_data_filename: location of source data or a UsnvcSource
+    :param version_number: do some specific processing based on version
+    :param output_filename: File to write
+    :param compression: "gzip", "zstd", "none" or None to infer from the filename extension
+    :param ids: Optional list of element_global_id values to export; defaults to every unit
+    :param workers: Number of worker processes to build with; units are built in this process when None
+    :param batch_size: Number of units to fetch per round of queries when building in this process
+    :param include_root: Whether to write the logical_nvcs_root document as the first line
+    :param progress: Optional function called with a status dictionary every progress_interval seconds and at the end
+    :param progress_interval: Seconds between progress reports
+    :return: Dictionary with the number of documents and bytes written, elapsed seconds and documents per second
+    """
+    start_time = time.time()
+    status = {
+        "documents": 0,
+        "bytes": 0,
+        "seconds": 0,
+        "documents_per_second": 0
+    }
+
+    def update_status():
+        status["seconds"] = time.time() - start_time
+        if status["seconds"] > 0:
+            status["documents_per_second"] = status["documents"] / status["seconds"]
+
+    with UsnvcSource(source_data_filename) as source, open_export(output_filename, "w", compression) as f:
+        unit_tree = UnitTree.load(source)
+        if ids is None:
+            ids = all_keys(source)
+
+        if workers is None:
+            documents = build_units(ids, source, version_number, batch_size=batch_size, unit_tree=unit_tree)
+        else:
+            from pyusnvc.parallel import build_units_parallel
+            documents = build_units_parallel(ids, source, version_number, workers=workers)
+
+        if include_root:
+            line = dumps(logical_nvcs_root(source, unit_tree)) + "\n"
+            f.write(line)
+            status["documents"] += 1
+            status["bytes"] += len(line.encode("utf-8"))
+
+        last_report = time.time()
+        for document in documents:
+            line = dumps(document) + "\n"
+            f.write(line)
+            status["documents"] += 1
+            status["bytes"] += len(line.encode("utf-8"))
+
+            if progress is not None and time.time() - last_report >= progress_interval:
+                update_status()
+                progress(dict(status))
+                last_report = time.time()
+
+    update_status()
+    if progress is not None:
+        progress(dict(status))
+
+    return status
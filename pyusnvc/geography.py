@@ -0,0 +1,323 @@
+"""
+Inverted index from places to the units that occur in them, for answering questions such as "which types occur in
+Oregon" or "which are in USFS ecoregion section M242" without building any documents. The index is read straight
+from UnitXSubnation, UnitXEcoregionUsfs2007 and UnitCrosswalk, and holds a bitmap over the units (a Python int with
+one bit per unit, in element_global_id order) for each place and combination of qualifiers:
+
+* subnation - state or province, coded like US-OR, qualified by presence and confidence as in "States/Provinces Raw
+  Data"
+* nation - the nation of those states and provinces, such as US, with the same qualifiers
+* ecoregion_2007 - USFS 2007 ecoregion code such as M242, qualified by occurrence as in "2007 USFS Ecoregion Raw Data"
+* crosswalk - state crosswalk, coded like US-OR, qualified by linkage; "States Using USNVC Type" are the US states
+  with linkage "1 direct"
+
+Bitmaps combine with | for union and & for intersection, can be rolled up the classification so that a unit counts
+as occurring wherever any unit below it does, and can be restricted to a hierarchy level. The index can be saved to
+and loaded from a JSON file.
+"""
+
+import json
+
+from pyusnvc.cache import source_fingerprint
+from pyusnvc.usnvc import _opened_source
+
+# Qualifiers recorded for each kind of place
+KINDS = {
+    "subnation": ("presence", "confidence"),
+    "nation": ("presence", "confidence"),
+    "ecoregion_2007": ("occurrence",),
+    "crosswalk": ("linkage",)
+}
+
+# Query reading the places of each kind, keyed by the table it reads
+_QUERIES = {
+    "subnation": ("UnitXSubnation", "SELECT UnitXSubnation.ELEMENT_GLOBAL_ID, ISO_Nation_cd, Subnation_cd,\
+        curr_presence_absence_cd, dist_confidence_cd\
+        FROM UnitXSubnation\
+        JOIN d_curr_presence_absence\
+        ON UnitXSubnation.d_curr_presence_absence_id = d_curr_presence_absence.d_curr_presence_absence_id\
+        JOIN d_dist_confidence\
+        ON UnitXSubnation.d_dist_confidence_id = d_dist_confidence.d_dist_confidence_id\
+        JOIN d_subnation\
+        ON UnitXSubnation.SUBNATION_ID = d_subnation.Subnation_id"),
+    "ecoregion_2007": ("UnitXEcoregionUsfs2007", "SELECT UnitXEcoregionUsfs2007.element_global_id,\
+        usfs_ecoregion_2007_concat_cd, occurrence_status_cd\
+        FROM UnitXEcoregionUsfs2007\
+        JOIN d_usfs_ecoregion2007\
+        ON UnitXEcoregionUsfs2007.usfs_ecoregion_2007_id = d_usfs_ecoregion2007.usfs_ecoregion_2007_id\
+        JOIN d_occurrence_status\
+        ON UnitXEcoregionUsfs2007.d_occurrence_status_id = d_occurrence_status.d_occurrence_status_id"),
+    "crosswalk": ("UnitCrosswalk", "SELECT UnitCrosswalk.element_global_id, ISO_Nation_cd, Subnation_cd, linkage\
+        FROM UnitCrosswalk\
+        JOIN d_subnation\
+        ON UnitCrosswalk.subnation_id = d_subnation.Subnation_id")
+}
+
+
+def _from_positions(positions, size):
+    bits = bytearray((size + 7) // 8)
+    for pos in positions:
+        bits[pos >> 3] |= 1 << (pos & 7)
+    return int.from_bytes(bits, "little")
+
+
+def positions(bitmap):
+    """
+    :param bitmap: Bitmap over the units of a GeographicIndex
+    :return: Generator of the positions of the set bits, in ascending order
+    """
+    digits = bin(bitmap)[:1:-1]
+    pos = digits.find("1")
+    while pos >= 0:
+        yield pos
+        pos = digits.find("1", pos + 1)
+
+
+def parse_place(place):
+    """
+    :param place: (kind, code) tuple or "kind:code" string, such as "subnation:US-OR"
+    :return: Tuple of the kind and code
+    :raises ValueError: if the place is not of that form or its kind is not one of KINDS
+    """
+    if isinstance(place, str):
+        if ":" not in place:
+            raise ValueError(f"Places are given as kind:code, not {place!r}")
+        place = place.split(":", 1)
+    kind, code = place
+    if kind not in KINDS:
+        raise ValueError(f"Unknown kind {kind!r} in place {':'.join(place)!r}; kind must be one of {list(KINDS)}")
+    return kind, code
+
+
+def _qualifier_matches(value, wanted):
+    if wanted is None:
+        return True
+    if isinstance(wanted, str):
+        return value == wanted
+    return value in wanted
+
+
+class GeographicIndex(object):
+    """
+    Bitmaps of the units occurring in each place, along with the parent and hierarchy level of each unit for
+    rolling results up the classification.
+    """
+    def __init__(self, ids, parents, levels, postings, ecoregion_parents, fingerprint=None):
+        """
+        :param ids: Sorted list of element_global_id values; bit n of a bitmap stands for ids[n]
+        :param parents: Position of each unit's parent, or -1 for the Classes
+        :param levels: hierarchyLevel of each unit
+        :param postings: Dictionary of kind to a dictionary of place code to a dictionary of qualifier tuple to bitmap
+        :param ecoregion_parents: Dictionary of USFS 2007 ecoregion code to the code of the ecoregion containing it
+        :param fingerprint: Fingerprint of the source data the index was built from
+        """
+        self.ids = ids
+        self.positions = {element_global_id: pos for pos, element_global_id in enumerate(ids)}
+        self.parents = parents
+        self.levels = levels
+        self.postings = postings
+        self.ecoregion_parents = ecoregion_parents
+        self.fingerprint = fingerprint
+
+        self.level_bitmaps = dict()
+        for level in set(levels):
+            self.level_bitmaps[level] = _from_positions([p for p, l in enumerate(levels) if l == level], len(ids))
+
+    @classmethod
+    def build(cls, source_data_filename):
+        """
+        Reads the index from the distribution, ecoregion and crosswalk tables of the source data.
+
+        :param source_data_filename: location of source data or a UsnvcSource
+        :return: GeographicIndex
+        """
+        with _opened_source(source_data_filename) as source:
+            tables = {r[0] for r in source.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+            units = sorted(source.execute("SELECT element_global_id, PARENT_ID, hierarchylevel FROM Unit").fetchall())
+            # UnitCrosswalk is only in the 2.03 source data
+            rows = {kind: source.execute(sql).fetchall() for kind, (table_name, sql) in _QUERIES.items()
+                    if table_name in tables}
+            ecoregion_parents = {
+                code: parent_code for code, parent_code in source.execute(
+                    "SELECT ecoregion.usfs_ecoregion_2007_concat_cd, parent.usfs_ecoregion_2007_concat_cd\
+                    FROM d_usfs_ecoregion2007 AS ecoregion\
+                    LEFT OUTER JOIN d_usfs_ecoregion2007 AS parent\
+                    ON ecoregion.parent_usfs_ecoregion_2007_id = parent.usfs_ecoregion_2007_id")
+                if code is not None and parent_code is not None and parent_code != code
+            } if "d_usfs_ecoregion2007" in tables else dict()
+            fingerprint = source_fingerprint(source)
+
+        ids = [int(u[0]) for u in units]
+        unit_positions = {element_global_id: pos for pos, element_global_id in enumerate(ids)}
+        parents = [unit_positions.get(u[1], -1) if u[1] is not None else -1 for u in units]
+        levels = [u[2] for u in units]
+
+        places = {kind: dict() for kind in KINDS}
+
+        def add(kind, code, qualifiers, element_global_id):
+            pos = unit_positions.get(int(element_global_id))
+            if pos is not None and code is not None:
+                places[kind].setdefault(code, dict()).setdefault(qualifiers, set()).add(pos)
+
+        for element_global_id, nation, subnation, presence, confidence in rows.get("subnation", []):
+            add("subnation", f"{nation}-{subnation}", (presence, confidence), element_global_id)
+            add("nation", nation, (presence, confidence), element_global_id)
+        for element_global_id, ecoregion, occurrence in rows.get("ecoregion_2007", []):
+            add("ecoregion_2007", ecoregion, (occurrence,), element_global_id)
+        for element_global_id, nation, subnation, linkage in rows.get("crosswalk", []):
+            add("crosswalk", f"{nation}-{subnation}", (linkage,), element_global_id)
+
+        postings = {
+            kind: {
+                code: {q: _from_positions(p, len(ids)) for q, p in by_qualifiers.items()}
+                for code, by_qualifiers in codes.items()
+            }
+            for kind, codes in places.items()
+        }
+        return cls(ids, parents, levels, postings, ecoregion_parents, fingerprint)
+
+    def save(self, filename):
+        """
+        Writes the index to a JSON file, with the bitmaps as hexadecimal strings.
+        """
+        with open(filename, "w") as f:
+            json.dump({
+                "fingerprint": self.fingerprint,
+                "ids": self.ids,
+                "parents": self.parents,
+                "levels": self.levels,
+                "ecoregion_parents": self.ecoregion_parents,
+                "postings": {
+                    kind: {
+                        code: [list(q) + [format(bitmap, "x")] for q, bitmap in by_qualifiers.items()]
+                        for code, by_qualifiers in codes.items()
+                    }
+                    for kind, codes in self.postings.items()
+                }
+            }, f)
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Reads an index written by save.
+
+        :return: GeographicIndex
+        """
+        with open(filename, "r") as f:
+            data = json.load(f)
+        postings = {
+            kind: {
+                code: {tuple(entry[:-1]): int(entry[-1], 16) for entry in entries}
+                for code, entries in codes.items()
+            }
+            for kind, codes in data["postings"].items()
+        }
+        return cls(data["ids"], data["parents"], data["levels"], postings, data["ecoregion_parents"],
+                   data["fingerprint"])
+
+    def is_current(self, source_data_filename):
+        """
+        :return: True if the index was built from the source data as it is now
+        """
+        return self.fingerprint == source_fingerprint(source_data_filename)
+
+    def codes(self, kind):
+        """
+        :param kind: subnation, nation, ecoregion_2007 or crosswalk
+        :return: Sorted list of the place codes units occur in
+        """
+        return sorted(self.postings[kind])
+
+    def _subregions(self, code):
+        children = dict()
+        for child, parent in self.ecoregion_parents.items():
+            children.setdefault(parent, []).append(child)
+        found = {code}
+        stack = [code]
+        while len(stack) > 0:
+            for child in children.get(stack.pop(), []):
+                if child not in found:
+                    found.add(child)
+                    stack.append(child)
+        return found
+
+    def match(self, kind, code, subregions=False, **qualifiers):
+        """
+        Finds the units recorded in a place.
+
+        :param kind: subnation, nation, ecoregion_2007 or crosswalk
+        :param code: Place code, such as US-OR, US or M242
+        :param subregions: For ecoregions, also include the units recorded in the ecoregions within it
+        :param qualifiers: Values, or collections of values, to restrict the qualifiers of the kind to, such as
+        presence="P", confidence=["C", "P"], occurrence="C" or linkage="1 direct"; a collection can include None to
+        select rows with no code
+        :return: Bitmap of the units
+        """
+        if kind not in KINDS:
+            raise ValueError(f"kind must be one of {list(KINDS)}")
+        unknown = set(qualifiers) - set(KINDS[kind])
+        if len(unknown) > 0:
+            raise ValueError(f"{kind} places are qualified by {list(KINDS[kind])}, not {sorted(unknown)}")
+
+        codes = self._subregions(code) if subregions and kind == "ecoregion_2007" else {code}
+        bitmap = 0
+        for place_code in codes:
+            for qualifier_values, place_bitmap in self.postings[kind].get(place_code, dict()).items():
+                if all(_qualifier_matches(v, qualifiers.get(n)) for n, v in zip(KINDS[kind], qualifier_values)):
+                    bitmap |= place_bitmap
+        return bitmap
+
+    def roll_up(self, bitmap):
+        """
+        Adds the ancestors of every unit in a bitmap, so that a unit counts wherever any unit below it does.
+
+        :param bitmap: Bitmap of units
+        :return: Bitmap of the units and all of their ancestors
+        """
+        found = set()
+        for pos in positions(bitmap):
+            while pos >= 0 and pos not in found:
+                found.add(pos)
+                pos = self.parents[pos]
+        return _from_positions(found, len(self.ids))
+
+    def element_global_ids(self, bitmap, level=None):
+        """
+        :param bitmap: Bitmap of units
+        :param level: Optional hierarchyLevel to restrict the units to
+        :return: Sorted list of the element_global_id values of the units
+        """
+        if level is not None:
+            bitmap &= self.level_bitmaps.get(level, 0)
+        return [self.ids[pos] for pos in positions(bitmap)]
+
+    def units(self, places, combine="any", level=None, roll_up=False, subregions=False, **qualifiers):
+        """
+        Answers which units occur in any or all of a set of places.
+
+        :param places: List of (kind, code) tuples or "kind:code" strings, such as "subnation:US-OR"
+        :param combine: "any" for the union of the places or "all" for their intersection
+        :param level: Optional hierarchyLevel to restrict the units to
+        :param roll_up: Count a unit as occurring in a place when any unit below it does
+        :param subregions: For ecoregions, also include the units recorded in the ecoregions within each one
+        :param qualifiers: Qualifier values applied to each place of a kind that has them (see match)
+        :return: Sorted list of element_global_id values
+        """
+        if combine not in ("any", "all"):
+            raise ValueError("combine must be any or all")
+        unknown = set(qualifiers) - {n for names in KINDS.values() for n in names}
+        if len(unknown) > 0:
+            raise ValueError(f"Unknown qualifiers: {sorted(unknown)}")
+
+        bitmaps = list()
+        for kind, code in [parse_place(p) for p in places]:
+            kind_qualifiers = {n: v for n, v in qualifiers.items() if n in KINDS[kind]}
+            bitmap = self.match(kind, code, subregions, **kind_qualifiers)
+            bitmaps.append(self.roll_up(bitmap) if roll_up else bitmap)
+
+        if len(bitmaps) == 0:
+            return list()
+        result = bitmaps[0]
+        for bitmap in bitmaps[1:]:
+            result = result | bitmap if combine == "any" else result & bitmap
+        return self.element_global_ids(result, level)
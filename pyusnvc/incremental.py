@@ -0,0 +1,214 @@
+"""
+Incremental rebuilds between releases of the USNVC source data. A manifest records a content hash for every unit,
+computed over its Unit/UnitDescription row and all of its rows in the related tables, along with a hash of its
+hierarchy row and its parent. Comparing the manifest of a new source with the one saved from the previous build gives
+the units that were added, changed or deleted, and only those documents (plus the documents whose cached hierarchy
+includes a changed unit) need to be rebuilt.
+"""
+
+import hashlib
+import json
+
+from pyusnvc.usnvc import UsnvcSource, UnitTree, _HIERARCHY_COLUMNS, _grouped_query, _unit_queries, all_keys, \
+    build_units, logical_nvcs_root
+
+
+def _package_version():
+    from pyusnvc import __version__
+    return __version__
+
+
+def _digest(*parts):
+    h = hashlib.blake2b(digest_size=16)
+    for part in parts:
+        h.update(repr(part).encode("utf-8"))
+    return h.hexdigest()
+
+
+def build_manifest(source_data_filename, version_number):
+    """
+    Computes the content and hierarchy hashes of every unit in the source data.
+
+    :param source_data_filename: location of source data or a UsnvcSource
+    :param version_number: do some specific processing based on version
+    :return: Manifest dictionary with the version_number, package_version and a units dictionary keyed by
+    element_global_id (as a string) holding each unit's content hash, hierarchy hash and parent
+    """
+    with UsnvcSource(source_data_filename) as source:
+        ids = all_keys(source)
+
+        query_results = list()
+        for name, sql in sorted(_unit_queries(version_number).items()):
+            columns, groups = _grouped_query(source, sql, ids)
+            query_results.append((name, columns, groups))
+
+        cursor = source.execute(f"SELECT {_HIERARCHY_COLUMNS} FROM Unit")
+        hierarchy_columns = [col_desc[0] for col_desc in cursor.description]
+        hierarchy_rows = {row[0]: row for row in cursor.fetchall()}
+        cursor.close()
+
+    parent_column = hierarchy_columns.index("PARENT_ID")
+
+    units = dict()
+    for element_global_id in ids:
+        content_parts = list()
+        for name, columns, groups in query_results:
+            content_parts.extend([name, columns, groups.get(element_global_id, [])])
+        units[str(element_global_id)] = {
+            "content": _digest(*content_parts),
+            "hierarchy": _digest(hierarchy_columns, hierarchy_rows[element_global_id]),
+            "parent": hierarchy_rows[element_global_id][parent_column]
+        }
+
+    return {
+        "version_number": version_number,
+        "package_version": _package_version(),
+        "units": units
+    }
+
+
+def save_manifest(manifest, filename):
+    """
+    Saves a manifest as a JSON file.
+
+    :param manifest: Manifest dictionary from build_manifest
+    :param filename: File to write
+    """
+    with open(filename, "w") as f:
+        json.dump(manifest, f)
+
+
+def load_manifest(filename):
+    """
+    Loads a manifest saved with save_manifest.
+
+    :param filename: Manifest file
+    :return: Manifest dictionary
+    """
+    with open(filename, "r") as f:
+        return json.load(f)
+
+
+def _descendants(units, changed_ids):
+    """
+    Finds every descendant of a set of units from the parents recorded in a manifest.
+
+    :param units: units dictionary from a manifest
+    :param changed_ids: Set of element_global_id strings
+    :return: Set of element_global_id strings for descendants of the changed units
+    """
+    children = dict()
+    for element_global_id, unit in units.items():
+        if unit["parent"] is not None:
+            children.setdefault(str(unit["parent"]), []).append(element_global_id)
+
+    descendants = set()
+    stack = [c for i in changed_ids for c in children.get(i, [])]
+    while len(stack) > 0:
+        element_global_id = stack.pop()
+        if element_global_id not in descendants:
+            descendants.add(element_global_id)
+            stack.extend(children.get(element_global_id, []))
+    return descendants
+
+
+def plan_changes(previous_manifest, manifest):
+    """
+    Compares two manifests and works out which documents need to be added, rebuilt or deleted.
+
+    A unit's cached hierarchy holds its own hierarchy record, those of its immediate children and those of all its
+    ancestors. When a unit's hierarchy row changes, or the unit is added or removed, its parent (old and new) and all
+    of its descendants are rebuilt along with it. When Classes change, the logical root document (_id 0) is rebuilt.
+    Everything is rebuilt when there is no previous manifest or it was made for a different version number or
+    package version.
+
+    :param previous_manifest: Manifest from the previous build, or None
+    :param manifest: Manifest of the current source data
+    :return: Dictionary with add, update and delete lists of integer element_global_id values
+    """
+    units = manifest["units"]
+    previous_units = previous_manifest["units"] if previous_manifest is not None else dict()
+
+    added = set(units) - set(previous_units)
+    deleted = set(previous_units) - set(units)
+    kept = set(units) & set(previous_units)
+
+    if previous_manifest is None \
+            or previous_manifest["version_number"] != manifest["version_number"] \
+            or previous_manifest["package_version"] != manifest["package_version"]:
+        update = kept
+        root_changed = True
+    else:
+        changed = {i for i in kept if units[i]["content"] != previous_units[i]["content"]}
+        hierarchy_changed = added | deleted | {
+            i for i in changed if units[i]["hierarchy"] != previous_units[i]["hierarchy"]
+        }
+
+        affected = _descendants(units, hierarchy_changed) | _descendants(previous_units, hierarchy_changed)
+        root_changed = False
+        for element_global_id in hierarchy_changed:
+            for unit in [units.get(element_global_id), previous_units.get(element_global_id)]:
+                if unit is None:
+                    continue
+                if unit["parent"] is None:
+                    root_changed = True
+                else:
+                    affected.add(str(unit["parent"]))
+
+        update = (changed | affected) & kept
+
+    changes = {
+        "add": sorted(int(i) for i in added),
+        "update": sorted(int(i) for i in update),
+        "delete": sorted(int(i) for i in deleted)
+    }
+    if root_changed:
+        changes["add" if previous_manifest is None else "update"].insert(0, 0)
+
+    return changes
+
+
+def build_changes(source_data_filename, version_number, changes, batch_size=500):
+    """
+    Builds the documents for a set of planned changes.
+
+    :param source_data_filename: location of source data or a UsnvcSource
+    :param version_number: do some specific processing based on version
+    :param changes: Dictionary with add, update and delete lists as produced by plan_changes
+    :param batch_size: Number of units to fetch per round of queries
+    :return: Generator yielding dictionaries with the op (add, update or delete), the element_global_id and, except
+    for deletes, the rebuilt document
+    """
+    with UsnvcSource(source_data_filename) as source:
+        unit_tree = UnitTree.load(source)
+
+        for op in ["add", "update"]:
+            ids = changes[op]
+            if 0 in ids:
+                yield {"op": op, "element_global_id": 0, "document": logical_nvcs_root(source, unit_tree)}
+                ids = [i for i in ids if i != 0]
+            for document in build_units(ids, source, version_number, batch_size=batch_size, unit_tree=unit_tree):
+                yield {
+                    "op": op,
+                    "element_global_id": document["Identifiers"]["element_global_id"],
+                    "document": document
+                }
+
+    for element_global_id in changes["delete"]:
+        yield {"op": "delete", "element_global_id": element_global_id}
+
+
+def incremental_build(source_data_filename, version_number, previous_manifest=None, batch_size=500):
+    """
+    Plans and builds the changes since a previous build. The returned manifest should be saved once the changes
+    have been applied so that it can be used as the previous manifest for the next release.
+
+    :param source_data_filename: location of source data or a UsnvcSource
+    :param version_number: do some specific processing based on version
+    :param previous_manifest: Manifest saved from the previous build, or None to build everything
+    :param batch_size: Number of units to fetch per round of queries
+    :return: Tuple of the new manifest, the planned changes and a generator of changes as produced by build_changes
+    """
+    manifest = build_manifest(source_data_filename, version_number)
+    changes = plan_changes(previous_manifest, manifest)
+    return manifest, changes, build_changes(source_data_filename, version_number, changes, batch_size)
@@ -0,0 +1,298 @@
+"""
+Opt-in timing of the unit build. While an Instrumentation is active, the named unit queries record their wall time,
+row count and approximate size in bytes, and the build records the time spent on each section of the document
+(Distribution, Concept History, References, Hierarchy, the change log and so on) along with the batch level work
+of fetching data and reading the document cache. SQLite statements can also be traced. Everything is aggregated
+into histograms that can be exported as JSON or in the Prometheus text format at the end of a run.
+
+When nothing is active the build only checks a module global, so the instrumentation costs next to nothing when it
+is not wanted. Recording is per process: builds in the worker processes of the parallel module are not seen by an
+Instrumentation in the parent.
+"""
+
+import bisect
+import collections
+import contextlib
+import json
+import re
+import threading
+import time
+
+# Upper bounds in seconds of the histogram buckets
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Instrumentation recording in this process, or None
+_recorder = None
+
+
+def recorder():
+    """
+    :return: The active Instrumentation, or None when the build is not being instrumented
+    """
+    return _recorder
+
+
+def _row_bytes(row):
+    return sum(len(v) if isinstance(v, (str, bytes)) else 8 for v in row if v is not None)
+
+
+def _normalize_statement(statement):
+    """
+    Reduces a traced statement to its shape so that executions with different parameters are counted together.
+    """
+    statement = re.sub(r"\s+", " ", statement).strip()
+    statement = re.sub(r"'(?:[^']|'')*'", "?", statement)
+    statement = re.sub(r"\bIN \([^()]*\)", "IN (...)", statement, flags=re.IGNORECASE)
+    return re.sub(r"\b\d+(?:\.\d+)?\b", "?", statement)
+
+
+class _Histogram(object):
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.bucket_counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.seconds = 0
+        self.rows = 0
+        self.bytes = 0
+
+    def add(self, seconds, rows=0, size=0):
+        self.bucket_counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.seconds += seconds
+        self.rows += rows
+        self.bytes += size
+
+    def cumulative_counts(self):
+        counts = list()
+        total = 0
+        for count in self.bucket_counts:
+            total += count
+            counts.append(total)
+        return counts
+
+    def to_dict(self, measures_rows):
+        result = {
+            "count": self.count,
+            "seconds": self.seconds,
+            "mean_seconds": self.seconds / self.count if self.count > 0 else 0,
+            "buckets": {str(b): c for b, c in zip(list(self.buckets) + ["+Inf"], self.cumulative_counts())}
+        }
+        if measures_rows:
+            result["rows"] = self.rows
+            result["bytes"] = self.bytes
+        return result
+
+
+class _Sections(object):
+    """
+    Times consecutive stretches of code. Each call to lap charges the time since the previous lap to the named
+    section, and finish records the total for each section once.
+    """
+    def __init__(self, instrumentation):
+        self.instrumentation = instrumentation
+        self.seconds = dict()
+        self.last_time = time.perf_counter()
+
+    def lap(self, name):
+        now = time.perf_counter()
+        self.seconds[name] = self.seconds.get(name, 0) + now - self.last_time
+        self.last_time = now
+
+    def finish(self):
+        for name, seconds in self.seconds.items():
+            self.instrumentation.record_section(name, seconds)
+        self.seconds = dict()
+
+
+class _NoSections(object):
+    def lap(self, name):
+        pass
+
+    def finish(self):
+        pass
+
+
+_NO_SECTIONS = _NoSections()
+
+
+def sections():
+    """
+    :return: Section timer for the active Instrumentation, or one that does nothing when none is active
+    """
+    if _recorder is None:
+        return _NO_SECTIONS
+    return _Sections(_recorder)
+
+
+class Instrumentation(object):
+    """
+    Aggregates query, section and statement timings recorded during a build. Use it through instrument().
+    """
+    def __init__(self, trace=False, trace_limit=100, buckets=DEFAULT_BUCKETS):
+        """
+        :param trace: Trace the SQL statements SQLite executes, counted by the shape of the statement
+        :param trace_limit: Number of the most recent statements to keep in full
+        :param buckets: Upper bounds in seconds of the histogram buckets
+        """
+        self.trace = trace
+        self.buckets = tuple(buckets)
+        self.queries = dict()
+        self.sections = dict()
+        self.statements = collections.Counter()
+        self.recent_statements = collections.deque(maxlen=trace_limit)
+        self._traced_connections = list()
+        self._lock = threading.Lock()
+
+    def record_query(self, name, seconds, row_groups):
+        """
+        Records one execution of a named query.
+
+        :param name: Query name
+        :param seconds: Wall time taken
+        :param row_groups: Iterable of lists of the row tuples fetched
+        """
+        rows = 0
+        size = 0
+        for group in row_groups:
+            rows += len(group)
+            size += sum(_row_bytes(row) for row in group)
+        with self._lock:
+            if name not in self.queries:
+                self.queries[name] = _Histogram(self.buckets)
+            self.queries[name].add(seconds, rows, size)
+
+    def record_section(self, name, seconds):
+        """
+        Records the time spent on a named section of the build.
+
+        :param name: Section name
+        :param seconds: Wall time taken
+        """
+        with self._lock:
+            if name not in self.sections:
+                self.sections[name] = _Histogram(self.buckets)
+            self.sections[name].add(seconds)
+
+    @contextlib.contextmanager
+    def section(self, name):
+        """
+        Context manager recording the time spent in its body as a section.
+        """
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_section(name, time.perf_counter() - start_time)
+
+    def _trace_statement(self, statement):
+        with self._lock:
+            self.statements[_normalize_statement(statement)] += 1
+            self.recent_statements.append(statement)
+
+    def trace_connection(self, connection):
+        """
+        Starts tracing the statements run on a sqlite3 connection, if tracing is on and it is not traced already.
+        """
+        if not self.trace:
+            return
+        with self._lock:
+            if any(c is connection for c in self._traced_connections):
+                return
+            self._traced_connections.append(connection)
+        connection.set_trace_callback(self._trace_statement)
+
+    def stop_tracing(self):
+        with self._lock:
+            connections = self._traced_connections
+            self._traced_connections = list()
+        for connection in connections:
+            try:
+                connection.set_trace_callback(None)
+            except Exception:
+                # The connection was closed while it was traced
+                pass
+
+    def report(self):
+        """
+        :return: Dictionary with the histogram of each query (count, seconds, rows, bytes and cumulative bucket
+        counts keyed by upper bound), each section (the same without rows and bytes) and the traced statements
+        """
+        with self._lock:
+            return {
+                "queries": {n: h.to_dict(True) for n, h in sorted(self.queries.items())},
+                "sections": {n: h.to_dict(False) for n, h in sorted(self.sections.items())},
+                "statements": {
+                    "count": sum(self.statements.values()),
+                    "by_statement": dict(self.statements.most_common()),
+                    "recent": list(self.recent_statements)
+                }
+            }
+
+    def to_json(self, indent=2):
+        return json.dumps(self.report(), indent=indent)
+
+    def to_prometheus(self, prefix="pyusnvc"):
+        """
+        :param prefix: Prefix for the metric names
+        :return: Histograms in the Prometheus text exposition format
+        """
+        def label(value):
+            return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+        lines = list()
+        with self._lock:
+            for kind, histograms in [("query", self.queries), ("section", self.sections)]:
+                metric = f"{prefix}_{kind}_seconds"
+                lines.append(f"# HELP {metric} Wall time of each {kind} of the unit build")
+                lines.append(f"# TYPE {metric} histogram")
+                for name, histogram in sorted(histograms.items()):
+                    bounds = [repr(float(b)) for b in histogram.buckets] + ["+Inf"]
+                    for bound, count in zip(bounds, histogram.cumulative_counts()):
+                        lines.append(f'{metric}_bucket{{{kind}="{label(name)}",le="{bound}"}} {count}')
+                    lines.append(f'{metric}_sum{{{kind}="{label(name)}"}} {histogram.seconds!r}')
+                    lines.append(f'{metric}_count{{{kind}="{label(name)}"}} {histogram.count}')
+
+            for measure in ["rows", "bytes"]:
+                metric = f"{prefix}_query_{measure}_total"
+                lines.append(f"# HELP {metric} Total {measure} fetched by each query of the unit build")
+                lines.append(f"# TYPE {metric} counter")
+                for name, histogram in sorted(self.queries.items()):
+                    lines.append(f'{metric}{{query="{label(name)}"}} {getattr(histogram, measure)}')
+
+            if self.trace:
+                metric = f"{prefix}_sqlite_statements_total"
+                lines.append(f"# HELP {metric} SQLite statements executed")
+                lines.append(f"# TYPE {metric} counter")
+                lines.append(f"{metric} {sum(self.statements.values())}")
+
+        return "\n".join(lines) + "\n"
+
+    def save(self, filename):
+        """
+        Writes the report in the Prometheus text format when the filename ends in .prom, or as JSON otherwise.
+        """
+        with open(filename, "w") as f:
+            if str(filename).endswith(".prom"):
+                f.write(self.to_prometheus())
+            else:
+                f.write(self.to_json())
+
+
+@contextlib.contextmanager
+def instrument(trace=False, trace_limit=100, buckets=DEFAULT_BUCKETS):
+    """
+    Records query and section timings for the builds run in its body.
+
+    :param trace: Trace the SQL statements SQLite executes
+    :param trace_limit: Number of the most recent statements to keep in full
+    :param buckets: Upper bounds in seconds of the histogram buckets
+    :return: Context manager yielding the Instrumentation
+    """
+    global _recorder
+    previous = _recorder
+    _recorder = Instrumentation(trace, trace_limit, buckets)
+    try:
+        yield _recorder
+    finally:
+        _recorder.stop_tracing()
+        _recorder = previous
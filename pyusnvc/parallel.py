@@ -0,0 +1,200 @@
+"""
+Multi-processing driver for building USNVC unit documents. Each worker process opens its own UsnvcSource and loads
+the UnitTree once when it starts, then builds chunks of units with the batched build_units process. Chunks are sized
+by the estimated cost of the units in them rather than by a fixed count, so that workers finish at about the same
+time even though units vary widely in how much related data they carry. The lookup tables and country names are
+loaded in the parent before the pool starts, so forked workers share them rather than each loading their own.
+"""
+
+import multiprocessing
+import multiprocessing.util
+
+from pyusnvc.usnvc import UsnvcSource, UnitTree, build_units, lookup_cache, merge_schemas, preload_country_names, \
+    unit_costs, update_schema
+
+# Per-process state set up by _init_worker
+_worker_source = None
+_worker_tree = None
+_worker_version = None
+_worker_validator = None
+
+
+def _init_worker(source_data_filename, version_number, schema=None, max_examples=5):
+    """
+    Pool initializer that opens the worker's source connection and loads the hierarchy once per process.
+
+    :param source_data_filename: location of source data
+    :param version_number: do some specific processing based on version
+    :param schema: Optional JSON Schema to compile a validation.DocumentValidator from for validation chunks
+    :param max_examples: Maximum number of example element_global_id values the validator keeps per path
+    """
+    global _worker_source, _worker_tree, _worker_version, _worker_validator
+
+    _worker_source = UsnvcSource(source_data_filename)
+    _worker_tree = UnitTree.load(_worker_source)
+    _worker_version = version_number
+    # Already loaded when the worker was forked; loaded here when workers are spawned
+    lookup_cache(_worker_source)
+    if schema is not None:
+        from pyusnvc.validation import DocumentValidator
+        _worker_validator = DocumentValidator(schema, max_examples)
+
+    multiprocessing.util.Finalize(None, _worker_source.close, exitpriority=10)
+
+
+def _build_chunk(chunk):
+    """
+    Builds a chunk of units in a worker process.
+
+    :param chunk: List of integer element_global_id values
+    :return: List of unit documents in the order of the chunk
+    """
+    return list(build_units(chunk, _worker_source, _worker_version, batch_size=len(chunk), unit_tree=_worker_tree))
+
+
+def cost_chunks(ids, costs, target_cost):
+    """
+    Splits a list of ids into consecutive chunks whose estimated costs add up to about the target cost.
+
+    :param ids: List of integer element_global_id values
+    :param costs: Dictionary of element_global_id to estimated cost, as produced by unit_costs
+    :param target_cost: Estimated cost to aim for in each chunk
+    :return: List of (chunk cost, list of ids) tuples in the order of the ids
+    """
+    chunks = list()
+    chunk = list()
+    chunk_cost = 0
+    for element_global_id in ids:
+        chunk.append(element_global_id)
+        chunk_cost += costs.get(int(element_global_id), 1)
+        if chunk_cost >= target_cost:
+            chunks.append((chunk_cost, chunk))
+            chunk = list()
+            chunk_cost = 0
+    if len(chunk) > 0:
+        chunks.append((chunk_cost, chunk))
+    return chunks
+
+
+def _map_chunks(function, ids, source_data_filename, version_number, workers=None, chunksize=None, ordered=True,
+                chunks_per_worker=4, initargs=()):
+    """
+    Splits units into cost-balanced chunks and runs a chunk function on them across a pool of worker processes.
+
+    :param function: Module-level function taking a list of ids, run in the worker processes
+    :param initargs: Further arguments for _init_worker
+    :return: Generator yielding the result of the function for each chunk
+    """
+    if isinstance(source_data_filename, UsnvcSource):
+        source_data_filename = source_data_filename.source_data_filename
+
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+
+    costs = unit_costs(source_data_filename)
+    if ids is None:
+        ids = list(costs.keys())
+    else:
+        ids = list(ids)
+
+    if len(ids) == 0:
+        return
+
+    total_cost = sum(costs.get(int(i), 1) for i in ids)
+    if chunksize is not None:
+        target_cost = total_cost / len(ids) * chunksize
+    else:
+        target_cost = total_cost / (workers * chunks_per_worker)
+
+    chunks = cost_chunks(ids, costs, max(target_cost, 1))
+    if not ordered:
+        chunks.sort(key=lambda c: c[0], reverse=True)
+
+    lookup_cache(source_data_filename)
+    preload_country_names()
+
+    with multiprocessing.Pool(workers, initializer=_init_worker,
+                              initargs=(source_data_filename, version_number) + tuple(initargs)) as pool:
+        if ordered:
+            yield from pool.imap(function, [c[1] for c in chunks])
+        else:
+            yield from pool.imap_unordered(function, [c[1] for c in chunks])
+
+
+def build_units_parallel(ids, source_data_filename, version_number, workers=None, chunksize=None, ordered=True,
+                         chunks_per_worker=4):
+    """
+    Builds unit documents across a pool of worker processes.
+
+    :param ids: List of integer element_global_id values to build, or None to build every unit
+    :param source_data_filename: location of source data or a UsnvcSource
+    :param version_number: do some specific processing based on version
+    :param workers: Number of worker processes; defaults to the number of CPUs
+    :param chunksize: Average number of units per chunk sent to a worker; by default the work is split into about
+    chunks_per_worker chunks for each worker
+    :param ordered: If True, documents are yielded in the order of the ids. If False, they are yielded as soon as each
+    chunk finishes and the most expensive chunks are sent out first.
+    :param chunks_per_worker: Used to size chunks when chunksize is not given
+    :return: Generator yielding unit documents
+    """
+    for docs in _map_chunks(_build_chunk, ids, source_data_filename, version_number, workers, chunksize, ordered,
+                            chunks_per_worker):
+        yield from docs
+
+
+def _schema_chunk(chunk):
+    """
+    Infers a partial JSON Schema for a chunk of units in a worker process.
+
+    :param chunk: List of integer element_global_id values
+    :return: JSON Schema dictionary covering the chunk's documents
+    """
+    return update_schema(None, _build_chunk(chunk))
+
+
+def build_schema_parallel(ids, source_data_filename, version_number, workers=None, chunks_per_worker=4):
+    """
+    Infers the JSON Schema of unit documents across a pool of worker processes. Each worker builds a partial schema
+    for its chunks and the partial schemas are merged in the order of the ids, giving the same schema as adding every
+    document to a single builder.
+
+    :param ids: List of integer element_global_id values to include, or None to include every unit
+    :param source_data_filename: location of source data or a UsnvcSource
+    :param version_number: do some specific processing based on version
+    :param workers: Number of worker processes; defaults to the number of CPUs
+    :param chunks_per_worker: Number of chunks to split the work into for each worker
+    :return: JSON Schema dictionary
+    """
+    return merge_schemas(_map_chunks(_schema_chunk, ids, source_data_filename, version_number, workers,
+                                     chunks_per_worker=chunks_per_worker))
+
+
+def _validate_chunk(chunk):
+    """
+    Builds and validates a chunk of units in a worker process.
+
+    :param chunk: List of integer element_global_id values
+    :return: Validation report for the chunk
+    """
+    return _worker_validator.check(_build_chunk(chunk))
+
+
+def validate_units_parallel(ids, source_data_filename, version_number, schema, workers=None, max_examples=5,
+                            chunks_per_worker=4):
+    """
+    Builds and validates unit documents across a pool of worker processes, each of which compiles the schema once.
+
+    :param ids: List of integer element_global_id values to validate, or None to validate every unit
+    :param source_data_filename: location of source data or a UsnvcSource
+    :param version_number: do some specific processing based on version
+    :param schema: JSON Schema dictionary
+    :param workers: Number of worker processes; defaults to the number of CPUs
+    :param max_examples: Maximum number of example element_global_id values to keep per path
+    :param chunks_per_worker: Number of chunks to split the work into for each worker
+    :return: Validation report as described in validation.DocumentValidator.check
+    """
+    from pyusnvc.validation import merge_reports
+
+    return merge_reports(_map_chunks(_validate_chunk, ids, source_data_filename, version_number, workers,
+                                     ordered=False, chunks_per_worker=chunks_per_worker,
+                                     initargs=(schema, max_examples)), max_examples)
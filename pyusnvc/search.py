@@ -0,0 +1,223 @@
+"""
+Full-text search over the narrative fields of the unit documents. The names, type concept, diagnostic
+characteristics, floristics, environmental description and synonymy of each built document are indexed in a SQLite
+FTS5 table, ranked with BM25 using a weight for each field, and can be filtered by hierarchy level. The index keeps
+the manifest of the source it was last built from (see the incremental module), so refreshing it after a new release
+of the source data only rebuilds and re-indexes the units that changed.
+"""
+
+import html
+import json
+import re
+import sqlite3
+import threading
+
+from pyusnvc.incremental import incremental_build
+
+# Indexed columns, with their BM25 weight and the function taking their text from a unit document
+SEARCH_COLUMNS = [
+    ("title", 10.0, lambda d: [d.get("title")]),
+    ("names", 8.0, lambda d: [
+        d["Overview"].get("Scientific Name"),
+        d["Overview"].get("Translated Name"),
+        d["Identifiers"].get("Database Code"),
+        d["Identifiers"].get("Classification Code")
+    ] + [r.get("colloquialName") for r in d["Hierarchy"]["Cached Hierarchy"][:1]]),
+    ("type_concept", 4.0, lambda d: [d["Overview"].get("Type Concept Sentence"), d["Overview"].get("Type Concept")]),
+    ("diagnostic_characteristics", 3.0, lambda d: [d["Overview"].get("Diagnostic Characteristics")]),
+    ("floristics", 2.0, lambda d: [d["Vegetation"].get("Floristics")]),
+    ("environment", 2.0, lambda d: [d["Environment"].get("Environmental Description")]),
+    ("synonymy", 2.0, lambda d: [d["Synonymy"].get("Synonymy")] + [
+        p.get(k) for p in d["Concept History"].get("Predecessors Raw Data", [])
+        for k in ("predecessorname", "predecessorsciname", "predecessorcolloquialname")
+    ])
+]
+
+# Stemmed, case and accent insensitive tokens
+TOKENIZER = "porter unicode61 remove_diacritics 2"
+
+
+def _plain_text(values):
+    """
+    Joins the text of a field, with the markup and entities the source data carries taken out.
+    """
+    text = " ".join(str(v) for v in values if v is not None)
+    return re.sub(r"\s+", " ", re.sub(r"<[^>]*>", " ", html.unescape(text))).strip()
+
+
+def match_expression(query):
+    """
+    Turns free text into an FTS5 query matching documents that contain every word, with the last word matched as a
+    prefix so that partial words typed into a search box find results.
+
+    :param query: Free text
+    :return: FTS5 MATCH expression, or None when the text has no words
+    """
+    terms = re.findall(r"\w+", query)
+    if len(terms) == 0:
+        return None
+    return " ".join(f'"{t}"' for t in terms) + "*"
+
+
+class SearchIndex(object):
+    """
+    FTS5 index of unit documents in a SQLite file, keyed by element_global_id.
+    """
+    def __init__(self, index_filename):
+        """
+        :param index_filename: SQLite file to keep the index in; created if it does not exist
+        """
+        self.index_filename = index_filename
+        self._lock = threading.Lock()
+
+        self.db = sqlite3.connect(index_filename, timeout=30, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        columns = ", ".join(name for name, _, _ in SEARCH_COLUMNS)
+        self.db.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS unit_search USING fts5({columns}, tokenize='{TOKENIZER}')")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS unit_levels (element_global_id INTEGER PRIMARY KEY, hierarchy_level TEXT)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS unit_levels_level ON unit_levels (hierarchy_level)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS search_meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.db.commit()
+
+    def __len__(self):
+        with self._lock:
+            return self.db.execute("SELECT COUNT(*) FROM unit_levels").fetchone()[0]
+
+    def add_documents(self, documents):
+        """
+        Indexes unit documents, replacing any earlier entries for the same units. The logical root document is
+        skipped.
+
+        :param documents: Iterable of unit documents, such as the output of build_units or export.read_export
+        :return: Number of documents indexed
+        """
+        search_rows = list()
+        level_rows = list()
+        for document in documents:
+            if "Identifiers" not in document:
+                continue
+            element_global_id = int(document["Identifiers"]["element_global_id"])
+            search_rows.append([element_global_id] + [_plain_text(f(document)) for _, _, f in SEARCH_COLUMNS])
+            level_rows.append((element_global_id, document["Hierarchy"].get("hierarchyLevel")))
+
+        with self._lock:
+            self._delete([r[0] for r in level_rows])
+            placeholders = ", ".join("?" * (len(SEARCH_COLUMNS) + 1))
+            columns = ", ".join(name for name, _, _ in SEARCH_COLUMNS)
+            self.db.executemany(f"INSERT INTO unit_search (rowid, {columns}) VALUES ({placeholders})", search_rows)
+            self.db.executemany("INSERT INTO unit_levels VALUES (?, ?)", level_rows)
+            self.db.commit()
+        return len(level_rows)
+
+    def _delete(self, ids):
+        rows = [(int(i),) for i in ids]
+        self.db.executemany("DELETE FROM unit_search WHERE rowid = ?", rows)
+        self.db.executemany("DELETE FROM unit_levels WHERE element_global_id = ?", rows)
+
+    def delete(self, ids):
+        """
+        Removes units from the index.
+
+        :param ids: List of integer element_global_id values
+        """
+        with self._lock:
+            self._delete(ids)
+            self.db.commit()
+
+    def clear(self):
+        """
+        Removes every unit and the saved manifest.
+        """
+        with self._lock:
+            self.db.execute("DELETE FROM unit_search")
+            self.db.execute("DELETE FROM unit_levels")
+            self.db.execute("DELETE FROM search_meta")
+            self.db.commit()
+
+    def manifest(self):
+        """
+        :return: Manifest of the source the index was last refreshed from, or None
+        """
+        with self._lock:
+            row = self.db.execute("SELECT value FROM search_meta WHERE key = 'manifest'").fetchone()
+        return json.loads(row[0]) if row is not None else None
+
+    def refresh(self, source_data_filename, version_number, batch_size=500, full=False):
+        """
+        Brings the index up to date with the source data. Units that were added or changed since the manifest
+        saved in the index are built and re-indexed, and deleted units are removed, as planned by
+        incremental.plan_changes. Everything is indexed when there is no saved manifest or full is set.
+
+        :param source_data_filename: location of source data or a UsnvcSource
+        :param version_number: do some specific processing based on version
+        :param batch_size: Number of units to fetch per round of queries
+        :param full: Clear the index and index every unit
+        :return: Dictionary with the add, update and delete lists of element_global_id values that were applied
+        """
+        if full:
+            self.clear()
+        manifest, changes, built_changes = incremental_build(source_data_filename, version_number, self.manifest(),
+                                                             batch_size)
+
+        batch = list()
+        for change in built_changes:
+            if change["op"] == "delete":
+                self.delete([change["element_global_id"]])
+                continue
+            batch.append(change["document"])
+            if len(batch) >= batch_size:
+                self.add_documents(batch)
+                batch = list()
+        self.add_documents(batch)
+
+        with self._lock:
+            self.db.execute("INSERT OR REPLACE INTO search_meta VALUES ('manifest', ?)", [json.dumps(manifest)])
+            self.db.commit()
+        return changes
+
+    def search(self, query, level=None, limit=20, raw=False, snippet_tokens=16):
+        """
+        Finds the units best matching a query, ranked by BM25 with the title and names weighted above the
+        narrative fields.
+
+        :param query: Words to search for, all of which must appear; the last may be the start of a word
+        :param level: Optional hierarchyLevel, such as Alliance or Association, to restrict the results to
+        :param limit: Maximum number of results
+        :param raw: Pass the query to FTS5 as it is, so that its syntax (OR, NOT, NEAR, phrases, column filters) can
+        be used
+        :param snippet_tokens: Number of tokens in each snippet
+        :return: List of dictionaries with the element_global_id, title, hierarchyLevel, a snippet of the best
+        matching field with the matched words in <b> tags, and the score (lower is better)
+        """
+        expression = query if raw else match_expression(query)
+        if expression is None:
+            return list()
+
+        weights = ", ".join(str(w) for _, w, _ in SEARCH_COLUMNS)
+        sql = f"SELECT unit_search.rowid, title, hierarchy_level,\
+            snippet(unit_search, -1, '<b>', '</b>', '...', {int(snippet_tokens)}), bm25(unit_search, {weights}) AS score\
+            FROM unit_search JOIN unit_levels ON unit_levels.element_global_id = unit_search.rowid\
+            WHERE unit_search MATCH ?"
+        parameters = [expression]
+        if level is not None:
+            sql += " AND unit_levels.hierarchy_level = ?"
+            parameters.append(level)
+        sql += " ORDER BY score LIMIT ?"
+        parameters.append(int(limit))
+
+        with self._lock:
+            rows = self.db.execute(sql, parameters).fetchall()
+        return [
+            {"element_global_id": r[0], "title": r[1], "hierarchyLevel": r[2], "snippet": r[3], "score": r[4]}
+            for r in rows
+        ]
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
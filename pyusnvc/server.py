@@ -0,0 +1,373 @@
+"""
+Read-only HTTP server for unit documents, so that the distribution can be served locally without loading it into a
+document database first. Documents are read from an export file written by the export module, or built on demand
+from the source data through a fixed pool of threads that each keep one read-only connection open.
+
+Routes:
+
+* /units/<element_global_id> - the unit document; 0 is the logical root document
+* /units/<element_global_id>/children - element_global_id and title of each immediate child
+* /units/<element_global_id>/ancestors - element_global_id and title of each ancestor, from the parent up to the
+  logical root
+* /root - the logical root document
+* /status - the number of units and the fingerprint the entity tags are derived from
+
+Response bodies are kept in an in-process LRU cache along with their gzip compressed form, which is sent to clients
+that accept it. Every response carries an entity tag derived from the fingerprint of the file it was served from
+(and the version number and package version when documents are built), so clients and proxies can revalidate with
+If-None-Match and are sent 304 Not Modified until the data changes. The tags are weak because built documents carry
+the time they were processed and the gzip and plain forms share a tag.
+"""
+
+import collections
+import gzip
+import hashlib
+import json
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from pyusnvc.cache import source_fingerprint
+from pyusnvc.export import dumps, read_export
+from pyusnvc.usnvc import UnitTree, UsnvcSource, build_unit, logical_nvcs_root, lookup_cache, \
+    preload_country_names
+
+# Bodies smaller than this are sent uncompressed, since gzip gains little on them
+GZIP_MIN_BYTES = 1024
+
+_ROUTE = re.compile(r"^/units/(?P<id>[^/]+)(?:/(?P<listing>children|ancestors))?/?$")
+
+
+def _document_id(document):
+    if "Identifiers" in document:
+        return int(document["Identifiers"]["element_global_id"])
+    return int(document["_id"])
+
+
+class ExportDocuments(object):
+    """
+    Serves the documents of an export file. Every document is read once when the file is loaded and kept as its
+    serialized line, along with the parent, children and title needed for the listings.
+    """
+    def __init__(self, export_filename, compression=None):
+        """
+        :param export_filename: File written by export.export_units
+        :param compression: "gzip", "zstd", "none" or None to infer from the filename extension
+        """
+        self.export_filename = export_filename
+        self.fingerprint = source_fingerprint(export_filename)
+
+        self.documents = dict()
+        self.parents = dict()
+        self.child_ids = dict()
+        self.ancestor_ids = dict()
+        self.titles = dict()
+        for document in read_export(export_filename, compression):
+            element_global_id = _document_id(document)
+            self.documents[element_global_id] = dumps(document).encode("utf-8")
+            self.parents[element_global_id] = document.get("parent")
+            self.child_ids[element_global_id] = list(document.get("children") or [])
+            self.ancestor_ids[element_global_id] = [a for a in document.get("ancestors") or [] if a != 0]
+            self.titles[element_global_id] = document.get("title")
+
+        if 0 not in self.documents:
+            # Exported with include_root=False
+            root = logical_nvcs_root(None, unit_tree=self)
+            self.documents[0] = dumps(root).encode("utf-8")
+            self.parents[0] = None
+            self.child_ids[0] = root["children"]
+            self.ancestor_ids[0] = list()
+            self.titles[0] = root["title"]
+
+    def __len__(self):
+        return len(self.documents)
+
+    def __contains__(self, element_global_id):
+        return element_global_id in self.documents
+
+    def roots(self):
+        """
+        :return: List of element_global_id values for units with no parent (the Classes)
+        """
+        return [i for i, parent in self.parents.items() if parent in (None, 0) and i != 0]
+
+    def document(self, element_global_id):
+        """
+        :return: Serialized document
+        """
+        return self.documents[element_global_id]
+
+    def children(self, element_global_id):
+        return self.child_ids[element_global_id]
+
+    def ancestors(self, element_global_id):
+        if element_global_id == 0:
+            return list()
+        return self.ancestor_ids[element_global_id] + [0]
+
+    def title(self, element_global_id):
+        return self.titles[element_global_id]
+
+    def close(self):
+        pass
+
+
+class SourceDocuments(object):
+    """
+    Builds documents on demand from the source data. The hierarchy is loaded into a UnitTree once, and documents
+    are built on a fixed pool of threads so that the number of open connections stays at the pool size however many
+    requests are being handled.
+    """
+    def __init__(self, source_data_filename, version_number, workers=4, cache=None):
+        """
+        :param source_data_filename: location of source data or a UsnvcSource
+        :param version_number: do some specific processing based on version
+        :param workers: Number of threads, and so connections, to build documents with
+        :param cache: Optional cache.DocumentCache to read documents from and store them in
+        """
+        from pyusnvc import __version__
+
+        self.source = UsnvcSource(source_data_filename)
+        self.version_number = version_number
+        self.cache = cache
+        self.fingerprint = hashlib.blake2b(
+            f"{source_fingerprint(self.source)}|{version_number}|{__version__}".encode("utf-8"), digest_size=16
+        ).hexdigest()
+
+        self.unit_tree = UnitTree.load(self.source)
+        self.root = dumps(logical_nvcs_root(self.source, self.unit_tree)).encode("utf-8")
+
+        # Loaded up front rather than by whichever request thread gets to them first
+        lookup_cache(self.source)
+        preload_country_names()
+
+        self._executor = ThreadPoolExecutor(workers, thread_name_prefix="pyusnvc-build")
+
+    def __len__(self):
+        return len(self.unit_tree) + 1
+
+    def __contains__(self, element_global_id):
+        return element_global_id == 0 or element_global_id in self.unit_tree
+
+    def _build(self, element_global_id):
+        document = build_unit(element_global_id, self.source, self.version_number, unit_tree=self.unit_tree,
+                              cache=self.cache, change_log_level="off")
+        return dumps(document).encode("utf-8")
+
+    def document(self, element_global_id):
+        """
+        :return: Serialized document
+        """
+        if element_global_id == 0:
+            return self.root
+        return self._executor.submit(self._build, element_global_id).result()
+
+    def children(self, element_global_id):
+        if element_global_id == 0:
+            return self.unit_tree.roots()
+        return self.unit_tree.children(element_global_id)
+
+    def ancestors(self, element_global_id):
+        if element_global_id == 0:
+            return list()
+        return self.unit_tree.ancestors(element_global_id) + [0]
+
+    def title(self, element_global_id):
+        if element_global_id == 0:
+            return "US National Vegetation Classification"
+        return self.unit_tree.display_title(element_global_id)
+
+    def close(self):
+        self._executor.shutdown()
+        self.source.close()
+
+
+class ResponseCache(object):
+    """
+    Least recently used cache of response bodies and their gzip compressed form, bounded by the number of entries.
+    """
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, key, produce):
+        """
+        :param key: Resource key
+        :param produce: Function returning the body when it is not cached
+        :return: Tuple of the body and its gzip compressed form, or None when it is too small to be worth compressing
+        """
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            self.misses += 1
+
+        body = produce()
+        entry = (body, gzip.compress(body, compresslevel=6) if len(body) >= GZIP_MIN_BYTES else None)
+        if self.max_entries > 0:
+            with self._lock:
+                self.entries[key] = entry
+                self.entries.move_to_end(key)
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+        return entry
+
+
+def _accepts_gzip(accept_encoding):
+    for coding in (accept_encoding or "").split(","):
+        name, _, parameters = coding.strip().partition(";")
+        if name.strip().lower() in ("gzip", "*"):
+            q = parameters.strip()
+            if q.startswith("q="):
+                try:
+                    return float(q[2:]) > 0
+                except ValueError:
+                    return False
+            return True
+    return False
+
+
+def _matches_etag(if_none_match, etag):
+    if if_none_match is None:
+        return False
+    tags = [t.strip() for t in if_none_match.split(",")]
+    return "*" in tags or any(t.replace("W/", "", 1) == etag.replace("W/", "", 1) for t in tags)
+
+
+class _RequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "pyusnvc"
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+    def _send(self, status, body=None, etag=None, compressed=None):
+        use_gzip = compressed is not None and _accepts_gzip(self.headers.get("Accept-Encoding"))
+        if use_gzip:
+            body = compressed
+        self.send_response(status)
+        if etag is not None:
+            self.send_header("ETag", etag)
+            self.send_header("Cache-Control", "no-cache")
+            self.send_header("Vary", "Accept-Encoding")
+        if body is not None:
+            self.send_header("Content-Type", "application/json")
+            if use_gzip:
+                self.send_header("Content-Encoding", "gzip")
+        self.send_header("Content-Length", str(len(body) if body is not None else 0))
+        self.end_headers()
+        if body is not None and self.command != "HEAD":
+            self.wfile.write(body)
+
+    def _send_error(self, status, message):
+        self._send(status, json.dumps({"error": message}).encode("utf-8"))
+
+    def _resource(self, path):
+        """
+        :return: Tuple of the cache key and a function producing the body, or None when the path is not a resource
+        """
+        store = self.server.store
+        if path == "/status":
+            return None, lambda: json.dumps({"units": len(store), "fingerprint": store.fingerprint}).encode("utf-8")
+        if path in ("/root", "/root/"):
+            path = "/units/0"
+
+        match = _ROUTE.match(path)
+        if match is None:
+            raise LookupError(f"No such resource: {path}")
+        try:
+            element_global_id = int(match.group("id"))
+        except ValueError:
+            raise ValueError(f"element_global_id must be an integer, not {match.group('id')}")
+        if element_global_id not in store:
+            raise LookupError(f"No unit with element_global_id {element_global_id}")
+
+        listing = match.group("listing")
+        if listing is None:
+            return str(element_global_id), lambda: store.document(element_global_id)
+
+        def produce():
+            ids = getattr(store, listing)(element_global_id)
+            return json.dumps([{"element_global_id": i, "title": store.title(i)} for i in ids]).encode("utf-8")
+        return f"{element_global_id}-{listing}", produce
+
+    def do_GET(self):
+        try:
+            key, produce = self._resource(self.path.split("?", 1)[0])
+        except ValueError as e:
+            return self._send_error(400, str(e))
+        except LookupError as e:
+            return self._send_error(404, str(e))
+
+        if key is None:
+            return self._send(200, produce())
+
+        etag = f'W/"{self.server.store.fingerprint[:16]}-{key}"'
+        if _matches_etag(self.headers.get("If-None-Match"), etag):
+            return self._send(304, etag=etag)
+
+        try:
+            body, compressed = self.server.response_cache.get(key, produce)
+        except Exception as e:
+            self.log_error("Could not produce %s: %r", self.path, e)
+            return self._send_error(500, f"Could not produce {self.path}")
+        self._send(200, body, etag, compressed)
+
+    do_HEAD = do_GET
+
+
+class DocumentServer(ThreadingHTTPServer):
+    """
+    Threaded HTTP server serving the documents of an ExportDocuments or SourceDocuments store.
+    """
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, server_address, store, cache_size=1000, quiet=False):
+        """
+        :param server_address: Tuple of the host and port to listen on; port 0 picks a free port
+        :param store: ExportDocuments or SourceDocuments
+        :param cache_size: Number of response bodies to keep in the LRU cache
+        :param quiet: Leave out the log line for each request
+        """
+        self.store = store
+        self.response_cache = ResponseCache(cache_size)
+        self.quiet = quiet
+        super().__init__(server_address, _RequestHandler)
+
+    def server_close(self):
+        super().server_close()
+        self.store.close()
+
+
+def make_server(host="127.0.0.1", port=8080, export_filename=None, source_data_filename=None, version_number=2.03,
+                workers=4, cache_size=1000, document_cache=None, quiet=False):
+    """
+    Sets up a server for an export file or for documents built on demand from the source data. Call serve_forever
+    on the result to handle requests and server_close to shut it down.
+
+    :param host: Address to listen on
+    :param port: Port to listen on; 0 picks a free port
+    :param export_filename: Export file to serve the documents of
+    :param source_data_filename: location of source data to build documents from when there is no export file
+    :param version_number: do some specific processing based on version, when building documents
+    :param workers: Number of threads, and so connections, to build documents with
+    :param cache_size: Number of response bodies to keep in the LRU cache
+    :param document_cache: Optional cache.DocumentCache to read built documents from and store them in
+    :param quiet: Leave out the log line for each request
+    :return: DocumentServer
+    """
+    if (export_filename is None) == (source_data_filename is None):
+        raise ValueError("Either an export file or the source data must be given")
+    if export_filename is not None:
+        store = ExportDocuments(export_filename)
+    else:
+        store = SourceDocuments(source_data_filename, version_number, workers, document_cache)
+    return DocumentServer((host, port), store, cache_size, quiet)
@@ -0,0 +1,243 @@
+"""
+Generates synthetic USNVC source databases for benchmarking and trying out the build without downloading the real
+source data from ScienceBase. The database has the same tables and columns the unit queries read (Unit,
+UnitDescription, the lookup tables, UnitXSubnation, the ecoregion tables, the concept history tables, references
+and crosswalks) filled with random but repeatable values. The number of units, the depth and fan-out of the
+hierarchy and the number of related rows per unit can all be set, so that the build can be timed at the size of
+the current release and of bigger ones.
+"""
+
+import os
+import random
+import sqlite3
+
+import pycountry
+
+LEVELS = ["Class", "Subclass", "Formation", "Division", "Macrogroup", "Group", "Alliance", "Association"]
+
+SCHEMA = """
+CREATE TABLE Unit (element_global_id INTEGER PRIMARY KEY, PARENT_ID INTEGER, hierarchyLevel TEXT,
+    D_CLASSIFICATION_LEVEL_ID INTEGER, classificationCode TEXT, databaseCode TEXT, scientificName TEXT,
+    formattedScientificName TEXT, translatedName TEXT, colloquialName TEXT, unitSort TEXT, parentKey TEXT,
+    parentName TEXT);
+CREATE TABLE UnitDescription (ELEMENT_GLOBAL_ID INTEGER, classif_confidence_id INTEGER, typeConceptSentence TEXT,
+    typeConcept TEXT, diagnosticCharacteristics TEXT, Rationale TEXT, classificationComments TEXT,
+    otherComments TEXT, similarNVCtypesComments TEXT, Physiognomy TEXT, Floristics TEXT, Dynamics TEXT,
+    Environment TEXT, spatialPattern TEXT, Range TEXT, Nations TEXT, Subnations TEXT, tncEcoregions TEXT,
+    omernikEcoregions TEXT, federalLands TEXT, plotCount INTEGER, plotSummary TEXT, plotTypal TEXT,
+    plotArchived TEXT, plotConsistency TEXT, plotSize TEXT, plotMethods TEXT, confidenceComments TEXT, grank TEXT,
+    grankReviewDate TEXT, grankAuthor TEXT, grankReasons TEXT, lineage TEXT, Synonymy TEXT,
+    primaryConceptSource TEXT, descriptionAuthor TEXT, Acknowledgements TEXT, versionDate TEXT);
+CREATE TABLE d_classif_confidence (D_CLASSIF_CONFIDENCE_ID INTEGER, CLASSIF_CONFIDENCE_DESC TEXT);
+CREATE TABLE UnitXSimilarUnit (ELEMENT_GLOBAL_ID INTEGER, simGLOBAL_ID INTEGER, simNote TEXT, simElcode TEXT,
+    simName TEXT, simUSstatus TEXT, simLevelId INTEGER);
+CREATE TABLE d_curr_presence_absence (d_curr_presence_absence_id INTEGER, curr_presence_absence_cd TEXT,
+    curr_presence_absence_desc TEXT);
+CREATE TABLE d_dist_confidence (d_dist_confidence_id INTEGER, dist_confidence_cd TEXT, dist_confidence_desc TEXT);
+CREATE TABLE d_subnation (Subnation_id INTEGER, ISO_Nation_cd TEXT, Subnation_cd TEXT, Subnation_name TEXT);
+CREATE TABLE UnitXSubnation (ELEMENT_GLOBAL_ID INTEGER, SUBNATION_ID INTEGER, d_curr_presence_absence_id INTEGER,
+    d_dist_confidence_id INTEGER);
+CREATE TABLE d_occurrence_status (d_occurrence_status_id INTEGER, occurrence_status_cd TEXT,
+    occurrence_status_desc TEXT, display_value TEXT);
+CREATE TABLE d_usfs_ecoregion1994 (usfs_ecoregion_id INTEGER, usfs_ecoregion_name TEXT,
+    usfs_ecoregion_class_cd TEXT, usfs_ecoregion_concat_cd TEXT);
+CREATE TABLE UnitXEcoregionUsfs1994 (element_global_id INTEGER, usfs_ecoregion_id INTEGER,
+    d_occurrence_status_id INTEGER);
+CREATE TABLE d_usfs_ecoregion2007 (usfs_ecoregion_2007_id INTEGER, parent_usfs_ecoregion_2007_id INTEGER,
+    d_usfs_ecoregion_level_id INTEGER, usfs_ecoregion_2007_name TEXT, usfs_ecoregion_2007_class_cd TEXT,
+    usfs_ecoregion_2007_concat_cd TEXT);
+CREATE TABLE UnitXEcoregionUsfs2007 (element_global_id INTEGER, usfs_ecoregion_2007_id INTEGER,
+    d_occurrence_status_id INTEGER);
+CREATE TABLE UnitPredecessor (element_global_id INTEGER, predecessor_id INTEGER, predecessorcode TEXT,
+    predecessorname TEXT, predecessorsciname TEXT, predecessorcolloquialname TEXT, lineageDate TEXT,
+    lineageNote TEXT, lineageAuthorizedBy TEXT);
+CREATE TABLE UnitObsoleteName (element_global_id INTEGER, obsoletename TEXT, obsoletenote TEXT, obsoletedate TEXT,
+    obsoleteauthority TEXT);
+CREATE TABLE UnitObsoleteParent (element_global_id INTEGER, obsoleteparentcode TEXT, obsoletedivision TEXT,
+    obsoleteparentname TEXT, obsoletenote TEXT, obsoletedate TEXT, obsoleteauthority TEXT);
+CREATE TABLE Reference (reference_id INTEGER, ShortCitation TEXT, FullCitation TEXT);
+CREATE TABLE UnitXReference (element_global_id INTEGER, reference_id INTEGER);
+CREATE TABLE UnitCrosswalk (element_global_id INTEGER, linkage TEXT, subnation_id INTEGER, stateCode TEXT,
+    statename TEXT, statename2 TEXT, stateRank TEXT, rel_std_to_nonstd_cd TEXT, rel_nonstd_to_std_cd TEXT,
+    confidenceDesc TEXT, crosswalknote TEXT);
+"""
+
+# Nations used for distribution, including an uncertain one and a code pycountry does not know
+NATIONS = ["US", "CA", "MX", "MX?", "XX"]
+
+FIRST_ELEMENT_GLOBAL_ID = 100000
+
+
+def _maybe(rng, value, null_fraction=0.3):
+    return None if rng.random() < null_fraction else value
+
+
+def _hierarchy(rng, units, depth, fanout):
+    """
+    Lays out a random hierarchy of units, level by level from the Classes down. When the deepest level is reached
+    before there are enough units, another Class is started.
+
+    :return: List of (element_global_id, parent element_global_id or None, level number, sort) tuples
+    """
+    hierarchy = list()
+    next_id = FIRST_ELEMENT_GLOBAL_ID
+    class_sort = 0
+    while len(hierarchy) < units:
+        class_sort += 1
+        hierarchy.append((next_id, None, 0, class_sort))
+        frontier = [next_id]
+        next_id += 1
+        for level in range(1, depth):
+            children = list()
+            for parent in frontier:
+                for sort in range(1, rng.randint(1, fanout) + 1):
+                    if len(hierarchy) >= units:
+                        break
+                    hierarchy.append((next_id, parent, level, sort))
+                    children.append(next_id)
+                    next_id += 1
+            frontier = children
+            if len(frontier) == 0:
+                break
+    return hierarchy
+
+
+def generate_database(filename, units=1000, depth=8, fanout=4, density=3, seed=0):
+    """
+    Writes a synthetic source database. An existing file is replaced.
+
+    :param filename: SQLite file to write
+    :param units: Number of units in the Unit table
+    :param depth: Number of hierarchy levels to use, from Class (1) down to Association (8)
+    :param fanout: Maximum number of children of each unit
+    :param density: Scales the number of related rows per unit (distribution, ecoregions, similar units, references
+    and crosswalks); each unit gets between none and a few times this many of each
+    :param seed: Seed for the random values, so that the same arguments always write the same database
+    :return: The filename
+    """
+    if not 1 <= depth <= len(LEVELS):
+        raise ValueError(f"depth must be between 1 and {len(LEVELS)}")
+
+    rng = random.Random(seed)
+    if os.path.exists(filename):
+        os.remove(filename)
+
+    db = sqlite3.connect(filename)
+    db.executescript(SCHEMA)
+
+    db.executemany("INSERT INTO d_classif_confidence VALUES (?, ?)",
+                   [(1, "High"), (2, "Moderate"), (3, "Low"), (4, None)])
+    db.executemany("INSERT INTO d_curr_presence_absence VALUES (?, ?, ?)",
+                   [(1, "P", "Present"), (2, None, "Unknown"), (3, "A", "Absent")])
+    db.executemany("INSERT INTO d_dist_confidence VALUES (?, ?, ?)", [(1, "C", "Confident"), (2, "P", "Probable")])
+    db.executemany("INSERT INTO d_occurrence_status VALUES (?, ?, ?, ?)",
+                   [(1, "C", "Confident", "c"), (2, "P", "Probable", "p")])
+
+    subnations = list()
+    for nation in ["US", "CA", "MX"]:
+        for subdivision in sorted(pycountry.subdivisions.get(country_code=nation), key=lambda s: s.code):
+            subnations.append((len(subnations) + 1, nation, subdivision.code.split("-")[1], subdivision.name))
+    db.executemany("INSERT INTO d_subnation VALUES (?, ?, ?, ?)", subnations)
+
+    ecoregions_1994 = [(i, f"Ecoregion {i}", _maybe(rng, f"C{i % 5}"), f"M{i}") for i in range(1, 41)]
+    db.executemany("INSERT INTO d_usfs_ecoregion1994 VALUES (?, ?, ?, ?)", ecoregions_1994)
+    ecoregions_2007 = [(i, max(i // 4, 1), 1 + i % 4, f"Ecoregion {i}", _maybe(rng, f"C{i % 5}"), f"M{200 + i}")
+                       for i in range(1, 101)]
+    db.executemany("INSERT INTO d_usfs_ecoregion2007 VALUES (?, ?, ?, ?, ?, ?)", ecoregions_2007)
+
+    reference_count = max(units // 5, 50)
+    db.executemany("INSERT INTO Reference VALUES (?, ?, ?)",
+                   [(i, f"Author {i} ({1950 + i % 70})", f"Author {i}. {1950 + i % 70}. Title {i} &amp; more.")
+                    for i in range(1, reference_count + 1)])
+
+    hierarchy = _hierarchy(rng, units, depth, fanout)
+    names = {element_global_id: f"Unit {element_global_id}" for element_global_id, _, _, _ in hierarchy}
+
+    unit_rows = list()
+    for element_global_id, parent_id, level, sort in hierarchy:
+        upper = level < 4
+        unit_rows.append((
+            element_global_id, parent_id, LEVELS[level], level + 1,
+            f"{level + 1}.{sort}" if level < 6 else None,
+            f"CEGL{element_global_id:06d}" if level >= 6 else f"{LEVELS[level][0]}{element_global_id:06d}",
+            f"{names[element_global_id]} scientific", f"<i>{names[element_global_id]}</i> scientific &amp; co",
+            f"{names[element_global_id]} translated",
+            f"{names[element_global_id]} colloquial" if upper or rng.random() < 0.5 else None,
+            str(sort), _maybe(rng, f"{LEVELS[level - 1][0]}{parent_id}" if parent_id else None),
+            _maybe(rng, names.get(parent_id))
+        ))
+    db.executemany("INSERT INTO Unit VALUES (" + ", ".join("?" * 13) + ")", unit_rows)
+
+    last_id = FIRST_ELEMENT_GLOBAL_ID + units - 1
+    for element_global_id, _, level, _ in hierarchy:
+        if rng.random() < 0.05:
+            # Some units have no description
+            continue
+
+        def text(label):
+            return _maybe(rng, f"{label} of {names[element_global_id]} &lt;b&gt;with markup&lt;/b&gt;&amp;")
+
+        nations = _maybe(rng, ",".join(rng.sample(NATIONS, rng.randint(1, 3))))
+        db.execute("INSERT INTO UnitDescription VALUES (" + ", ".join("?" * 38) + ")", (
+            element_global_id, rng.choice([1, 2, 3, 4, None]), text("Type concept sentence"), text("Type concept"),
+            text("Diagnostic characteristics"), text("Rationale"), text("Classification comments"),
+            text("Other comments"), text("Similar types comments"), text("Physiognomy"), text("Floristics"),
+            text("Dynamics"), text("Environment"), text("Spatial pattern"), text("Range"), nations,
+            _maybe(rng, ", ".join(s[2] for s in rng.sample(subnations, 3))), _maybe(rng, "63:C"),
+            _maybe(rng, "1:P"), _maybe(rng, "USFS"), _maybe(rng, rng.randint(0, 500)), text("Plot summary"),
+            text("Plot type"), text("Plot archive"), text("Plot consistency"), text("Plot size"),
+            text("Plot methods"), text("Confidence comments"), _maybe(rng, f"G{rng.randint(1, 5)}"),
+            _maybe(rng, "2019-01-01"), text("Rank author"), text("Rank reasons"), text("Lineage"),
+            text("Synonymy"), text("Concept source"), text("Description author"), text("Acknowledgements"),
+            _maybe(rng, "2019-03-01")
+        ))
+
+        db.executemany("INSERT INTO UnitXSimilarUnit VALUES (?, ?, ?, ?, ?, ?, ?)", [
+            (element_global_id, _maybe(rng, rng.randint(FIRST_ELEMENT_GLOBAL_ID, last_id), 0.2),
+             _maybe(rng, "Similar note"), f"CEGL{element_global_id:06d}", f"Similar to {names[element_global_id]}",
+             _maybe(rng, "US"), rng.randint(1, len(LEVELS)))
+            for _ in range(rng.randint(0, density))
+        ])
+
+        # Lower levels carry far more distribution and crosswalk rows than upper levels
+        spread = density * (1 + level)
+        db.executemany("INSERT INTO UnitXSubnation VALUES (?, ?, ?, ?)", [
+            (element_global_id, s[0], rng.randint(1, 3), rng.randint(1, 2))
+            for s in rng.sample(subnations, min(rng.randint(0, spread * 2), len(subnations)))
+        ])
+        db.executemany("INSERT INTO UnitXEcoregionUsfs1994 VALUES (?, ?, ?)", [
+            (element_global_id, e[0], rng.randint(1, 2))
+            for e in rng.sample(ecoregions_1994, min(rng.randint(0, spread), len(ecoregions_1994)))
+        ])
+        db.executemany("INSERT INTO UnitXEcoregionUsfs2007 VALUES (?, ?, ?)", [
+            (element_global_id, e[0], rng.randint(1, 2))
+            for e in rng.sample(ecoregions_2007, min(rng.randint(0, spread * 2), len(ecoregions_2007)))
+        ])
+        db.executemany("INSERT INTO UnitPredecessor VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", [
+            (element_global_id, rng.randint(1, 99999), f"P{rng.randint(1, 9999)}", "Predecessor",
+             "Predecessor scientific", _maybe(rng, "Predecessor colloquial"), "2018-01-01", _maybe(rng, "Note"),
+             "Authority")
+            for _ in range(rng.randint(0, 2))
+        ])
+        db.executemany("INSERT INTO UnitObsoleteName VALUES (?, ?, ?, ?, ?)", [
+            (element_global_id, "Obsolete name", _maybe(rng, "Note"), "2017-01-01", "Authority")
+            for _ in range(rng.randint(0, 1))
+        ])
+        db.executemany("INSERT INTO UnitObsoleteParent VALUES (?, ?, ?, ?, ?, ?, ?)", [
+            (element_global_id, "OP", _maybe(rng, "Division"), _maybe(rng, "Obsolete parent"), _maybe(rng, "Note"),
+             "2017-01-01", "Authority")
+            for _ in range(rng.randint(0, 1))
+        ])
+        db.executemany("INSERT INTO UnitXReference VALUES (?, ?)", [
+            (element_global_id, r) for r in rng.sample(range(1, reference_count + 1), rng.randint(0, density * 2))
+        ])
+        db.executemany("INSERT INTO UnitCrosswalk VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", [
+            (element_global_id, rng.choice(["1 direct", "2 indirect"]), s[0], _maybe(rng, f"S{rng.randint(1, 5)}"),
+             s[3], f"{s[3]} type", f"S{rng.randint(1, 5)}", "=", "<", "High", _maybe(rng, "Note"))
+            for s in rng.sample(subnations, min(rng.randint(0, spread), len(subnations)))
+        ])
+
+    db.commit()
+    db.close()
+
+    return filename
@@ -1,30 +1,43 @@
-import pandas as pd
 import sqlite3
 import os
-from zipfile import ZipFile
-from sciencebasepy import SbSession
+import threading
+import contextlib
+import pathlib
+import shutil
+import tempfile
 from datetime import datetime
-import pycountry
 import json
-import numpy
 import math
 import copy
-from genson import SchemaBuilder
+import heapq
+import random
+import time
+
+from pyusnvc import instrumentation
 
 """
 This script is the core usnvc package. Starting with sourcedata from ScienceBase,
 these functions extract transform and load the data into a human readable form.
 """
 
-def get_source_item(version=2.03, force=False):
+def get_source_item(version=2.03, force=False, mirror=None, folder=None):
     """
     Checks the local path for the ScienceBase Source item (cached as a JSON document) and updates as necessary.
-    Retrieves the ScienceBase Item and caches it as a document. Retrieves the data file from the ScienceBase Item, 
-    checking to see if the file already exists in the local path, and downloading/unzipping if necessary.
- 
+    Retrieves the ScienceBase Item and caches it as a document. Retrieves the data file from the ScienceBase Item,
+    streaming the download so that an interrupted download resumes where it stopped, verifying it against the size
+    and checksum listed in the item's file metadata and extracting only the database from the archive. Nothing is
+    downloaded or extracted when the database on disk was already extracted from the archive the item lists.
+
     :param version: Which numbered version of the USNVC source to retrieve
-    :param force: Set to True to force cache of ScienceBase source info regardless of pre-existence
+    :param force: Set to True to force cache of ScienceBase source info regardless of pre-existence, and to fetch and
+    extract the data file again
+    :param mirror: Optional local directory or base URL holding the item metadata as <item id>.json and the data file
+    under its ScienceBase name, used in place of ScienceBase
+    :param folder: Folder to keep the metadata, archive and database in; defaults to the current directory
+    :return: Dictionary with the source item metadata filename, the source data filename and the archive filename
     """
+    from pyusnvc import download
+
     # 2 versions in ScienceBase at the moment. Need a way to consistently query ScienceBase for versions of source.
     usnvc_source_items = [
         {
@@ -46,18 +59,11 @@ def get_source_item(version=2.03, force=False):
     if version_config is None:
         raise ValueError("Version number does not correspond to a valid source item")
 
-    source_item_metadata_file = f'{version_config["id"]}.json'
+    def local_path(name):
+        return name if folder is None else os.path.join(folder, name)
 
-    if os.path.exists(f'{version_config["id"]}.json') and not force:
-        with open(source_item_metadata_file, 'r') as f:
-            source_item_metadata = json.load(f)
-            f.close()
-    else:
-        sb = SbSession()
-        source_item_metadata = sb.get_item(version_config["id"])
-        with open(source_item_metadata_file, 'w') as f:
-            json.dump(source_item_metadata, f)
-            f.close()
+    source_item_metadata_file = local_path(f'{version_config["id"]}.json')
+    source_item_metadata = download.fetch_metadata(version_config["id"], source_item_metadata_file, mirror, force)
 
     source_sb_file = next(
         (f for f in source_item_metadata["files"] if f["title"] == version_config["source_title"]), None)
@@ -66,33 +72,328 @@ def get_source_item(version=2.03, force=False):
         raise ValueError("The source item metadata contained no reference to source data file")
 
     # This is a clunky way of handling identification of the source data file
-    source_data_file = source_sb_file["name"].replace(".zip", ".db")
+    source_data_file = local_path(source_sb_file["name"].replace(".zip", ".db"))
+    source_archive_file = local_path(source_sb_file["name"])
 
-    if not os.path.exists(source_data_file) or force:
-        zip_file = sb.download_file(
-            source_sb_file["url"],
-            source_sb_file["name"]
-        )
+    if force or not download.is_current(source_data_file, source_sb_file):
+        source_archive_file = download.fetch_archive(source_sb_file, source_archive_file, mirror, force)
+        member_name, sha256 = download.extract_database(source_archive_file, source_data_file)
+        download.record_extraction(source_data_file, source_sb_file, member_name, sha256, source_archive_file)
+    else:
+        # The archive may have been read from a mirror when the database was extracted
+        source_archive_file = download.extraction_record(source_data_file).get("archive_filename") \
+            or source_archive_file
 
-        with ZipFile(zip_file, 'r') as zip_ref:
-            # Assumes only one file. Need to revisit this.
-            source_data_file = zip_ref.namelist()[0]
-            zip_ref.extractall()
-            zip_ref.close()
-    
     return {
-        "source_item_metadata_filename": source_item_metadata_file, 
-        "source_data_filename": source_data_file
+        "source_item_metadata_filename": source_item_metadata_file,
+        "source_data_filename": source_data_file,
+        "source_archive_filename": source_archive_file
     }
 
 
 def db_connection(source_data_filename):
+    """
+    Opens a new read/write connection to the source data. Kept for existing callers; the functions in this module
+    use UsnvcSource, which reuses read-only connections and closes them when finished.
+
+    :param source_data_filename: location of source data
+    :return: sqlite3 connection or None if the connection could not be made
+    """
     try:
         return sqlite3.connect(source_data_filename)
     except:
         return None
 
 
+# Pragmas set on every UsnvcSource connection: memory-map up to 256 MiB of the file, keep up to 64 MiB of pages in
+# the page cache, and refuse anything that would change the database
+READ_PRAGMAS = {
+    "mmap_size": 268435456,
+    "cache_size": -65536,
+    "query_only": "ON"
+}
+
+
+class UsnvcSource(object):
+    """
+    Manages read-only connections to the USNVC source SQLite database. One connection is opened per thread (and per
+    process, so that forked workers never share a connection with their parent) the first time it is needed, and
+    reused with SQLite's prepared statement cache for every query after that. All connections are closed when the
+    source is closed or its context exits.
+
+    Functions in this module that take a source_data_filename also accept a UsnvcSource. Passing an open source
+    avoids opening a new connection for every call.
+    """
+    def __init__(self, source_data_filename, cached_statements=256, pragmas=None):
+        """
+        :param source_data_filename: location of source data
+        :param cached_statements: Number of prepared statements SQLite keeps for each connection
+        :param pragmas: Dictionary of pragmas to set on each connection; defaults to READ_PRAGMAS
+        """
+        if isinstance(source_data_filename, UsnvcSource):
+            source_data_filename = source_data_filename.source_data_filename
+        self.source_data_filename = source_data_filename
+        self.cached_statements = cached_statements
+        self.pragmas = dict(READ_PRAGMAS if pragmas is None else pragmas)
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._local = threading.local()
+        self._connections = list()
+
+    @property
+    def uri(self):
+        """
+        :return: SQLite URI opening the source data read-only, and as immutable so that SQLite skips file locking
+        """
+        return pathlib.Path(self.source_data_filename).resolve().as_uri() + "?mode=ro&immutable=1"
+
+    @property
+    def connection(self):
+        """
+        :return: sqlite3 connection for the current thread, opened on first use
+        """
+        if self._pid != os.getpid():
+            # Connections inherited through fork belong to the parent process and are left alone
+            self._reset()
+
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(
+                self.uri,
+                uri=True,
+                check_same_thread=False,
+                cached_statements=self.cached_statements
+            )
+            for name, value in self.pragmas.items():
+                connection.execute(f"PRAGMA {name} = {value}")
+            self._local.connection = connection
+            with self._lock:
+                self._connections.append(connection)
+        return connection
+
+    def execute(self, sql, parameters=()):
+        """
+        Executes a parameterized query on the current thread's connection.
+
+        :param sql: SQL statement with ? placeholders
+        :param parameters: Sequence of values for the placeholders
+        :return: sqlite3 cursor
+        """
+        connection = self.connection
+        recorder = instrumentation.recorder()
+        if recorder is not None:
+            recorder.trace_connection(connection)
+        return connection.execute(sql, parameters)
+
+    def close(self):
+        """
+        Closes every connection opened by this source in the current process.
+        """
+        if self._pid == os.getpid():
+            with self._lock:
+                for connection in self._connections:
+                    connection.close()
+        self._reset()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __getstate__(self):
+        # Connections cannot be pickled; a copy sent to another process opens its own
+        return {
+            "source_data_filename": self.source_data_filename,
+            "cached_statements": self.cached_statements,
+            "pragmas": self.pragmas
+        }
+
+    def __setstate__(self, state):
+        self.__init__(state["source_data_filename"], state["cached_statements"], state["pragmas"])
+
+
+@contextlib.contextmanager
+def _opened_source(source_data_filename):
+    """
+    Provides a UsnvcSource for either a filename or an existing source. A source opened here is closed on exit,
+    while a source passed in by the caller is left open for further use.
+
+    :param source_data_filename: location of source data or a UsnvcSource
+    :return: Context manager yielding a UsnvcSource
+    """
+    if isinstance(source_data_filename, UsnvcSource):
+        yield source_data_filename
+    else:
+        with UsnvcSource(source_data_filename) as source:
+            yield source
+
+
+# Columns the unit queries filter or join on, which the Access export does not reliably index
+SOURCE_INDEXES = [
+    ("Unit", "element_global_id"),
+    ("Unit", "PARENT_ID"),
+    ("UnitDescription", "ELEMENT_GLOBAL_ID"),
+    ("UnitXSimilarUnit", "ELEMENT_GLOBAL_ID"),
+    ("UnitXSubnation", "ELEMENT_GLOBAL_ID"),
+    ("UnitXEcoregionUsfs1994", "element_global_id"),
+    ("UnitXEcoregionUsfs2007", "element_global_id"),
+    ("UnitPredecessor", "element_global_id"),
+    ("UnitObsoleteName", "element_global_id"),
+    ("UnitObsoleteParent", "element_global_id"),
+    ("UnitXReference", "element_global_id"),
+    ("UnitCrosswalk", "element_global_id"),
+    ("d_classif_confidence", "D_CLASSIF_CONFIDENCE_ID"),
+    ("d_curr_presence_absence", "d_curr_presence_absence_id"),
+    ("d_dist_confidence", "d_dist_confidence_id"),
+    ("d_subnation", "Subnation_id"),
+    ("d_usfs_ecoregion1994", "usfs_ecoregion_id"),
+    ("d_usfs_ecoregion2007", "usfs_ecoregion_2007_id"),
+    ("d_occurrence_status", "d_occurrence_status_id"),
+    ("Reference", "reference_id")
+]
+
+# Table in a prepared working copy recording the preparation
+PREPARED_TABLE = "pyusnvc_prepared"
+
+
+def _prepared_record(working_filename):
+    """
+    :param working_filename: Possible working copy made by prepare_source
+    :return: Dictionary recorded by prepare_source, or None if the file was not prepared
+    """
+    if not os.path.exists(working_filename):
+        return None
+    connection = sqlite3.connect(pathlib.Path(working_filename).resolve().as_uri() + "?mode=ro", uri=True)
+    try:
+        row = connection.execute(f"SELECT record FROM {PREPARED_TABLE}").fetchone()
+    except sqlite3.DatabaseError:
+        row = None
+    finally:
+        connection.close()
+    return json.loads(row[0]) if row is not None else None
+
+
+def _leading_index_columns(connection, table_name):
+    columns = set()
+    for index in connection.execute(f'PRAGMA index_list("{table_name}")').fetchall():
+        first_column = connection.execute(f'PRAGMA index_info("{index[1]}")').fetchone()
+        if first_column is not None and first_column[2] is not None:
+            columns.add(first_column[2].lower())
+    # An INTEGER PRIMARY KEY column is the rowid and needs no index
+    for column in connection.execute(f'PRAGMA table_info("{table_name}")').fetchall():
+        if column[5] == 1 and column[2].upper() == "INTEGER":
+            columns.add(column[1].lower())
+    return columns
+
+
+def prepared_filename(source_data_filename):
+    """
+    :param source_data_filename: location of source data
+    :return: Default name of the working copy prepare_source makes of it, with .prepared before the extension
+    """
+    root, extension = os.path.splitext(source_data_filename)
+    return f"{root}.prepared{extension}"
+
+
+def is_prepared(source_data_filename, working_filename=None):
+    """
+    :param source_data_filename: location of source data
+    :param working_filename: Working copy; defaults to prepared_filename(source_data_filename)
+    :return: True if the working copy was made by prepare_source from the source as it is now
+    """
+    if working_filename is None:
+        working_filename = prepared_filename(source_data_filename)
+    record = _prepared_record(working_filename)
+    if record is None:
+        return False
+    source_stat = os.stat(source_data_filename)
+    return record["source_size"] == source_stat.st_size and record["source_mtime_ns"] == source_stat.st_mtime_ns
+
+
+def prepare_source(source_data_filename, working_filename=None, force=False):
+    """
+    Makes a working copy of the source data tuned for building documents. The Access export does not guarantee
+    indexes on the columns the unit queries filter and join on, so any missing indexes from SOURCE_INDEXES are
+    created and ANALYZE is run so that SQLite plans its queries from real statistics. What was done is recorded in
+    the working copy along with the size and modification time of the source it was made from, so the work is only
+    done once per release; calling this again returns straight away while the source is unchanged. The copy is
+    made under a unique temporary name and moved into place when it is complete, so processes preparing the same
+    source at once never see or overwrite each other's partial copies.
+
+    Run this after get_source_item and build from the returned file. The read-optimized pragmas (mmap_size,
+    cache_size and query_only) are connection settings, so they are applied by UsnvcSource whenever it connects.
+
+    :param source_data_filename: location of source data as downloaded by get_source_item
+    :param working_filename: Working copy to create; defaults to the source filename with .prepared before the
+    extension
+    :param force: Set to True to remake the working copy even if it is up to date
+    :return: Filename of the prepared working copy
+    """
+    if working_filename is None:
+        working_filename = prepared_filename(source_data_filename)
+
+    if not force and is_prepared(source_data_filename, working_filename):
+        return working_filename
+
+    source_stat = os.stat(source_data_filename)
+    file_descriptor, temporary_filename = tempfile.mkstemp(
+        suffix=".tmp", prefix=os.path.basename(working_filename) + ".",
+        dir=os.path.dirname(os.path.abspath(working_filename)))
+    os.close(file_descriptor)
+    try:
+        shutil.copyfile(source_data_filename, temporary_filename)
+        _prepare_copy(source_data_filename, source_stat, temporary_filename)
+        os.replace(temporary_filename, working_filename)
+    except BaseException:
+        os.remove(temporary_filename)
+        raise
+
+    return working_filename
+
+
+def _prepare_copy(source_data_filename, source_stat, temporary_filename):
+    """
+    Creates the missing indexes in a copy of the source, analyzes it and records what was done, for prepare_source.
+    """
+    connection = sqlite3.connect(temporary_filename)
+    try:
+        tables = {r[0].lower(): r[0] for r in connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+
+        created_indexes = list()
+        for table_name, column_name in SOURCE_INDEXES:
+            table_name = tables.get(table_name.lower())
+            if table_name is None:
+                continue
+            table_columns = {c[1].lower() for c in connection.execute(f'PRAGMA table_info("{table_name}")')}
+            if column_name.lower() not in table_columns \
+                    or column_name.lower() in _leading_index_columns(connection, table_name):
+                continue
+            index_name = f"pyusnvc_{table_name}_{column_name}".lower()
+            connection.execute(f'CREATE INDEX "{index_name}" ON "{table_name}" ("{column_name}")')
+            created_indexes.append(index_name)
+
+        connection.execute("ANALYZE")
+
+        record = {
+            "source_data_filename": os.path.abspath(source_data_filename),
+            "source_size": source_stat.st_size,
+            "source_mtime_ns": source_stat.st_mtime_ns,
+            "created_indexes": created_indexes,
+            "analyzed": True,
+            "prepared": datetime.utcnow().isoformat()
+        }
+        connection.execute(f"DROP TABLE IF EXISTS {PREPARED_TABLE}")
+        connection.execute(f"CREATE TABLE {PREPARED_TABLE} (record TEXT)")
+        connection.execute(f"INSERT INTO {PREPARED_TABLE} VALUES (?)", [json.dumps(record)])
+        connection.commit()
+    finally:
+        connection.close()
+
+
 def clean_string(text):
     """
     Function for basic cleaning of cruft from strings.
@@ -106,6 +407,21 @@ def clean_string(text):
     return text
 
 
+# Country names looked up through pycountry, by the abbreviation they were looked up with
+_country_names = dict()
+
+
+def preload_country_names():
+    """
+    Fills the country name lookup used by get_place_code_data with every two-character code, so that worker
+    processes forked afterwards share it instead of each going through pycountry.
+    """
+    import pycountry
+
+    for country in pycountry.countries:
+        _country_names.setdefault(country.alpha_2, country.name)
+
+
 def get_place_code_data(abbreviation, uncertainty=False):
     """
     Takes an abbreviation for a 2 character country code and uses the pycountry package to return the full name.
@@ -120,152 +436,1226 @@ def get_place_code_data(abbreviation, uncertainty=False):
         "Name": "Unknown"
     }
 
-    country_info = pycountry.countries.get(alpha_2=abbreviation)
-    if country_info is not None:
-        code_data["Name"] = country_info.name
+    if abbreviation not in _country_names:
+        import pycountry
+        country_info = pycountry.countries.get(alpha_2=abbreviation)
+        _country_names[abbreviation] = country_info.name if country_info is not None else None
+    if _country_names[abbreviation] is not None:
+        code_data["Name"] = _country_names[abbreviation]
 
     return code_data
 
 
-def all_keys(source_data_filename):
+def all_keys(source_data_filename, shard=None, num_shards=None, strategy="cost"):
     """
     Pulls together a list of all element_global_id keys from the USNVC source. This can be used to set up a message
     queue with all of the items to be processed.
 
-    :param source_data_filename: location of source data
-    :return: List of all element_global_id values in the Unit table of the SQLite database
+    :param source_data_filename: location of source data or a UsnvcSource
+    :param shard: Optional number, from 0 to num_shards - 1, of the shard to return the keys of, so that the units
+    can be split between nodes that each build one shard
+    :param num_shards: Number of shards the units are split into
+    :param strategy: How units are assigned to shards (see SHARD_STRATEGIES)
+    :return: List of all element_global_id values in the Unit table of the SQLite database, or of those in the
+    shard, in table order
     """
-    db = db_connection(source_data_filename)
+    with _opened_source(source_data_filename) as source:
+        identifiers = _query_frame(source, "SELECT element_global_id FROM Unit")
+        ids = identifiers["element_global_id"].tolist()
+        if shard is None:
+            return ids
 
-    identifiers = pd.read_sql_query(
-        "SELECT element_global_id FROM Unit",
-        db
-    )
+        _check_shard(shard, num_shards, strategy)
+        shard_ids = set(shard_keys(source, num_shards, strategy)[shard])
+    return [i for i in ids if int(i) in shard_ids]
 
-    return identifiers["element_global_id"].tolist()
 
+def iter_keys(source_data_filename, page_size=1000, after=None, shard=None, num_shards=None, strategy="cost"):
+    """
+    Streams element_global_id keys in ascending order a page at a time, each page picking up after the last key of
+    the one before, so that no query holds more than a page and an interrupted run can carry on from the last key it
+    handled.
+
+    :param source_data_filename: location of source data or a UsnvcSource
+    :param page_size: Number of keys to fetch per query
+    :param after: Optional key to start after
+    :param shard: Optional number of the shard to stream the keys of (see all_keys)
+    :param num_shards: Number of shards the units are split into
+    :param strategy: How units are assigned to shards (see SHARD_STRATEGIES); the "modulo" strategy is worked out in
+    the query, while "cost" works out every shard up front
+    :return: Generator of element_global_id values
+    """
+    conditions = list()
+    parameters = list()
+    shard_ids = None
+    with _opened_source(source_data_filename) as source:
+        if shard is not None:
+            _check_shard(shard, num_shards, strategy)
+            if strategy == "modulo":
+                conditions.append("element_global_id % ? = ?")
+                parameters.extend([num_shards, shard])
+            else:
+                shard_ids = set(shard_keys(source, num_shards, strategy)[shard])
+
+        last_key = after
+        while True:
+            page_conditions = conditions if last_key is None else ["element_global_id > ?"] + conditions
+            page_parameters = parameters if last_key is None else [last_key] + parameters
+            where = f"WHERE {' AND '.join(page_conditions)}" if len(page_conditions) > 0 else ""
+            page = source.execute(f"SELECT element_global_id FROM Unit {where} ORDER BY element_global_id LIMIT ?",
+                                  page_parameters + [page_size]).fetchall()
+            if len(page) == 0:
+                return
+            for (element_global_id,) in page:
+                if shard_ids is None or element_global_id in shard_ids:
+                    yield element_global_id
+            last_key = page[-1][0]
+
+
+# Related tables that add rows to a unit document, with the column they are keyed on
+_COST_TABLES = [
+    ("UnitXSimilarUnit", "ELEMENT_GLOBAL_ID"),
+    ("UnitXSubnation", "ELEMENT_GLOBAL_ID"),
+    ("UnitXEcoregionUsfs1994", "element_global_id"),
+    ("UnitXEcoregionUsfs2007", "element_global_id"),
+    ("UnitPredecessor", "element_global_id"),
+    ("UnitObsoleteName", "element_global_id"),
+    ("UnitObsoleteParent", "element_global_id"),
+    ("UnitXReference", "element_global_id"),
+    ("UnitCrosswalk", "element_global_id"),
+    ("Unit", "PARENT_ID")
+]
+
+# Relative cost of the unit's own row and document assembly compared to one related row
+_UNIT_BASE_COST = 10
+
+
+def unit_costs(source_data_filename):
+    """
+    Estimates the relative cost of building each unit from the number of rows it has in the related tables. Units
+    with long distribution, crosswalk and reference lists cost far more to build than sparse upper-level units, so
+    this is used to balance work between workers.
 
-def logical_nvcs_root(source_data_filename):
+    :param source_data_filename: location of source data or a UsnvcSource
+    :return: Dictionary of element_global_id to estimated build cost
+    """
+    with _opened_source(source_data_filename) as source:
+        costs = {int(k[0]): _UNIT_BASE_COST for k in source.execute("SELECT element_global_id FROM Unit")}
+
+        tables = {r[0] for r in source.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        for table_name, key_column in _COST_TABLES:
+            if table_name not in tables:
+                continue
+            for key, row_count in source.execute(
+                    f"SELECT {key_column}, COUNT(*) FROM {table_name} GROUP BY {key_column}"):
+                if key is not None and int(key) in costs:
+                    costs[int(key)] += row_count
+
+    return costs
+
+
+# Ways of splitting the units between shards. "cost" balances the estimated build cost of each shard (see
+# unit_costs), while "modulo" assigns units by element_global_id modulo the number of shards, which leaves every other
+# unit where it was when units are added or removed.
+SHARD_STRATEGIES = ("cost", "modulo")
+
+
+def _check_shard(shard, num_shards, strategy):
+    if strategy not in SHARD_STRATEGIES:
+        raise ValueError(f"strategy must be one of {SHARD_STRATEGIES}")
+    if num_shards is None or num_shards < 1:
+        raise ValueError("num_shards must be at least 1")
+    if shard is not None and not 0 <= shard < num_shards:
+        raise ValueError(f"shard must be from 0 to {num_shards - 1}")
+
+
+def shard_keys(source_data_filename, num_shards, strategy="cost"):
+    """
+    Splits the units between a number of shards. With the "cost" strategy, units are taken from the most to the
+    least costly and each is given to the shard with the least estimated cost so far, with ties broken by
+    element_global_id and shard number, so every node working from the same source data arrives at the same shards.
+
+    :param source_data_filename: location of source data or a UsnvcSource
+    :param num_shards: Number of shards
+    :param strategy: "cost" or "modulo" (see SHARD_STRATEGIES)
+    :return: List with a sorted list of element_global_id values for each shard
+    """
+    _check_shard(None, num_shards, strategy)
+    costs = unit_costs(source_data_filename)
+    shards = [list() for _ in range(num_shards)]
+
+    if strategy == "modulo":
+        for element_global_id in sorted(costs):
+            shards[element_global_id % num_shards].append(element_global_id)
+        return shards
+
+    loads = [(0, shard) for shard in range(num_shards)]
+    for element_global_id, cost in sorted(costs.items(), key=lambda c: (-c[1], c[0])):
+        load, shard = heapq.heappop(loads)
+        shards[shard].append(element_global_id)
+        heapq.heappush(loads, (load + cost, shard))
+    return [sorted(shard) for shard in shards]
+
+
+def logical_nvcs_root(source_data_filename, unit_tree=None):
     """
     Creates a logical root document with _id 0 for the root of the USNVC.
 
-    ::param source_data_filename: location of source data
+    ::param source_data_filename: location of source data or a UsnvcSource
+    :param unit_tree: Optional UnitTree to take the Classes from instead of querying the database
     :return: Dictionary with the bare minimum properties necessary to establish the root.
     """
-    db = db_connection(source_data_filename)
-
-    classes = pd.read_sql_query(
-        "SELECT element_global_id FROM Unit WHERE PARENT_ID IS NULL",
-        db
-    )
+    if unit_tree is not None:
+        children = unit_tree.roots()
+    else:
+        with _opened_source(source_data_filename) as source:
+            classes = _query_frame(source, "SELECT element_global_id FROM Unit WHERE PARENT_ID IS NULL")
+        children = classes["element_global_id"].tolist()
 
     return {
         "_id": int(0),
         "title": "US National Vegetation Classification",
         "parent": None,
         "ancestors": None,
-        "children": classes["element_global_id"].tolist(),
+        "children": children,
         "Hierarchy": {
             "unitSort": str(0)
         }
     }
 
 
-def build_hierarchy(element_global_id, source_data_filename):
+_HIERARCHY_COLUMNS = "element_global_id, PARENT_ID, hierarchylevel, classificationCode,\
+    databaseCode, translatedName, colloquialName, unitsort"
+
+_CHILD_HIERARCHY_COLUMNS = "element_global_id, hierarchylevel, classificationCode,\
+    databaseCode, translatedName, colloquialName, unitsort"
+
+
+# Keeps IN clauses under SQLite's default limit on the number of bound parameters
+_MAX_PARAMETERS = 500
+
+
+# Stands in for a column label that appears more than once in a query result, where pandas returns a Series for
+# the label rather than a value
+_DUPLICATE_COLUMN = object()
+
+# Converters from raw sqlite3 values to the native values DataFrame.to_dict gives for each column type
+_NATIVE_CONVERTERS = {
+    "int64": int,
+    "float64": lambda v: float("nan") if v is None else float(v),
+    "object": None
+}
+
+# Converters to the numpy scalars a DataFrame row (Series) holds for each column type, set up on first use so that
+# numpy is only imported by processes that build documents
+_SCALAR_CONVERTERS = None
+
+
+def _scalar_converters():
+    global _SCALAR_CONVERTERS
+    if _SCALAR_CONVERTERS is None:
+        import numpy
+        _SCALAR_CONVERTERS = {
+            "int64": numpy.int64,
+            "float64": lambda v: numpy.float64("nan") if v is None else numpy.float64(v),
+            "object": None
+        }
+    return _SCALAR_CONVERTERS
+
+
+def _column_type(values):
+    """
+    Works out the type pandas infers for a column of raw sqlite3 values: int64 for integers, float64 for numbers with
+    any floats or NULLs among them, and object for anything else, including columns that are entirely NULL.
+
+    :param values: Iterable of values from one column
+    :return: "int64", "float64" or "object"
+    """
+    has_int = has_float = has_null = False
+    for value in values:
+        value_type = type(value)
+        if value_type is int:
+            has_int = True
+        elif value_type is float:
+            has_float = True
+        elif value is None:
+            has_null = True
+        else:
+            return "object"
+    if has_float or (has_int and has_null):
+        return "float64"
+    if has_int:
+        return "int64"
+    return "object"
+
+
+class _RowsColumn(list):
+    """
+    Values of a single column of a _Rows result.
+    """
+    def tolist(self):
+        return list(self)
+
+
+class _RowsIndexer(object):
+    def __init__(self, rows):
+        self.rows = rows
+
+    def __getitem__(self, position):
+        return self.rows._series(self.rows.rows[position])
+
+
+class _Rows(object):
+    """
+    Lightweight replacement for the DataFrames the unit queries used to be read into. The raw sqlite3 rows are kept
+    as they are and only converted when they are read, giving exactly the values the pandas methods used in document
+    assembly would: to_dict("records") and tolist() give native values, while rows read with iloc hold numpy scalars
+    (as do rows from iterrows when there are no object columns), with integers promoted to floats when every column
+    is numeric and any is a float.
+    """
+    def __init__(self, columns, rows):
+        """
+        :param columns: List of column names from the cursor description
+        :param rows: List of row tuples
+        """
+        self.columns = list(columns)
+        self.rows = rows
+        self._column_types = None
+        self._duplicates = {c for c in self.columns if self.columns.count(c) > 1}
+
+    @property
+    def column_types(self):
+        if self._column_types is None:
+            self._column_types = [_column_type(v) for v in zip(*self.rows)] if len(self.rows) > 0 \
+                else ["object"] * len(self.columns)
+        return self._column_types
+
+    @property
+    def index(self):
+        return range(len(self.rows))
+
+    @property
+    def iloc(self):
+        return _RowsIndexer(self)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def _convert(self, row, converters):
+        return [v if c is None else c(v) for v, c in zip(row, converters)]
+
+    def _series(self, row, native=False):
+        column_types = set(self.column_types)
+        scalar_converters = _scalar_converters()
+        if "object" in column_types:
+            converters = [(_NATIVE_CONVERTERS if native else scalar_converters)[t] for t in self.column_types]
+        elif "float64" in column_types:
+            converters = [scalar_converters["float64"]] * len(self.columns)
+        else:
+            converters = [scalar_converters["int64"]] * len(self.columns)
+        series = dict(zip(self.columns, self._convert(row, converters)))
+        for column in self._duplicates:
+            series[column] = _DUPLICATE_COLUMN
+        return series
+
+    def iterrows(self):
+        for position, row in enumerate(self.rows):
+            # iterrows goes through the frame's values, where a mix with object columns holds native values
+            yield position, self._series(row, native=True)
+
+    def to_dict(self, orient="records"):
+        if orient != "records":
+            raise ValueError("Only records orientation is supported")
+        if "float64" not in self.column_types:
+            # Integer and object values are already native
+            return [dict(zip(self.columns, row)) for row in self.rows]
+        converters = [_NATIVE_CONVERTERS[t] for t in self.column_types]
+        return [dict(zip(self.columns, self._convert(row, converters))) for row in self.rows]
+
+    def __getitem__(self, column):
+        position = self.columns.index(column)
+        converter = _NATIVE_CONVERTERS[self.column_types[position]]
+        return _RowsColumn(row[position] if converter is None else converter(row[position]) for row in self.rows)
+
+
+# Frame implementation used to hold query results: "rows" for _Rows or "pandas" for DataFrames
+BACKENDS = ["rows", "pandas"]
+_backend = os.environ.get("PYUSNVC_BACKEND", "rows")
+
+
+def set_backend(backend):
+    """
+    Chooses how query results are held while documents are assembled. The default "rows" backend works from the
+    sqlite3 rows directly and does not need pandas; "pandas" reads results into DataFrames as earlier versions did.
+    Both give identical documents.
+
+    :param backend: "rows" or "pandas"
+    """
+    global _backend
+    if backend not in BACKENDS:
+        raise ValueError(f"backend must be one of {BACKENDS}")
+    if backend == "pandas":
+        import pandas
+    _backend = backend
+
+
+def _frame(columns, rows):
+    """
+    Holds raw query rows with the same type conversion pd.read_sql_query applies, as a _Rows or a DataFrame
+    depending on the backend. Batched queries are grouped by unit first so that each unit gets exactly the column
+    types it would get from its own query.
+
+    :param columns: List of column names from the cursor description
+    :param rows: List of row tuples
+    :return: _Rows or pandas DataFrame
+    """
+    if _backend == "pandas":
+        import pandas as pd
+        return pd.DataFrame.from_records(rows, columns=columns, coerce_float=True)
+    return _Rows(columns, rows)
+
+
+def _query_frame(source, sql, parameters=()):
+    """
+    Runs a query and holds its results as _frame does.
+
+    :param source: UsnvcSource
+    :param sql: SQL statement with ? placeholders
+    :param parameters: Sequence of values for the placeholders
+    :return: _Rows or pandas DataFrame
+    """
+    cursor = source.execute(sql, parameters)
+    columns = [col_desc[0] for col_desc in cursor.description]
+    rows = cursor.fetchall()
+    cursor.close()
+    return _frame(columns, rows)
+
+
+def _grouped_query(source, sql, ids):
+    """
+    Runs a query filtered on a list of ids whose first selected column is the grouping key, and splits the result
+    by that key. The ids are bound as parameters, in chunks when there are more than SQLite allows at once.
+
+    :param source: UsnvcSource
+    :param sql: SQL statement with the grouping key as the first column and an {ids} placeholder for the IN clause
+    :param ids: Iterable of integer ids to filter on
+    :return: Tuple of the list of column names (without the key) and a dictionary of key to list of row tuples
+    """
+    ids = [int(i) for i in ids]
+    columns = None
+    groups = dict()
+    for chunk_start in range(0, max(len(ids), 1), _MAX_PARAMETERS):
+        chunk = ids[chunk_start:chunk_start + _MAX_PARAMETERS]
+        cursor = source.execute(sql.format(ids=", ".join("?" * len(chunk))), chunk)
+        columns = [col_desc[0] for col_desc in cursor.description][1:]
+        for row in cursor.fetchall():
+            groups.setdefault(row[0], []).append(row[1:])
+        cursor.close()
+    return columns, groups
+
+
+def _named_query(name, query, *args):
+    """
+    Runs a grouped query, recording its time, rows and size under the query name when the build is instrumented.
+
+    :param name: Query name
+    :param query: _grouped_query or another function returning columns and groups the same way
+    :param args: Arguments for the query function
+    :return: Tuple of the list of column names and a dictionary of key to list of row tuples
+    """
+    recorder = instrumentation.recorder()
+    if recorder is None:
+        return query(*args)
+    start_time = time.perf_counter()
+    columns, groups = query(*args)
+    recorder.record_query(name, time.perf_counter() - start_time, groups.values())
+    return columns, groups
+
+
+# Queries that gather the related table data for a set of units. Each query selects the element_global_id it is
+# filtered on as the first column so that results for many units can be fetched at once and grouped in memory. The
+# SQL is a template with an {ids} placeholder for the IN clause.
+_UNIT_QUERIES = {
+    "unit": "SELECT Unit.element_global_id, * FROM Unit \
+        LEFT OUTER JOIN UnitDescription \
+        ON Unit.element_global_id = UnitDescription.ELEMENT_GLOBAL_ID \
+        LEFT OUTER JOIN d_classif_confidence \
+        ON UnitDescription.classif_confidence_id = d_classif_confidence.D_CLASSIF_CONFIDENCE_ID \
+        WHERE Unit.element_global_id IN ({ids})",
+    "similar_units": "SELECT ELEMENT_GLOBAL_ID, * FROM UnitXSimilarUnit WHERE ELEMENT_GLOBAL_ID IN ({ids})",
+    "distribution": "SELECT UnitXSubnation.ELEMENT_GLOBAL_ID, curr_presence_absence_desc,\
+        curr_presence_absence_cd, dist_confidence_cd, dist_confidence_desc,\
+        ISO_Nation_cd, Subnation_cd, Subnation_name\
+        FROM UnitXSubnation\
+        JOIN d_curr_presence_absence\
+        ON UnitXSubnation.d_curr_presence_absence_id = d_curr_presence_absence.d_curr_presence_absence_id\
+        JOIN d_dist_confidence\
+        ON UnitXSubnation.d_dist_confidence_id = d_dist_confidence.d_dist_confidence_id\
+        JOIN d_subnation\
+        ON UnitXSubnation.SUBNATION_ID = d_subnation.Subnation_id\
+        WHERE UnitXSubnation.ELEMENT_GLOBAL_ID IN ({ids})",
+    "usfs_2007": "SELECT UnitXEcoregionUsfs2007.element_global_id, d_usfs_ecoregion2007.*, d_occurrence_status.*\
+        FROM UnitXEcoregionUsfs2007\
+        JOIN d_usfs_ecoregion2007\
+        ON UnitXEcoregionUsfs2007.usfs_ecoregion_2007_id = d_usfs_ecoregion2007.usfs_ecoregion_2007_id\
+        JOIN d_occurrence_status\
+        ON UnitXEcoregionUsfs2007.d_occurrence_status_id = d_occurrence_status.d_occurrence_status_id\
+        WHERE UnitXEcoregionUsfs2007.element_global_id IN ({ids})",
+    "UnitPredecessor": "SELECT element_global_id, * FROM UnitPredecessor WHERE element_global_id IN ({ids})",
+    "UnitObsoleteName": "SELECT element_global_id, * FROM UnitObsoleteName WHERE element_global_id IN ({ids})",
+    "UnitObsoleteParent": "SELECT element_global_id, * FROM UnitObsoleteParent WHERE element_global_id IN ({ids})",
+    "references": "SELECT UnitXReference.element_global_id, ShortCitation, FullCitation\
+        FROM UnitXReference\
+        JOIN Reference\
+        ON UnitXReference.reference_id = Reference.reference_id\
+        WHERE UnitXReference.element_global_id IN ({ids})",
+    "usfs_1994": "SELECT UnitXEcoregionUsfs1994.element_global_id, usfs_ecoregion_name,\
+        usfs_ecoregion_class_cd, usfs_ecoregion_concat_cd,\
+        occurrence_status_cd, occurrence_status_desc, display_value\
+        FROM UnitXEcoregionUsfs1994\
+        JOIN d_usfs_ecoregion1994\
+        ON UnitXEcoregionUsfs1994.usfs_ecoregion_id = d_usfs_ecoregion1994.usfs_ecoregion_id\
+        JOIN d_occurrence_status\
+        ON UnitXEcoregionUsfs1994.d_occurrence_status_id = d_occurrence_status.d_occurrence_status_id\
+        WHERE UnitXEcoregionUsfs1994.element_global_id IN ({ids})",
+    "crosswalk": "SELECT UnitCrosswalk.element_global_id, * FROM UnitCrosswalk\
+        JOIN d_subnation ON\
+        UnitCrosswalk.subnation_id = d_subnation.Subnation_id\
+        WHERE UnitCrosswalk.element_global_id IN ({ids})"
+}
+
+# Sections of a unit document, in the order they appear in it
+DOCUMENT_SECTIONS = [
+    "Identifiers", "Overview", "Vegetation", "Environment", "Distribution", "Plot Sampling and Analysis",
+    "Confidence Level", "Conservation Status", "Hierarchy", "Concept History", "Synonymy", "State Crosswalk",
+    "Authorship", "References"
+]
+
+# Top-level document properties that go with a section; the title and Date Processed are in every document
+_SECTION_PROPERTIES = {"parent": "Hierarchy", "children": "Hierarchy", "ancestors": "Hierarchy"}
+
+# Queries each section of the document needs whatever the version of the source data. Every document is built from
+# the unit query, which holds the Unit and UnitDescription row, and "hierarchy" stands for the hierarchy of the unit
+# from a UnitTree or build_hierarchy. Versions not in SECTION_QUERIES are built with these.
+_COMMON_SECTION_QUERIES = {
+    "Identifiers": [],
+    "Overview": ["similar_units"],
+    "Vegetation": [],
+    "Environment": [],
+    "Distribution": ["distribution", "usfs_2007"],
+    "Plot Sampling and Analysis": [],
+    "Confidence Level": [],
+    "Conservation Status": [],
+    "Hierarchy": ["hierarchy"],
+    "Concept History": ["UnitPredecessor", "UnitObsoleteName", "UnitObsoleteParent"],
+    "Synonymy": [],
+    "State Crosswalk": [],
+    "Authorship": [],
+    "References": ["references"]
+}
+
+# Queries each section needs in each version. This is the one place where the versions differ in what is queried:
+# the 1994 USFS ecoregions are only in 2.02 and the state crosswalk only in 2.03.
+SECTION_QUERIES = {
+    2.02: {**_COMMON_SECTION_QUERIES, "Distribution": ["distribution", "usfs_1994", "usfs_2007"]},
+    2.03: {**_COMMON_SECTION_QUERIES, "State Crosswalk": ["crosswalk"]}
+}
+
+
+def section_queries(version_number, sections=None):
+    """
+    Works out the queries a document with the given sections needs.
+
+    :param version_number: do some specific processing based on version; versions not in SECTION_QUERIES get
+    neither the 2.02 nor the 2.03 specific queries, as before the registry
+    :param sections: Optional list of document sections (see DOCUMENT_SECTIONS); every section when None
+    :return: Set of query names, including "unit" and, when the Hierarchy is wanted, "hierarchy"
+    """
+    version_sections = SECTION_QUERIES.get(version_number, _COMMON_SECTION_QUERIES)
+    if sections is None:
+        sections = version_sections.keys()
+    unknown = [s for s in sections if s not in version_sections]
+    if len(unknown) > 0:
+        raise ValueError(f"Unknown document sections {unknown}; expected some of {DOCUMENT_SECTIONS}")
+
+    queries = {"unit"}
+    for section in sections:
+        queries.update(version_sections[section])
+    return queries
+
+
+def _unit_queries(version_number, sections=None):
+    """
+    Lists the queries that gather the related table data for a set of units.
+
+    :param version_number: do some specific processing based on version
+    :param sections: Optional list of document sections to limit the queries to those they need
+    :return: Dictionary of query name to SQL template with an {ids} placeholder for the IN clause
+    """
+    needed = section_queries(version_number, sections)
+    return {name: sql for name, sql in _UNIT_QUERIES.items() if name in needed}
+
+
+# The unit queries that join lookup tables, described so that the joins can be made from a LookupCache instead of
+# in SQL. Each gives the FROM clause and key of the unit's own rows, the tables in that clause, the joins onto lookup
+# tables as (lookup table, foreign key, lookup key, outer join) and the selected columns, where table.* and * expand
+# the same way they do in SQL.
+_LOOKUP_JOINS = {
+    "unit": {
+        "from": "Unit LEFT OUTER JOIN UnitDescription ON Unit.element_global_id = UnitDescription.ELEMENT_GLOBAL_ID",
+        "key": "Unit.element_global_id",
+        "tables": ["Unit", "UnitDescription"],
+        "joins": [("d_classif_confidence", "UnitDescription.classif_confidence_id", "D_CLASSIF_CONFIDENCE_ID", True)],
+        "columns": ["*"]
+    },
+    "distribution": {
+        "from": "UnitXSubnation",
+        "key": "UnitXSubnation.ELEMENT_GLOBAL_ID",
+        "tables": ["UnitXSubnation"],
+        "joins": [
+            ("d_curr_presence_absence", "UnitXSubnation.d_curr_presence_absence_id", "d_curr_presence_absence_id",
+             False),
+            ("d_dist_confidence", "UnitXSubnation.d_dist_confidence_id", "d_dist_confidence_id", False),
+            ("d_subnation", "UnitXSubnation.SUBNATION_ID", "Subnation_id", False)
+        ],
+        "columns": ["curr_presence_absence_desc", "curr_presence_absence_cd", "dist_confidence_cd",
+                    "dist_confidence_desc", "ISO_Nation_cd", "Subnation_cd", "Subnation_name"]
+    },
+    "usfs_2007": {
+        "from": "UnitXEcoregionUsfs2007",
+        "key": "UnitXEcoregionUsfs2007.element_global_id",
+        "tables": ["UnitXEcoregionUsfs2007"],
+        "joins": [
+            ("d_usfs_ecoregion2007", "UnitXEcoregionUsfs2007.usfs_ecoregion_2007_id", "usfs_ecoregion_2007_id", False),
+            ("d_occurrence_status", "UnitXEcoregionUsfs2007.d_occurrence_status_id", "d_occurrence_status_id", False)
+        ],
+        "columns": ["d_usfs_ecoregion2007.*", "d_occurrence_status.*"]
+    },
+    "usfs_1994": {
+        "from": "UnitXEcoregionUsfs1994",
+        "key": "UnitXEcoregionUsfs1994.element_global_id",
+        "tables": ["UnitXEcoregionUsfs1994"],
+        "joins": [
+            ("d_usfs_ecoregion1994", "UnitXEcoregionUsfs1994.usfs_ecoregion_id", "usfs_ecoregion_id", False),
+            ("d_occurrence_status", "UnitXEcoregionUsfs1994.d_occurrence_status_id", "d_occurrence_status_id", False)
+        ],
+        "columns": ["usfs_ecoregion_name", "usfs_ecoregion_class_cd", "usfs_ecoregion_concat_cd",
+                    "occurrence_status_cd", "occurrence_status_desc", "display_value"]
+    },
+    "references": {
+        "from": "UnitXReference",
+        "key": "UnitXReference.element_global_id",
+        "tables": ["UnitXReference"],
+        "joins": [("Reference", "UnitXReference.reference_id", "reference_id", False)],
+        "columns": ["ShortCitation", "FullCitation"]
+    },
+    "crosswalk": {
+        "from": "UnitCrosswalk",
+        "key": "UnitCrosswalk.element_global_id",
+        "tables": ["UnitCrosswalk"],
+        "joins": [("d_subnation", "UnitCrosswalk.subnation_id", "Subnation_id", False)],
+        "columns": ["*"]
+    }
+}
+
+
+def _table_columns(source, table_name):
+    cursor = source.execute(f'SELECT * FROM "{table_name}" LIMIT 0')
+    columns = [col_desc[0] for col_desc in cursor.description]
+    cursor.close()
+    return columns
+
+
+class LookupCache(object):
+    """
+    The small lookup tables (d_classif_confidence, d_curr_presence_absence, d_dist_confidence, d_subnation,
+    d_usfs_ecoregion1994, d_usfs_ecoregion2007, d_occurrence_status and Reference) held in memory, indexed on the
+    keys the unit queries join them on, so that units can be built from their own rows with dictionary lookups
+    instead of joining the lookup tables again for every unit. Rows come out in the same order and with the same
+    values as the SQL joins give.
+
+    Use lookup_cache to get the cache for a source; it is loaded once per process and shared read-only with worker
+    processes forked after it is loaded.
+    """
+    def __init__(self, source_data_filename):
+        """
+        :param source_data_filename: location of source data or a UsnvcSource
+        """
+        self.tables = dict()
+        self.indexes = dict()
+        with _opened_source(source_data_filename) as source:
+            table_names = {r[0] for r in source.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+            for spec in _LOOKUP_JOINS.values():
+                for table_name in spec["tables"]:
+                    if table_name in table_names and table_name not in self.tables:
+                        self.tables[table_name] = _table_columns(source, table_name)
+                for table_name, foreign_key, lookup_key, outer in spec["joins"]:
+                    if table_name not in table_names or (table_name, lookup_key) in self.indexes:
+                        continue
+                    if table_name not in self.tables:
+                        self.tables[table_name] = _table_columns(source, table_name)
+                    index = dict()
+                    for row in source.execute(f'SELECT "{lookup_key}", * FROM "{table_name}"'):
+                        # NULL keys never match in a join
+                        if row[0] is not None:
+                            index.setdefault(row[0], []).append(row[1:])
+                    self.indexes[(table_name, lookup_key)] = index
+
+    def supports(self, name):
+        """
+        :param name: Unit query name
+        :return: True if the query's joins can be made from this cache
+        """
+        spec = _LOOKUP_JOINS.get(name)
+        if spec is None:
+            return False
+        return all(t in self.tables for t in spec["tables"]) \
+            and all((t, k) in self.indexes for t, _, k, _ in spec["joins"])
+
+    def _plan(self, name):
+        """
+        Works out where each selected column comes from.
+
+        :param name: Unit query name
+        :return: List of selected column names and a list of (part, position) pairs, where part 0 is the unit's own
+        row and part n is the row from the nth join
+        """
+        spec = _LOOKUP_JOINS[name]
+        parts = [[(t, c) for t in spec["tables"] for c in self.tables[t]]]
+        parts.extend([(t, c) for c in self.tables[t]] for t, _, _, _ in spec["joins"])
+
+        columns = list()
+        plan = list()
+        for selected in spec["columns"]:
+            table_name, _, column_name = selected.rpartition(".")
+            for part_number, part in enumerate(parts):
+                for position, (t, c) in enumerate(part):
+                    if (table_name == "" or t.lower() == table_name.lower()) \
+                            and (column_name == "*" or c.lower() == column_name.lower()):
+                        columns.append(c)
+                        plan.append((part_number, position))
+        return columns, plan
+
+    def grouped_query(self, source, name, ids):
+        """
+        Fetches a unit query's rows for a batch of units, joining the lookup tables from the cache.
+
+        :param source: UsnvcSource
+        :param name: Unit query name
+        :param ids: Iterable of integer ids to filter on
+        :return: Tuple of the list of column names and a dictionary of key to list of row tuples, as _grouped_query
+        """
+        spec = _LOOKUP_JOINS[name]
+        columns, plan = self._plan(name)
+
+        own_columns = ", ".join(f'"{t}"."{c}"' for t in spec["tables"] for c in self.tables[t])
+        foreign_keys = ", ".join(j[1] for j in spec["joins"])
+        _, own_rows = _grouped_query(
+            source,
+            f"SELECT {spec['key']}, {own_columns}, {foreign_keys} FROM {spec['from']} WHERE {spec['key']} IN ({{ids}})",
+            ids
+        )
+
+        own_width = sum(len(self.tables[t]) for t in spec["tables"])
+        joins = [(self.indexes[(t, k)], outer, (None,) * len(self.tables[t])) for t, _, k, outer in spec["joins"]]
+
+        groups = dict()
+        for key, rows in own_rows.items():
+            joined_rows = list()
+            for row in rows:
+                combinations = [[row[:own_width]]]
+                for join_number, (index, outer, empty_row) in enumerate(joins):
+                    matches = index.get(row[own_width + join_number])
+                    if matches is None:
+                        if not outer:
+                            combinations = None
+                            break
+                        matches = [empty_row]
+                    combinations = [c + [m] for c in combinations for m in matches]
+                if combinations is not None:
+                    joined_rows.extend(tuple(c[p][i] for p, i in plan) for c in combinations)
+            if len(joined_rows) > 0:
+                groups[key] = joined_rows
+
+        return columns, groups
+
+
+# LookupCache for each source file, keyed by its path, size and modification time
+_lookup_caches = dict()
+
+
+def lookup_cache(source_data_filename):
+    """
+    Loads the LookupCache for a source, or returns the one already loaded in this process.
+
+    :param source_data_filename: location of source data or a UsnvcSource
+    :return: LookupCache
+    """
+    filename = getattr(source_data_filename, "source_data_filename", source_data_filename)
+    stat = os.stat(filename)
+    key = (os.path.abspath(filename), stat.st_size, stat.st_mtime_ns)
+    if key not in _lookup_caches:
+        _lookup_caches[key] = LookupCache(source_data_filename)
+    return _lookup_caches[key]
+
+
+def _fetch_units(source, ids, version_number, lookups=True, sections=None):
+    """
+    Runs each of the unit queries once for a batch of units and splits the results into per-unit frames (see _frame).
+
+    :param source: UsnvcSource
+    :param ids: List of integer element_global_id values
+    :param version_number: do some specific processing based on version
+    :param lookups: Join the lookup tables from the source's LookupCache rather than in SQL
+    :param sections: Optional list of document sections to run only the queries they need
+    :return: Dictionary of element_global_id to a dictionary of query name to frame
+    """
+    unit_data = {int(i): dict() for i in ids}
+    cache = lookup_cache(source) if lookups else None
+
+    for name, sql in _unit_queries(version_number, sections).items():
+        if cache is not None and cache.supports(name):
+            columns, groups = _named_query(name, cache.grouped_query, source, name, unit_data.keys())
+        else:
+            columns, groups = _named_query(name, _grouped_query, source, sql, unit_data.keys())
+        for element_global_id, frames in unit_data.items():
+            frames[name] = _frame(columns, groups.get(element_global_id, []))
+
+    return unit_data
+
+
+def _display_title(unit):
+    """
+    Creates the display title used for a unit in the cached hierarchy.
+
+    :param unit: Dictionary of hierarchy columns for a unit
+    :return: Display title string
+    """
+    if unit["hierarchyLevel"] in ["Class", "Subclass", "Formation", "Division"]:
+        return f'{unit["classificationCode"]} {unit["colloquialName"]} {unit["hierarchyLevel"]}'
+    elif unit["hierarchyLevel"] in ["Macrogroup", "Group"]:
+        return f'{unit["classificationCode"]} {unit["translatedName"]}'
+    else:
+        return f'{unit["databaseCode"]} {unit["translatedName"]}'
+
+
+def _fetch_hierarchies(source, ids):
+    """
+    Builds the hierarchy for a batch of units, fetching the units, their immediate children and one round of
+    ancestors per level of the classification rather than one query per ancestor of every unit.
+
+    :param source: UsnvcSource
+    :param ids: List of integer element_global_id values
+    :return: Dictionary of element_global_id to the build_hierarchy result for that unit
+    """
+    unit_columns, this_units = _named_query(
+        "hierarchy_units",
+        _grouped_query,
+        source,
+        f"SELECT element_global_id, {_HIERARCHY_COLUMNS} FROM Unit WHERE element_global_id IN ({{ids}})",
+        ids
+    )
+    child_columns, children = _named_query(
+        "hierarchy_children",
+        _grouped_query,
+        source,
+        f"SELECT PARENT_ID, {_CHILD_HIERARCHY_COLUMNS} FROM Unit WHERE PARENT_ID IN ({{ids}})",
+        ids
+    )
+
+    # Single row results convert to the same native values they were fetched as, so ancestors are cached as plain
+    # records and copied for each unit that needs them
+    parent_index = unit_columns.index("PARENT_ID")
+    known_units = {k: dict(zip(unit_columns, v[0])) for k, v in this_units.items()}
+    pending = {v[0][parent_index] for v in this_units.values()} - set(known_units) - {None}
+    while len(pending) > 0:
+        ancestor_columns, ancestor_rows = _named_query(
+            "hierarchy_ancestors",
+            _grouped_query,
+            source,
+            f"SELECT element_global_id, {_HIERARCHY_COLUMNS} FROM Unit WHERE element_global_id IN ({{ids}})",
+            pending
+        )
+        known_units.update({k: dict(zip(ancestor_columns, v[0])) for k, v in ancestor_rows.items()})
+        pending = {v[0][parent_index] for v in ancestor_rows.values()} - set(known_units) - {None}
+
+    hierarchies = dict()
+    for element_global_id in ids:
+        element_global_id = int(element_global_id)
+        this_unit = _frame(unit_columns, this_units.get(element_global_id, []))
+        immediate_children = _frame(child_columns, children.get(element_global_id, []))
+
+        full_hierarchy = list()
+        full_hierarchy.extend(this_unit.to_dict("records"))
+        full_hierarchy.extend(immediate_children.to_dict("records"))
+
+        parent_id = this_unit.iloc[0]["PARENT_ID"]
+
+        ancestors = []
+        while parent_id is not None:
+            ancestor = known_units.get(parent_id)
+            if ancestor is not None:
+                ancestors.append(dict(ancestor))
+                parent_id = ancestor["PARENT_ID"]
+            else:
+                parent_id = None
+        full_hierarchy.extend(ancestors)
+
+        hierarchy_list = list()
+        for unit in full_hierarchy:
+            unit["Display Title"] = _display_title(unit)
+            hierarchy_list.append(unit)
+
+        hierarchies[element_global_id] = {
+            "Children": list(map(int, immediate_children["element_global_id"].tolist())),
+            "Hierarchy": hierarchy_list,
+            "Ancestors": list(map(int, [a["element_global_id"] for a in ancestors]))
+        }
+
+    return hierarchies
+
+
+class UnitTree(object):
+    """
+    In-memory index of the USNVC hierarchy loaded with a single query against the Unit table. Parent and child
+    positions, ancestor chains and the cached hierarchy records with their display titles are all worked out once
+    when the tree is loaded, so that hierarchies for any number of units can be produced without going back to the
+    database.
+    """
+    def __init__(self, columns, rows):
+        """
+        :param columns: List of hierarchy column names, starting with element_global_id and including PARENT_ID
+        :param rows: List of row tuples from the Unit table
+        """
+        parent_column = columns.index("PARENT_ID")
+        child_columns = [c for c in columns if c != "PARENT_ID"]
+
+        self.ids = [row[0] for row in rows]
+        self.positions = {element_global_id: pos for pos, element_global_id in enumerate(self.ids)}
+
+        # Position of each unit's parent, or -1 when the unit has no parent in the table
+        self.parents = list()
+        self.child_positions = [list() for _ in rows]
+        self.root_positions = list()
+        for pos, row in enumerate(rows):
+            parent_id = row[parent_column]
+            if parent_id is None:
+                self.root_positions.append(pos)
+            parent_pos = self.positions.get(parent_id, -1) if parent_id is not None else -1
+            self.parents.append(parent_pos)
+            if parent_pos >= 0:
+                self.child_positions[parent_pos].append(pos)
+
+        # Each unit's ancestor chain is its parent followed by the parent's chain, so chains are worked out from the
+        # top down and every unit below a parent shares the parent's
+        self.ancestor_positions = [None] * len(rows)
+        for pos in range(len(rows)):
+            path = list()
+            parent_pos = pos
+            while parent_pos >= 0 and self.ancestor_positions[parent_pos] is None:
+                path.append(parent_pos)
+                parent_pos = self.parents[parent_pos]
+            chain = () if parent_pos < 0 else (parent_pos,) + self.ancestor_positions[parent_pos]
+            for path_pos in reversed(path):
+                self.ancestor_positions[path_pos] = chain
+                chain = (path_pos,) + chain
+
+        # Units are cached the way they appear in build_hierarchy, where a unit and its ancestors come from single
+        # row results and children come from one result per parent
+        self.records = list()
+        for row in rows:
+            record = dict(zip(columns, row))
+            record["Display Title"] = _display_title(record)
+            self.records.append(record)
+
+        self.child_records = list()
+        for pos, child_positions in enumerate(self.child_positions):
+            child_records = list()
+            if len(child_positions) > 0:
+                immediate_children = _frame(
+                    child_columns,
+                    [tuple(v for i, v in enumerate(rows[c]) if i != parent_column) for c in child_positions]
+                )
+                for record in immediate_children.to_dict("records"):
+                    record["Display Title"] = _display_title(record)
+                    child_records.append(record)
+            self.child_records.append(child_records)
+
+    @classmethod
+    def load(cls, source_data_filename):
+        """
+        Loads the hierarchy of every unit from the Unit table.
+
+        :param source_data_filename: location of source data or a UsnvcSource
+        :return: UnitTree
+        """
+        with _opened_source(source_data_filename) as source:
+            cursor = source.execute(f"SELECT {_HIERARCHY_COLUMNS} FROM Unit")
+            columns = [col_desc[0] for col_desc in cursor.description]
+            rows = cursor.fetchall()
+            cursor.close()
+
+        return cls(columns, rows)
+
+    @classmethod
+    def load_subtree(cls, source_data_filename, element_global_id):
+        """
+        Loads the hierarchy of a unit, its descendants and its ancestors, which is all that is needed to build the
+        hierarchy of every unit in the subtree. The descendants are found with a single recursive query rather than
+        one query per level.
+
+        :param source_data_filename: location of source data or a UsnvcSource
+        :param element_global_id: Integer element_global_id value of the top of the subtree
+        :return: UnitTree
+        """
+        with _opened_source(source_data_filename) as source:
+            cursor = source.execute(
+                f"WITH RECURSIVE \
+                descendants(element_global_id) AS (\
+                    SELECT element_global_id FROM Unit WHERE element_global_id = ? \
+                    UNION SELECT Unit.element_global_id FROM Unit \
+                    JOIN descendants ON Unit.PARENT_ID = descendants.element_global_id), \
+                ancestors(element_global_id) AS (\
+                    SELECT PARENT_ID FROM Unit WHERE element_global_id = ? \
+                    UNION SELECT Unit.PARENT_ID FROM Unit \
+                    JOIN ancestors ON Unit.element_global_id = ancestors.element_global_id) \
+                SELECT {_HIERARCHY_COLUMNS} FROM Unit WHERE element_global_id IN (\
+                    SELECT element_global_id FROM descendants UNION SELECT element_global_id FROM ancestors) \
+                ORDER BY rowid",
+                [int(element_global_id), int(element_global_id)]
+            )
+            columns = [col_desc[0] for col_desc in cursor.description]
+            rows = cursor.fetchall()
+            cursor.close()
+
+        return cls(columns, rows)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, element_global_id):
+        return element_global_id in self.positions
+
+    def roots(self):
+        """
+        :return: List of element_global_id values for units with no parent (the Classes)
+        """
+        return [self.ids[pos] for pos in self.root_positions]
+
+    def parent(self, element_global_id):
+        """
+        :param element_global_id: Integer element_global_id value
+        :return: element_global_id of the unit's parent or None
+        """
+        parent_pos = self.parents[self.positions[element_global_id]]
+        return self.ids[parent_pos] if parent_pos >= 0 else None
+
+    def children(self, element_global_id):
+        """
+        :param element_global_id: Integer element_global_id value
+        :return: List of element_global_id values for the immediate children of the unit
+        """
+        return [self.ids[pos] for pos in self.child_positions[self.positions[element_global_id]]]
+
+    def ancestors(self, element_global_id):
+        """
+        :param element_global_id: Integer element_global_id value
+        :return: List of element_global_id values from the unit's parent up to its Class
+        """
+        return [self.ids[pos] for pos in self.ancestor_positions[self.positions[element_global_id]]]
+
+    def display_title(self, element_global_id):
+        """
+        :param element_global_id: Integer element_global_id value
+        :return: Display title of the unit as used in the cached hierarchy
+        """
+        return self.records[self.positions[element_global_id]]["Display Title"]
+
+    def subtree(self, element_global_id):
+        """
+        Iterates over a unit and all of its descendants, with every unit coming before its children.
+
+        :param element_global_id: Integer element_global_id value of the top of the subtree
+        :return: Generator of element_global_id values
+        """
+        stack = [self.positions[element_global_id]]
+        while len(stack) > 0:
+            pos = stack.pop()
+            yield self.ids[pos]
+            stack.extend(reversed(self.child_positions[pos]))
+
+    def hierarchy(self, element_global_id):
+        """
+        Produces the same result as build_hierarchy from the in-memory index.
+
+        :param element_global_id: Integer element_global_id value to build the hierarchy around.
+        :return: Dictionary with Children, Hierarchy and Ancestors as described in build_hierarchy
+        """
+        pos = self.positions[element_global_id]
+
+        hierarchy_list = [dict(self.records[pos])]
+        hierarchy_list.extend(dict(r) for r in self.child_records[pos])
+        hierarchy_list.extend(dict(self.records[a]) for a in self.ancestor_positions[pos])
+
+        return {
+            "Children": [int(r["element_global_id"]) for r in self.child_records[pos]],
+            "Hierarchy": hierarchy_list,
+            "Ancestors": [int(self.ids[a]) for a in self.ancestor_positions[pos]]
+        }
+
+
+def build_hierarchy(element_global_id, source_data_filename, unit_tree=None):
     """
     This function builds the hierarchy immediately above and below a given Unit.
 
     :param element_global_id: Integer element_global_id value to build the hierarchy around.
-    ::param source_data_filename: location of source data
+    ::param source_data_filename: location of source data or a UsnvcSource
+    :param unit_tree: Optional UnitTree to build the hierarchy from instead of querying the database
     :return: List of dictionaries containing the basic identification information for ancestors all the way up the
     hierarchy, the unit for the provided element_global_id, and immediate children of the unit in the hierarchy
     """
-    db = db_connection(source_data_filename)
+    if unit_tree is not None:
+        return unit_tree.hierarchy(element_global_id)
 
-    full_hierarchy = list()
+    with _opened_source(source_data_filename) as source:
+        return _fetch_hierarchies(source, [element_global_id])[int(element_global_id)]
 
-    this_unit = pd.read_sql_query(
-        f"SELECT element_global_id, PARENT_ID, hierarchylevel, classificationCode,\
-        databaseCode, translatedName, colloquialName, unitsort\
-        FROM Unit\
-        WHERE element_global_id = {element_global_id}",
-        db
-    )
-    full_hierarchy.extend(this_unit.to_dict("records"))
-
-    immediate_children = pd.read_sql_query(
-        f"SELECT element_global_id, hierarchylevel, classificationCode,\
-        databaseCode, translatedName, colloquialName, unitsort\
-        FROM Unit\
-        WHERE PARENT_ID = {element_global_id}",
-        db
-    )
-    full_hierarchy.extend(immediate_children.to_dict("records"))
-
-    parent_id = this_unit.iloc[0]["PARENT_ID"]
-
-    ancestors = []
-    while parent_id is not None:
-        ancestor = pd.read_sql_query(
-            f"SELECT element_global_id, PARENT_ID, hierarchylevel, classificationCode,\
-            databaseCode, translatedName, colloquialName, unitsort\
-            FROM Unit\
-            WHERE element_global_id = {parent_id}",
-            db
-        )
-        if len(ancestor.index) > 0:
-            ancestors.append(ancestor.to_dict("records")[0])
-            parent_id = ancestor.iloc[0]["PARENT_ID"]
-        else:
-            parent_id = None
-    full_hierarchy.extend(ancestors)
-
-    hierarchy_list = list()
-    for unit in full_hierarchy:
-        if unit["hierarchyLevel"] in ["Class", "Subclass", "Formation", "Division"]:
-            unit["Display Title"] = f'{unit["classificationCode"]} {unit["colloquialName"]} {unit["hierarchyLevel"]}'
-        elif unit["hierarchyLevel"] in ["Macrogroup", "Group"]:
-            unit["Display Title"] = f'{unit["classificationCode"]} {unit["translatedName"]}'
+
+CHANGE_LOG_LEVELS = ["off", "summary", "delta", "full"]
+
+
+def _json_pointer(key):
+    return "/" + str(key).replace("~", "~0").replace("/", "~1")
+
+
+def _members(value):
+    if isinstance(value, dict):
+        return dict(value)
+    if isinstance(value, list):
+        return len(value)
+    return None
+
+
+class _ChangeTracker(object):
+    """
+    Works out what has changed in a unit document since the previous change log step as JSON-Patch style operations,
+    without copying the document. The top two levels of the document are tracked, which is where build_unit adds to a
+    document after its first step; anything added deeper arrives inside a new value. The value of each add and replace
+    operation is copied when it is recorded, so that later steps cannot change what an earlier operation says was added.
+    """
+    def __init__(self, copy_values=True):
+        """
+        :param copy_values: Copy the values of add and replace operations; only their count is needed when not set
+        """
+        self.seen = dict()
+        self.copy_values = copy_values
+
+    def _copy(self, value):
+        return copy.deepcopy(value) if self.copy_values else value
+
+    def changes(self, document):
+        """
+        :param document: Unit document
+        :return: List of operation dictionaries with op, path and (for add and replace) value
+        """
+        operations = list()
+        seen = dict()
+        for key, value in document.items():
+            path = _json_pointer(key)
+            if key not in self.seen:
+                operations.append({"op": "add", "path": path, "value": self._copy(value)})
+            elif self.seen[key][0] is not value:
+                operations.append({"op": "replace", "path": path, "value": self._copy(value)})
+            else:
+                previous_members = self.seen[key][1]
+                if isinstance(value, dict):
+                    for member_key, member_value in value.items():
+                        member_path = path + _json_pointer(member_key)
+                        if member_key not in previous_members:
+                            operations.append({"op": "add", "path": member_path, "value": self._copy(member_value)})
+                        elif previous_members[member_key] is not member_value:
+                            operations.append({"op": "replace", "path": member_path, "value": self._copy(member_value)})
+                    for member_key in previous_members:
+                        if member_key not in value:
+                            operations.append({"op": "remove", "path": path + _json_pointer(member_key)})
+                elif isinstance(value, list):
+                    for i in range(previous_members, len(value)):
+                        operations.append({"op": "add", "path": f"{path}/{i}", "value": self._copy(value[i])})
+            seen[key] = (value, _members(value))
+
+        for key in self.seen:
+            if key not in document:
+                operations.append({"op": "remove", "path": _json_pointer(key)})
+
+        self.seen = seen
+        return operations
+
+
+class _ChangeLog(object):
+    """
+    Sends the provenance of a unit document to a change log function at the level of detail requested:
+
+    * off - nothing is logged
+    * summary - the number of operations and the top-level sections they touched
+    * delta - the JSON-Patch style operations made since the previous step
+    * full - complete before and after copies of the document at every step
+    """
+    def __init__(self, element_global_id, document, change_log_function=None, change_log_level="full"):
+        if change_log_level not in CHANGE_LOG_LEVELS:
+            raise ValueError(f"change_log_level must be one of {CHANGE_LOG_LEVELS}")
+        if change_log_function is None:
+            change_log_level = "off"
+
+        self.element_global_id = element_global_id
+        self.document = document
+        self.change_log_function = change_log_function
+        self.change_log_level = change_log_level
+        self.previous_document = {}
+        self.tracker = _ChangeTracker(copy_values=change_log_level == "delta")
+
+    def log(self, change_name, change_description, function_name='build_unit'):
+        if self.change_log_level == "off":
+            return
+
+        if self.change_log_level == "full":
+            source, result = self.previous_document, self.document
+            self.previous_document = copy.deepcopy(self.document)
         else:
-            unit["Display Title"] = f'{unit["databaseCode"]} {unit["translatedName"]}'
-        hierarchy_list.append(unit)
+            operations = self.tracker.changes(self.document)
+            source = None
+            if self.change_log_level == "delta":
+                result = operations
+            else:
+                result = {
+                    "operations": len(operations),
+                    "sections": sorted({o["path"].split("/")[1] for o in operations})
+                }
 
-    return {
-        "Children": list(map(int, immediate_children["element_global_id"].tolist())),
-        "Hierarchy": hierarchy_list,
-        "Ancestors": list(map(int, [a["element_global_id"] for a in ancestors]))
-    }
+        self.change_log_function(str(self.element_global_id), 'pyusnvc/usnvc.py', function_name,
+                                 change_name, change_description, source, result)
 
 
-def build_unit(element_global_id, source_data_filename, version_number, change_log_function=None):
+def _assemble_unit(element_global_id, version_number, frames, hierarchy, change_log_function=None,
+                   change_log_level="full", sections=None):
     """
-    Main function that builds a given Unit from all the related data tables in the relational database as a single
-    document for adding to a document database or indexing system. This function is designed to be run in a
-    multi-processing mode against a list of IDs or set of messages in a queue.
+    Assembles the document for a single unit from its already fetched table data. This is shared by build_unit and
+    the batched build_units so that both produce the same documents.
 
-    :param element_global_id: Integer element_global_id value to build the unit from.
-    :param source_data_filename: location of source data
+    :param element_global_id: Integer element_global_id value of the unit
     :param version_number: do some specific processing based on version
-    :param change_log_function: Optional function to log document providence 
-    :return: Dictionary object containing a logical set of high level properties patterned after the current online
-    "USNVC Explorer" application. The structure is designed to provide a logical and human-readable view of the
-    core information for a given unit.
+    :param frames: Dictionary of query name to frame holding this unit's rows, as produced by _fetch_units
+    :param hierarchy: This unit's hierarchy, as produced by build_hierarchy, or None when the Hierarchy is not wanted
+    :param change_log_function: Optional function to log document providence
+    :param change_log_level: Detail sent to change_log_function: off, summary, delta or full
+    :param sections: Optional list of the document sections to include; every section when None
+    :return: Unit document as described in build_unit
     """
-    db = db_connection(source_data_filename)
+    timer = instrumentation.sections()
 
     # Get requested unit by element_global_id
-    this_unit = pd.read_sql_query(
-        f"SELECT * FROM Unit \
-        LEFT OUTER JOIN UnitDescription \
-        ON Unit.element_global_id = UnitDescription.ELEMENT_GLOBAL_ID \
-        LEFT OUTER JOIN d_classif_confidence \
-        ON UnitDescription.classif_confidence_id = d_classif_confidence.D_CLASSIF_CONFIDENCE_ID \
-        WHERE Unit.element_global_id = {element_global_id}",
-        db
-    ).iloc[0]
+    this_unit = frames["unit"].iloc[0]
 
     # unitDoc template and initial properties
-    previous_unitDoc = {}
     unitDoc = {
         "Date Processed": datetime.utcnow().isoformat(),
         "Identifiers": {
@@ -291,264 +1681,240 @@ def build_unit(element_global_id, source_data_filename, version_number, change_l
         "Authorship": {},
         "References": []
     }
-
-    if change_log_function:
-        change_log_function(str(element_global_id), 'pyusnvc/usnvc.py', 'build_unit',
-                            'Create', 'Create base usnvc unit doc',
-                            previous_unitDoc, unitDoc)
-        previous_unitDoc = copy.deepcopy(unitDoc)
-
-    if type(this_unit["colloquialName"]) is str:
-        unitDoc["Overview"]["Colloquial Name"] = this_unit["colloquialName"]
-    if type(this_unit["typeConceptSentence"]) is str:
-        unitDoc["Overview"]["Type Concept Sentence"] = clean_string(
-            this_unit["typeConceptSentence"])
-    if type(this_unit["typeConcept"]) is str:
-        unitDoc["Overview"]["Type Concept"] = clean_string(
-            this_unit["typeConcept"])
-    if type(this_unit["diagnosticCharacteristics"]) is str:
-        unitDoc["Overview"]["Diagnostic Characteristics"] = clean_string(
-            this_unit["diagnosticCharacteristics"])
-    if type(this_unit["Rationale"]) is str:
-        unitDoc["Overview"]["Rationale for Nominal Species or Physiognomic Features"] = clean_string(
-            this_unit["Rationale"])
-    if type(this_unit["classificationComments"]) is str:
-        unitDoc["Overview"]["Classification Comments"] = clean_string(
-            this_unit["classificationComments"])
-    if type(this_unit["otherComments"]) is str:
-        unitDoc["Overview"]["Other Comments"] = clean_string(
-            this_unit["otherComments"])
-
-    if type(this_unit["similarNVCtypesComments"]) is str:
-        unitDoc["Overview"]["Similar NVC Type Comments"] = clean_string(
-            this_unit["similarNVCtypesComments"])
-    
-    if change_log_function:
-        change_log_function(str(element_global_id), 'pyusnvc/usnvc.py', 'build_unit',
-                            'Add data', 'Add basic data to existing usnvc unit doc',
-                            previous_unitDoc, unitDoc)
-        previous_unitDoc = copy.deepcopy(unitDoc)
-
-    thisSimilarUnits = pd.read_sql_query(
-        f"SELECT * FROM UnitXSimilarUnit WHERE ELEMENT_GLOBAL_ID = {element_global_id}",
-        db
-    )
-    if len(thisSimilarUnits.index) > 0:
-        d_thisSimilarUnits = thisSimilarUnits.to_dict("records")
-        for d in d_thisSimilarUnits:
-            d.update((k, int(v))
-                     for k, v in d.items() if isinstance(v, numpy.int64))
-        for d in d_thisSimilarUnits:
-            d.update((k, None) for k, v in d.items()
-                     if isinstance(v, float) and math.isnan(v))
-        unitDoc["Overview"]["Similar NVC Types"] = d_thisSimilarUnits
+    if sections is not None:
+        unitDoc = {k: v for k, v in unitDoc.items() if k in ("Date Processed", "Identifiers") or k in sections}
+    change_log = _ChangeLog(element_global_id, unitDoc, change_log_function, change_log_level)
+    timer.lap("Overview")
+
+    change_log.log('Create', 'Create base usnvc unit doc')
+    timer.lap("Change Log")
+
+    if "Overview" in unitDoc:
+        if type(this_unit["colloquialName"]) is str:
+            unitDoc["Overview"]["Colloquial Name"] = this_unit["colloquialName"]
+        if type(this_unit["typeConceptSentence"]) is str:
+            unitDoc["Overview"]["Type Concept Sentence"] = clean_string(
+                this_unit["typeConceptSentence"])
+        if type(this_unit["typeConcept"]) is str:
+            unitDoc["Overview"]["Type Concept"] = clean_string(
+                this_unit["typeConcept"])
+        if type(this_unit["diagnosticCharacteristics"]) is str:
+            unitDoc["Overview"]["Diagnostic Characteristics"] = clean_string(
+                this_unit["diagnosticCharacteristics"])
+        if type(this_unit["Rationale"]) is str:
+            unitDoc["Overview"]["Rationale for Nominal Species or Physiognomic Features"] = clean_string(
+                this_unit["Rationale"])
+        if type(this_unit["classificationComments"]) is str:
+            unitDoc["Overview"]["Classification Comments"] = clean_string(
+                this_unit["classificationComments"])
+        if type(this_unit["otherComments"]) is str:
+            unitDoc["Overview"]["Other Comments"] = clean_string(
+                this_unit["otherComments"])
+
+        if type(this_unit["similarNVCtypesComments"]) is str:
+            unitDoc["Overview"]["Similar NVC Type Comments"] = clean_string(
+                this_unit["similarNVCtypesComments"])
+    timer.lap("Overview")
+
+    change_log.log('Add data', 'Add basic data to existing usnvc unit doc')
+    timer.lap("Change Log")
+
+    if "similar_units" in frames:
+        thisSimilarUnits = frames["similar_units"]
+        if len(thisSimilarUnits.index) > 0:
+            import numpy
+            d_thisSimilarUnits = thisSimilarUnits.to_dict("records")
+            for d in d_thisSimilarUnits:
+                d.update((k, int(v))
+                         for k, v in d.items() if isinstance(v, numpy.int64))
+            for d in d_thisSimilarUnits:
+                d.update((k, None) for k, v in d.items()
+                         if isinstance(v, float) and math.isnan(v))
+            unitDoc["Overview"]["Similar NVC Types"] = d_thisSimilarUnits
 
     if this_unit["hierarchyLevel"] in ["Class", "Subclass", "Formation", "Division"]:
-        unitDoc["Overview"]["Display Title"] = this_unit["classificationCode"] + " " + this_unit[
+        display_title = this_unit["classificationCode"] + " " + this_unit[
             "colloquialName"] + " " + this_unit["hierarchyLevel"]
     elif this_unit["hierarchyLevel"] in ["Macrogroup", "Group"]:
-        unitDoc["Overview"]["Display Title"] = this_unit["classificationCode"] + \
+        display_title = this_unit["classificationCode"] + \
             " " + this_unit["translatedName"]
     else:
-        unitDoc["Overview"]["Display Title"] = this_unit["databaseCode"] + \
+        display_title = this_unit["databaseCode"] + \
             " " + this_unit["translatedName"]
 
-    unitDoc["title"] = unitDoc["Overview"]["Display Title"]
-
-    if type(this_unit["Physiognomy"]) is str:
-        unitDoc["Vegetation"]["Physiognomy and Structure"] = clean_string(
-            this_unit["Physiognomy"])
-    if type(this_unit["Floristics"]) is str:
-        unitDoc["Vegetation"]["Floristics"] = clean_string(
-            this_unit["Floristics"])
-    if type(this_unit["Dynamics"]) is str:
-        unitDoc["Vegetation"]["Dynamics"] = clean_string(this_unit["Dynamics"])
-
-    if type(this_unit["Environment"]) is str:
-        unitDoc["Environment"]["Environmental Description"] = clean_string(
-            this_unit["Environment"])
-
-    if type(this_unit["spatialPattern"]) is str:
-        unitDoc["Environment"]["Spatial Pattern"] = clean_string(
-            this_unit["spatialPattern"])
-
-    if type(this_unit["Range"]) is str:
-        unitDoc["Distribution"]["Geographic Range"] = this_unit["Range"]
-
-    if type(this_unit["Nations"]) is str:
-        unitDoc["Distribution"]["Nations"] = {
-            "Raw List": this_unit["Nations"], "Nation Info": []}
-        for nation in this_unit["Nations"].split(","):
-            if nation.endswith("?"):
-                placeCodeUncertainty = True
-            else:
-                placeCodeUncertainty = False
-
-            unitDoc["Distribution"]["Nations"]["Nation Info"].append(
-                get_place_code_data(nation, placeCodeUncertainty))
-
-    if type(this_unit["Subnations"]) is str:
-        unitDoc["Distribution"]["Subnations"] = {
-            "Raw List": this_unit["Subnations"]}
-
-    thisDistribution = pd.read_sql_query(
-        f"SELECT curr_presence_absence_desc, curr_presence_absence_cd, dist_confidence_cd, dist_confidence_desc,\
-        ISO_Nation_cd, Subnation_cd, Subnation_name\
-        FROM UnitXSubnation\
-        JOIN d_curr_presence_absence\
-        ON UnitXSubnation.d_curr_presence_absence_id = d_curr_presence_absence.d_curr_presence_absence_id\
-        JOIN d_dist_confidence\
-        ON UnitXSubnation.d_dist_confidence_id = d_dist_confidence.d_dist_confidence_id\
-        JOIN d_subnation\
-        ON UnitXSubnation.SUBNATION_ID = d_subnation.Subnation_id\
-        WHERE UnitXSubnation.ELEMENT_GLOBAL_ID = {element_global_id}",
-        db
-    )
-    if len(thisDistribution.index) > 0:
-        unitDoc["Distribution"]["States/Provinces Raw Data"] = thisDistribution.to_dict(
-            "records")
-
-    if version_number == 2.02:
-        thisUSFSDistribution1994 = pd.read_sql_query(
-            f"SELECT usfs_ecoregion_name, usfs_ecoregion_class_cd, usfs_ecoregion_concat_cd,\
-            occurrence_status_cd, occurrence_status_desc, display_value\
-            FROM UnitXEcoregionUsfs1994\
-            JOIN d_usfs_ecoregion1994\
-            ON UnitXEcoregionUsfs1994.usfs_ecoregion_id = d_usfs_ecoregion1994.usfs_ecoregion_id\
-            JOIN d_occurrence_status\
-            ON UnitXEcoregionUsfs1994.d_occurrence_status_id = d_occurrence_status.d_occurrence_status_id\
-            WHERE UnitXEcoregionUsfs1994.element_global_id = {element_global_id}",
-            db
-        )
-        if len(thisUSFSDistribution1994.index) > 0:
-            unitDoc["Distribution"]["1994 USFS Ecoregion Raw Data"] = thisUSFSDistribution1994.to_dict(
+    if "Overview" in unitDoc:
+        unitDoc["Overview"]["Display Title"] = display_title
+    unitDoc["title"] = display_title
+    timer.lap("Overview")
+
+    if "Vegetation" in unitDoc:
+        if type(this_unit["Physiognomy"]) is str:
+            unitDoc["Vegetation"]["Physiognomy and Structure"] = clean_string(
+                this_unit["Physiognomy"])
+        if type(this_unit["Floristics"]) is str:
+            unitDoc["Vegetation"]["Floristics"] = clean_string(
+                this_unit["Floristics"])
+        if type(this_unit["Dynamics"]) is str:
+            unitDoc["Vegetation"]["Dynamics"] = clean_string(this_unit["Dynamics"])
+
+    if "Environment" in unitDoc:
+        if type(this_unit["Environment"]) is str:
+            unitDoc["Environment"]["Environmental Description"] = clean_string(
+                this_unit["Environment"])
+
+        if type(this_unit["spatialPattern"]) is str:
+            unitDoc["Environment"]["Spatial Pattern"] = clean_string(
+                this_unit["spatialPattern"])
+
+    timer.lap("Vegetation and Environment")
+
+    if "Distribution" in unitDoc:
+        if type(this_unit["Range"]) is str:
+            unitDoc["Distribution"]["Geographic Range"] = this_unit["Range"]
+
+        if type(this_unit["Nations"]) is str:
+            unitDoc["Distribution"]["Nations"] = {
+                "Raw List": this_unit["Nations"], "Nation Info": []}
+            for nation in this_unit["Nations"].split(","):
+                if nation.endswith("?"):
+                    placeCodeUncertainty = True
+                else:
+                    placeCodeUncertainty = False
+
+                unitDoc["Distribution"]["Nations"]["Nation Info"].append(
+                    get_place_code_data(nation, placeCodeUncertainty))
+
+        if type(this_unit["Subnations"]) is str:
+            unitDoc["Distribution"]["Subnations"] = {
+                "Raw List": this_unit["Subnations"]}
+
+        thisDistribution = frames["distribution"]
+        if len(thisDistribution.index) > 0:
+            unitDoc["Distribution"]["States/Provinces Raw Data"] = thisDistribution.to_dict(
                 "records")
 
-    thisUSFSDistribution2007 = pd.read_sql_query(
-        f"SELECT d_usfs_ecoregion2007.*, d_occurrence_status.*\
-        FROM UnitXEcoregionUsfs2007\
-        JOIN d_usfs_ecoregion2007\
-        ON UnitXEcoregionUsfs2007.usfs_ecoregion_2007_id = d_usfs_ecoregion2007.usfs_ecoregion_2007_id\
-        JOIN d_occurrence_status\
-        ON UnitXEcoregionUsfs2007.d_occurrence_status_id = d_occurrence_status.d_occurrence_status_id\
-        WHERE UnitXEcoregionUsfs2007.element_global_id = {element_global_id}",
-        db
-    )
-    if len(thisUSFSDistribution2007.index) > 0:
-        unitDoc["Distribution"]["2007 USFS Ecoregion Raw Data"] = thisUSFSDistribution2007.to_dict(
-            "records")
-
-    if type(this_unit["tncEcoregions"]) is int:
-        unitDoc["Distribution"]["TNC Ecoregions"] = this_unit["tncEcoregions"]
-
-    if type(this_unit["omernikEcoregions"]) is int:
-        unitDoc["Distribution"]["Omernik Ecoregions"] = this_unit["omernikEcoregions"]
-
-    if type(this_unit["federalLands"]) is int:
-        unitDoc["Distribution"]["Federal Lands"] = this_unit["federalLands"]
-
-    if type(this_unit["plotCount"]) is int:
-        unitDoc["Plot Sampling and Analysis"]["Plot Count"] = this_unit["plotCount"]
-    if type(this_unit["plotSummary"]) is str:
-        unitDoc["Plot Sampling and Analysis"]["Plot Summary"] = this_unit["plotSummary"]
-    if type(this_unit["plotTypal"]) is str:
-        unitDoc["Plot Sampling and Analysis"]["Plot Type"] = this_unit["plotTypal"]
-    if type(this_unit["plotArchived"]) is str:
-        unitDoc["Plot Sampling and Analysis"]["Plot Archive"] = this_unit["plotArchived"]
-    if type(this_unit["plotConsistency"]) is str:
-        unitDoc["Plot Sampling and Analysis"]["Plot Consistency"] = this_unit["plotConsistency"]
-    if type(this_unit["plotSize"]) is str:
-        unitDoc["Plot Sampling and Analysis"]["Plot Size"] = this_unit["plotSize"]
-    if type(this_unit["plotMethods"]) is str:
-        unitDoc["Plot Sampling and Analysis"]["Plot Methods"] = this_unit["plotMethods"]
-
-    unitDoc["Confidence Level"]["Confidence Level"] = this_unit["CLASSIF_CONFIDENCE_DESC"]
-    if type(this_unit["confidenceComments"]) is str:
-        unitDoc["Confidence Level"]["Confidence Level Comments"] = clean_string(
-            this_unit["confidenceComments"])
-
-    if type(this_unit["grank"]) is str:
-        unitDoc["Conservation Status"]["Global Rank"] = this_unit["grank"]
-    if type(this_unit["grankReviewDate"]) is str:
-        unitDoc["Conservation Status"]["Global Rank Review Date"] = this_unit["grankReviewDate"]
-    if type(this_unit["grankAuthor"]) is str:
-        unitDoc["Conservation Status"]["Global Rank Author"] = this_unit["grankAuthor"]
-    if type(this_unit["grankReasons"]) is str:
-        unitDoc["Conservation Status"]["Global Rank Reasons"] = this_unit["grankReasons"]
-
-    unitDoc["Hierarchy"]["parent_id"] = str(this_unit["PARENT_ID"])
-    unitDoc["Hierarchy"]["hierarchyLevel"] = this_unit["hierarchyLevel"]
-    unitDoc["Hierarchy"]["d_classification_level_id"] = int(
-        this_unit["D_CLASSIFICATION_LEVEL_ID"])
-    unitDoc["Hierarchy"]["unitsort"] = this_unit["unitSort"]
-    unitDoc["Hierarchy"]["parentkey"] = this_unit["parentKey"]
-    unitDoc["Hierarchy"]["parentname"] = this_unit["parentName"]
+        if "usfs_1994" in frames:
+            thisUSFSDistribution1994 = frames["usfs_1994"]
+            if len(thisUSFSDistribution1994.index) > 0:
+                unitDoc["Distribution"]["1994 USFS Ecoregion Raw Data"] = thisUSFSDistribution1994.to_dict(
+                    "records")
 
-    try:
-        unitDoc["parent"] = int(this_unit["PARENT_ID"])
-    except:
-        unitDoc["parent"] = int(0)
-
-    if type(this_unit["lineage"]) is str:
-        unitDoc["Concept History"]["Concept Lineage"] = this_unit["lineage"]
-
-    for hist_obj in [
-        ("UnitPredecessor", "Predecessors Raw Data"),
-        ("UnitObsoleteName", "Obsolete Units Raw Data"),
-        ("UnitObsoleteParent", "Obsolete Parents Raw Data")
-    ]:
-        df_hist_data = pd.read_sql_query(
-            f"SELECT * FROM {hist_obj[0]} WHERE element_global_id = {element_global_id}",
-            db
-        )
-        if len(df_hist_data.index) > 0:
-            unitDoc["Concept History"][hist_obj[1]
-                                       ] = df_hist_data.to_dict("records")
-
-    if type(this_unit["Synonymy"]) is str:
-        unitDoc["Synonymy"]["Synonymy"] = this_unit["Synonymy"]
-
-    if type(this_unit["primaryConceptSource"]) is str:
-        unitDoc["Authorship"]["Concept Author"] = this_unit["primaryConceptSource"]
-    if type(this_unit["descriptionAuthor"]) is str:
-        unitDoc["Authorship"]["Description Author"] = this_unit["descriptionAuthor"]
-    if type(this_unit["Acknowledgements"]) is str:
-        unitDoc["Authorship"]["Acknowledgements"] = this_unit["Acknowledgements"]
-    if type(this_unit["versionDate"]) is str:
-        unitDoc["Authorship"]["Version Date"] = this_unit["versionDate"]
-
-    thisUnitReferences = pd.read_sql_query(
-        f"SELECT ShortCitation, FullCitation\
-        FROM UnitXReference\
-        JOIN Reference\
-        ON UnitXReference.reference_id = Reference.reference_id\
-        WHERE UnitXReference.element_global_id = {element_global_id}",
-        db
-    )
-    for index, this_unit in thisUnitReferences.iterrows():
-        unitDoc["References"].append({
-            "Short Citation": this_unit["ShortCitation"],
-            "Full Citation": this_unit["FullCitation"]
-        })
-
-    this_hierarchy = build_hierarchy(element_global_id, source_data_filename)
-    unitDoc["Hierarchy"]["Cached Hierarchy"] = this_hierarchy["Hierarchy"]
+        thisUSFSDistribution2007 = frames["usfs_2007"]
+        if len(thisUSFSDistribution2007.index) > 0:
+            unitDoc["Distribution"]["2007 USFS Ecoregion Raw Data"] = thisUSFSDistribution2007.to_dict(
+                "records")
 
-    if len(this_hierarchy["Children"]) > 0:
-        unitDoc["children"] = this_hierarchy["Children"]
+        if type(this_unit["tncEcoregions"]) is int:
+            unitDoc["Distribution"]["TNC Ecoregions"] = this_unit["tncEcoregions"]
+
+        if type(this_unit["omernikEcoregions"]) is int:
+            unitDoc["Distribution"]["Omernik Ecoregions"] = this_unit["omernikEcoregions"]
+
+        if type(this_unit["federalLands"]) is int:
+            unitDoc["Distribution"]["Federal Lands"] = this_unit["federalLands"]
+    timer.lap("Distribution")
+
+    if "Plot Sampling and Analysis" in unitDoc:
+        if type(this_unit["plotCount"]) is int:
+            unitDoc["Plot Sampling and Analysis"]["Plot Count"] = this_unit["plotCount"]
+        if type(this_unit["plotSummary"]) is str:
+            unitDoc["Plot Sampling and Analysis"]["Plot Summary"] = this_unit["plotSummary"]
+        if type(this_unit["plotTypal"]) is str:
+            unitDoc["Plot Sampling and Analysis"]["Plot Type"] = this_unit["plotTypal"]
+        if type(this_unit["plotArchived"]) is str:
+            unitDoc["Plot Sampling and Analysis"]["Plot Archive"] = this_unit["plotArchived"]
+        if type(this_unit["plotConsistency"]) is str:
+            unitDoc["Plot Sampling and Analysis"]["Plot Consistency"] = this_unit["plotConsistency"]
+        if type(this_unit["plotSize"]) is str:
+            unitDoc["Plot Sampling and Analysis"]["Plot Size"] = this_unit["plotSize"]
+        if type(this_unit["plotMethods"]) is str:
+            unitDoc["Plot Sampling and Analysis"]["Plot Methods"] = this_unit["plotMethods"]
+
+    if "Confidence Level" in unitDoc:
+        unitDoc["Confidence Level"]["Confidence Level"] = this_unit["CLASSIF_CONFIDENCE_DESC"]
+        if type(this_unit["confidenceComments"]) is str:
+            unitDoc["Confidence Level"]["Confidence Level Comments"] = clean_string(
+                this_unit["confidenceComments"])
+
+    if "Conservation Status" in unitDoc:
+        if type(this_unit["grank"]) is str:
+            unitDoc["Conservation Status"]["Global Rank"] = this_unit["grank"]
+        if type(this_unit["grankReviewDate"]) is str:
+            unitDoc["Conservation Status"]["Global Rank Review Date"] = this_unit["grankReviewDate"]
+        if type(this_unit["grankAuthor"]) is str:
+            unitDoc["Conservation Status"]["Global Rank Author"] = this_unit["grankAuthor"]
+        if type(this_unit["grankReasons"]) is str:
+            unitDoc["Conservation Status"]["Global Rank Reasons"] = this_unit["grankReasons"]
+    timer.lap("Plot, Confidence and Conservation Status")
+
+    if "Hierarchy" in unitDoc:
+        unitDoc["Hierarchy"]["parent_id"] = str(this_unit["PARENT_ID"])
+        unitDoc["Hierarchy"]["hierarchyLevel"] = this_unit["hierarchyLevel"]
+        unitDoc["Hierarchy"]["d_classification_level_id"] = int(
+            this_unit["D_CLASSIFICATION_LEVEL_ID"])
+        unitDoc["Hierarchy"]["unitsort"] = this_unit["unitSort"]
+        unitDoc["Hierarchy"]["parentkey"] = this_unit["parentKey"]
+        unitDoc["Hierarchy"]["parentname"] = this_unit["parentName"]
+
+        try:
+            unitDoc["parent"] = int(this_unit["PARENT_ID"])
+        except:
+            unitDoc["parent"] = int(0)
+    timer.lap("Hierarchy")
+
+    if "Concept History" in unitDoc:
+        if type(this_unit["lineage"]) is str:
+            unitDoc["Concept History"]["Concept Lineage"] = this_unit["lineage"]
+
+        for hist_obj in [
+            ("UnitPredecessor", "Predecessors Raw Data"),
+            ("UnitObsoleteName", "Obsolete Units Raw Data"),
+            ("UnitObsoleteParent", "Obsolete Parents Raw Data")
+        ]:
+            df_hist_data = frames[hist_obj[0]]
+            if len(df_hist_data.index) > 0:
+                unitDoc["Concept History"][hist_obj[1]
+                                           ] = df_hist_data.to_dict("records")
+    timer.lap("Concept History")
+
+    if "Synonymy" in unitDoc:
+        if type(this_unit["Synonymy"]) is str:
+            unitDoc["Synonymy"]["Synonymy"] = this_unit["Synonymy"]
+
+    if "Authorship" in unitDoc:
+        if type(this_unit["primaryConceptSource"]) is str:
+            unitDoc["Authorship"]["Concept Author"] = this_unit["primaryConceptSource"]
+        if type(this_unit["descriptionAuthor"]) is str:
+            unitDoc["Authorship"]["Description Author"] = this_unit["descriptionAuthor"]
+        if type(this_unit["Acknowledgements"]) is str:
+            unitDoc["Authorship"]["Acknowledgements"] = this_unit["Acknowledgements"]
+        if type(this_unit["versionDate"]) is str:
+            unitDoc["Authorship"]["Version Date"] = this_unit["versionDate"]
+    timer.lap("Synonymy and Authorship")
+
+    if "References" in unitDoc:
+        thisUnitReferences = frames["references"]
+        for index, this_unit in thisUnitReferences.iterrows():
+            unitDoc["References"].append({
+                "Short Citation": this_unit["ShortCitation"],
+                "Full Citation": this_unit["FullCitation"]
+            })
+    timer.lap("References")
+
+    if "Hierarchy" in unitDoc:
+        unitDoc["Hierarchy"]["Cached Hierarchy"] = hierarchy["Hierarchy"]
+
+        if len(hierarchy["Children"]) > 0:
+            unitDoc["children"] = hierarchy["Children"]
+
+        if len(hierarchy["Ancestors"]) > 0:
+            unitDoc["ancestors"] = hierarchy["Ancestors"]
+        else:
+            unitDoc["ancestors"] = [int(0)]
+    timer.lap("Hierarchy")
 
-    if len(this_hierarchy["Ancestors"]) > 0:
-        unitDoc["ancestors"] = this_hierarchy["Ancestors"]
-    else:
-        unitDoc["ancestors"] = [int(0)]
-    if version_number == 2.03:
-        state_crosswalks = pd.read_sql_query(
-            f"SELECT * FROM UnitCrosswalk\
-            JOIN d_subnation ON\
-            UnitCrosswalk.subnation_id = d_subnation.Subnation_id\
-            WHERE UnitCrosswalk.element_global_id = {element_global_id}",
-            db
-        )
+    if "crosswalk" in frames:
+        state_crosswalks = frames["crosswalk"]
         if len(state_crosswalks.index) > 0:
             unitDoc["State Crosswalk"]["Crosswalk Raw Data"] = state_crosswalks.to_dict(
                 "records")
@@ -556,15 +1922,286 @@ def build_unit(element_global_id, source_data_filename, version_number, change_l
                 i["Subnation_cd"] for i in unitDoc["State Crosswalk"]["Crosswalk Raw Data"]
                 if i["linkage"] == "1 direct" and i["ISO_Nation_cd"] == "US"
             ]
-    if change_log_function:
-        change_log_function(str(element_global_id), 'pyusnvc/usnvc.py', 'build_unit',
-                            'Finish Unit Doc', 'Finished building usnvc unit doc',
-                            previous_unitDoc, unitDoc)
-        previous_unitDoc = copy.deepcopy(unitDoc)
+    timer.lap("State Crosswalk")
+
+    change_log.log('Finish Unit Doc', 'Finished building usnvc unit doc')
+    timer.lap("Change Log")
+    timer.finish()
     return unitDoc
 
 
-def get_schema(source_data_filename, cache_file=True, schema_path=None, schema_file=None, force=False):
+def build_unit(element_global_id, source_data_filename, version_number, change_log_function=None, unit_tree=None,
+               cache=None, change_log_level="full", sections=None):
+    """
+    Main function that builds a given Unit from all the related data tables in the relational database as a single
+    document for adding to a document database or indexing system. This function is designed to be run in a
+    multi-processing mode against a list of IDs or set of messages in a queue.
+
+    :param element_global_id: Integer element_global_id value to build the unit from.
+    :param source_data_filename: location of source data or a UsnvcSource
+    :param version_number: do some specific processing based on version
+    :param change_log_function: Optional function to log document providence 
+    :param unit_tree: Optional UnitTree used to build the hierarchy instead of querying the database
+    :param cache: Optional cache.DocumentCache to read the document from and store it in
+    :param change_log_level: Detail sent to change_log_function. "full" sends complete before and after copies of the
+    document at each step, "delta" sends only the JSON-Patch style operations made in the step, "summary" sends the
+    number of operations and the sections they touched, and "off" logs nothing.
+    :param sections: Optional list of the document sections (see DOCUMENT_SECTIONS) to build, such as ["Overview",
+    "Hierarchy"]. Only the queries those sections need (see SECTION_QUERIES) are run, and the hierarchy is only built
+    for the Hierarchy section. The document always has its Identifiers, title and Date Processed; parent, children
+    and ancestors come with the Hierarchy. Every section is built when None.
+    :return: Dictionary object containing a logical set of high level properties patterned after the current online
+    "USNVC Explorer" application. The structure is designed to provide a logical and human-readable view of the
+    core information for a given unit.
+    """
+    with _opened_source(source_data_filename) as source:
+        return next(_build_batch(source, [element_global_id], version_number, change_log_function, unit_tree, cache,
+                                 change_log_level, sections))
+
+
+def _project(document, sections):
+    """
+    :param document: Complete unit document
+    :param sections: List of document sections
+    :return: Copy of the document with only the given sections and the properties every document has
+    """
+    return {
+        k: v for k, v in document.items()
+        if k in ("Date Processed", "Identifiers", "title") or _SECTION_PROPERTIES.get(k, k) in sections
+    }
+
+
+def _build_batch(source, batch, version_number, change_log_function=None, unit_tree=None, cache=None,
+                 change_log_level="full", sections=None):
+    """
+    Fetches the data for a batch of units and assembles their documents. When a cache is supplied, documents already
+    in it are read from it and only the rest are built (and then stored). Documents built with only some sections
+    are not stored, but are read from cached complete documents.
+
+    :param source: UsnvcSource
+    :param batch: List of integer element_global_id values
+    :param version_number: do some specific processing based on version
+    :param change_log_function: Optional function to log document providence
+    :param unit_tree: Optional UnitTree used to build the hierarchies instead of querying the database
+    :param cache: Optional cache.DocumentCache
+    :param change_log_level: Detail sent to change_log_function: off, summary, delta or full
+    :param sections: Optional list of the document sections to build (see build_unit)
+    :return: Generator yielding unit documents in the order of the batch
+    """
+    timer = instrumentation.sections()
+    queries = section_queries(version_number, sections)
+
+    cached_documents = dict()
+    if cache is not None:
+        cached_documents = cache.get_many(source, batch, version_number)
+        timer.lap("Document Cache")
+
+    to_build = [i for i in batch if int(i) not in cached_documents]
+    built_documents = dict()
+    if len(to_build) > 0:
+        unit_data = _fetch_units(source, to_build, version_number, sections=sections)
+        timer.lap("Fetch Units")
+        if "hierarchy" not in queries:
+            hierarchies = {int(i): None for i in to_build}
+        elif unit_tree is None:
+            hierarchies = _fetch_hierarchies(source, to_build)
+        else:
+            hierarchies = {int(i): unit_tree.hierarchy(i) for i in to_build}
+        timer.lap("Fetch Hierarchy")
+
+        for element_global_id in to_build:
+            built_documents[int(element_global_id)] = _assemble_unit(
+                element_global_id,
+                version_number,
+                unit_data[int(element_global_id)],
+                hierarchies[int(element_global_id)],
+                change_log_function,
+                change_log_level,
+                sections
+            )
+
+        timer.lap("Assemble Units")
+
+        if cache is not None and sections is None:
+            cache.put_many(source, built_documents.values(), version_number)
+            timer.lap("Document Cache")
+    timer.finish()
+
+    for element_global_id in batch:
+        if int(element_global_id) in built_documents:
+            yield built_documents[int(element_global_id)]
+        else:
+            unitDoc = cached_documents[int(element_global_id)]
+            if sections is not None:
+                unitDoc = _project(unitDoc, sections)
+            _ChangeLog(element_global_id, unitDoc, change_log_function, change_log_level).log(
+                'Read cached unit doc', 'Read usnvc unit doc from document cache')
+            yield unitDoc
+
+
+def build_units(ids, source_data_filename, version_number, change_log_function=None, batch_size=500,
+                unit_tree=None, cache=None, change_log_level="full", sections=None):
+    """
+    Builds unit documents for a list of element_global_id values in batches. Each related table is queried once per
+    batch instead of once per unit, and the rows are grouped by element_global_id in memory, which removes most of
+    the query overhead of calling build_unit for every unit.
+
+    :param ids: List of integer element_global_id values to build
+    :param source_data_filename: location of source data or a UsnvcSource
+    :param version_number: do some specific processing based on version
+    :param change_log_function: Optional function to log document providence
+    :param batch_size: Number of units to fetch per round of queries
+    :param unit_tree: Optional UnitTree to build hierarchies from; one is loaded from the source when not supplied
+    :param cache: Optional cache.DocumentCache to read documents from and store them in
+    :param change_log_level: Detail sent to change_log_function: off, summary, delta or full (see build_unit)
+    :param sections: Optional list of the document sections to build (see build_unit)
+    :return: Generator yielding the same documents as build_unit, in the order of the supplied ids
+    """
+    with _opened_source(source_data_filename) as source:
+        if unit_tree is None and "hierarchy" in section_queries(version_number, sections):
+            unit_tree = UnitTree.load(source)
+
+        ids = list(ids)
+        for batch_start in range(0, len(ids), batch_size):
+            yield from _build_batch(source, ids[batch_start:batch_start + batch_size], version_number,
+                                    change_log_function, unit_tree, cache, change_log_level, sections)
+
+
+def build_all_units(source_data_filename, version_number, change_log_function=None, batch_size=500,
+                    unit_tree=None, cache=None, change_log_level="full", sections=None):
+    """
+    Builds every unit in the source data using the batched build_units process.
+
+    :param source_data_filename: location of source data or a UsnvcSource
+    :param version_number: do some specific processing based on version
+    :param change_log_function: Optional function to log document providence
+    :param batch_size: Number of units to fetch per round of queries
+    :param unit_tree: Optional UnitTree to build hierarchies from; one is loaded from the source when not supplied
+    :param cache: Optional cache.DocumentCache to read documents from and store them in
+    :param change_log_level: Detail sent to change_log_function: off, summary, delta or full (see build_unit)
+    :param sections: Optional list of the document sections to build (see build_unit)
+    :return: Generator yielding a unit document for every element_global_id in the Unit table
+    """
+    with _opened_source(source_data_filename) as source:
+        yield from build_units(all_keys(source), source, version_number, change_log_function, batch_size, unit_tree,
+                               cache, change_log_level, sections)
+
+
+def build_subtree(root_id, source_data_filename, version_number, change_log_function=None, batch_size=500,
+                  unit_tree=None, cache=None, change_log_level="full", sections=None):
+    """
+    Builds a unit and every unit below it in the classification, such as all of the Groups and Alliances under a
+    Macrogroup, using the batched build_units process. Only the subtree and its ancestors are loaded into the
+    UnitTree, and the ancestor chain and display titles worked out for each unit are shared by all of its
+    descendants.
+
+    :param root_id: Integer element_global_id value of the top of the subtree
+    :param source_data_filename: location of source data or a UsnvcSource
+    :param version_number: do some specific processing based on version
+    :param change_log_function: Optional function to log document providence
+    :param batch_size: Number of units to fetch per round of queries
+    :param unit_tree: Optional UnitTree to find the subtree in; only the subtree is loaded when not supplied
+    :param cache: Optional cache.DocumentCache to read documents from and store them in
+    :param change_log_level: Detail sent to change_log_function: off, summary, delta or full (see build_unit)
+    :param sections: Optional list of the document sections to build (see build_unit)
+    :return: Generator yielding the same documents as build_unit, with every unit coming before its children
+    """
+    with _opened_source(source_data_filename) as source:
+        if unit_tree is None:
+            unit_tree = UnitTree.load_subtree(source, root_id)
+        if int(root_id) not in unit_tree:
+            raise ValueError(f"Unit {root_id} is not in the source data")
+
+        yield from build_units(list(unit_tree.subtree(int(root_id))), source, version_number, change_log_function,
+                               batch_size, unit_tree, cache, change_log_level, sections)
+
+
+def sample_units(source_data_filename, per_level, seed=0, unit_tree=None):
+    """
+    Draws a stratified random sample of units with up to per_level units from each hierarchyLevel, for quick checks
+    of the schema without building every document.
+
+    :param source_data_filename: location of source data or a UsnvcSource
+    :param per_level: Maximum number of units to take from each hierarchyLevel
+    :param seed: Seed for the random sample so that checks can be repeated
+    :param unit_tree: Optional UnitTree already loaded from the source data
+    :return: List of integer element_global_id values in Unit table order
+    """
+    if unit_tree is None:
+        unit_tree = UnitTree.load(source_data_filename)
+
+    levels = dict()
+    for pos, record in enumerate(unit_tree.records):
+        levels.setdefault(record["hierarchyLevel"], list()).append(pos)
+
+    rng = random.Random(seed)
+    sample = list()
+    for level in sorted(levels):
+        positions = levels[level]
+        sample.extend(rng.sample(positions, min(per_level, len(positions))))
+
+    return [unit_tree.ids[pos] for pos in sorted(sample)]
+
+
+def _empty_required(schema, include):
+    """
+    genson leaves required out of an object schema when no property is required, which it reads as not knowing which
+    properties are required when the schema is added back to a builder. Partial schemas are merged with the empty
+    required lists put back, so that merging them is the same as adding the documents themselves, and the empty lists
+    are taken out again from the result so that it matches a schema built in one go.
+
+    :param schema: JSON Schema dictionary
+    :param include: True to add empty required lists to object schemas, False to remove them
+    :return: Copy of the schema
+    """
+    if isinstance(schema, list):
+        return [_empty_required(s, include) for s in schema]
+    if not isinstance(schema, dict):
+        return schema
+    adjusted = {k: _empty_required(v, include) for k, v in schema.items() if include or v != [] or k != "required"}
+    if include and "properties" in schema and "required" not in schema:
+        adjusted["required"] = []
+    return adjusted
+
+
+def update_schema(schema, documents):
+    """
+    Adds documents to a JSON Schema. Schemas can only be widened this way: a changed document adds any new structure
+    it carries, but structure that has gone from the data is only dropped by rebuilding the schema from every document.
+
+    :param schema: Existing JSON Schema dictionary, or None to start a new schema
+    :param documents: Iterable of unit documents
+    :return: JSON Schema dictionary
+    """
+    from genson import SchemaBuilder
+
+    builder = SchemaBuilder()
+    builder.add_schema({"type": "object", "properties": {}})
+    if schema is not None:
+        builder.add_schema(_empty_required(schema, True))
+    for unit_doc in documents:
+        builder.add_object(unit_doc)
+    return _empty_required(builder.to_schema(), False)
+
+
+def merge_schemas(schemas):
+    """
+    Merges partial JSON Schemas, such as those inferred from separate batches of documents, into one.
+
+    :param schemas: Iterable of JSON Schema dictionaries
+    :return: JSON Schema dictionary
+    """
+    from genson import SchemaBuilder
+
+    builder = SchemaBuilder()
+    builder.add_schema({"type": "object", "properties": {}})
+    for schema in schemas:
+        builder.add_schema(_empty_required(schema, True))
+    return _empty_required(builder.to_schema(), False)
+
+
+def get_schema(source_data_filename, cache_file=True, schema_path=None, schema_file=None, force=False, cache=None,
+               version_number=2.03, workers=None, per_level=None, seed=0, changed_ids=None):
     """
     Retrieves the schema documentation (JSON Schema) or builds it if it doesn't exist (or forced).
     Schema build process will run through all documents to ensure that we fully sample the dataset.
@@ -573,12 +2210,25 @@ def get_schema(source_data_filename, cache_file=True, schema_path=None, schema_f
     :param cache_file: If true, caches the JSON schema as a JSON document
     :param schema_path: Location where the schema file should be cached; defaults to the resources path within the pyusnvc package
     :param schema_file: Filename of the JSON schema file; required if cache_file is true
-    :param force: Can force the re-creation of the schema file if necessary
+    :param force: Can force the re-creation of the schema file if necessary; the cached schema is then ignored, even
+    when changed_ids is given
+    :param cache: Optional cache.DocumentCache to read unit documents from instead of rebuilding them
+    :param version_number: version_number to build the unit documents with
+    :param workers: Number of worker processes to infer the schema with; documents are built in this process when None
+    :param per_level: If given, only a stratified sample of this many units per hierarchyLevel is used (see
+    sample_units). Meant for quick checks, so cache_file must be False so that a sampled schema never replaces the
+    cached one.
+    :param seed: Seed for the per_level sample
+    :param changed_ids: element_global_id values of units that changed since the cached schema was built. When the
+    cached schema exists it is updated from just these documents (see update_schema) instead of being rebuilt.
     :return: Returns a Python dictionary object containing the JSON Schema created with the genson package.
     This is a barebones schema with just the basic data structure in place. It needs to be further developed
     with full documentation, but the basic version can be used as a simple data validator.
     """
+    existing_schema = None
     if cache_file:
+        if per_level is not None:
+            raise ValueError("A per_level sample only gives a partial schema; set cache_file to False to use it")
         if schema_file is None:
             raise ValueError("You must supply a schema_file name in order to cache the schema to a file")
         if schema_path is None:
@@ -587,24 +2237,30 @@ def get_schema(source_data_filename, cache_file=True, schema_path=None, schema_f
         else:
             schema_path = os.path.join(schema_path, schema_file)
 
-    if os.path.exists(schema_path) and not force:
-        with open(schema_path, 'r') as f:
-            schema = json.load(f)
-            f.close()
-        return schema
-
-    builder = SchemaBuilder()
-    builder.add_schema({"type": "object", "properties": {}})
-    for element_global_id in all_keys(source_data_filename):
-        builder.add_object(
-            build_unit(
-                element_global_id,
-                source_data_filename,
-                2.03
-            )
-        )
-
-    schema = builder.to_schema()
+        if os.path.exists(schema_path) and not force:
+            with open(schema_path, 'r') as f:
+                existing_schema = json.load(f)
+                f.close()
+            if changed_ids is None:
+                return existing_schema
+
+    with _opened_source(source_data_filename) as source:
+        if existing_schema is not None:
+            ids = list(changed_ids)
+        elif per_level is not None:
+            ids = sample_units(source, per_level, seed)
+        else:
+            ids = None
+
+        if workers is not None:
+            from pyusnvc.parallel import build_schema_parallel
+            schema = build_schema_parallel(ids, source, version_number, workers)
+            if existing_schema is not None:
+                schema = merge_schemas([existing_schema, schema])
+        elif ids is None:
+            schema = update_schema(None, build_all_units(source, version_number, cache=cache))
+        else:
+            schema = update_schema(existing_schema, build_units(ids, source, version_number, cache=cache))
 
     if cache_file:
         with open(schema_path, 'w') as f:
@@ -0,0 +1,350 @@
+"""
+Batch validation of unit documents against the unit JSON Schema. The schema is compiled into a validator once and
+documents are checked in batches, either as they are built or read back from an export file, optionally across a
+pool of worker processes. Violations are reported aggregated by the JSON path where they occur, with list positions
+collapsed to *, so a problem shared by thousands of documents shows up as a single line. Validation requires the
+jsonschema package.
+"""
+
+import json
+import multiprocessing
+import numbers
+import os
+import time
+
+from pyusnvc.usnvc import _json_pointer
+
+# Schema URI written by genson, which does not name a draft
+GENERIC_SCHEMA_URI = "http://json-schema.org/schema#"
+
+# Per-process validator set up by _init_validator
+_worker_validator = None
+
+
+def _jsonschema():
+    try:
+        import jsonschema
+    except ImportError:
+        raise ImportError("Validation requires the jsonschema package (pip install jsonschema)")
+    return jsonschema
+
+
+def load_schema(version_number=2.03, schema_path=None):
+    """
+    Loads the cached unit schema written by get_schema.
+
+    :param version_number: version_number the schema was built for
+    :param schema_path: Schema file; defaults to the schema for the version in the pyusnvc resources folder
+    :return: JSON Schema dictionary
+    """
+    if schema_path is None:
+        schema_path = os.path.join(os.path.dirname(__file__), 'resources', f'usnvc_unit_schema_{version_number:.2f}.json')
+    with open(schema_path, 'r') as f:
+        return json.load(f)
+
+
+# Checks for the JSON Schema types, following the jsonschema package's draft 7 type checker
+_TYPE_CHECKS = {
+    "array": lambda v: isinstance(v, list),
+    "boolean": lambda v: isinstance(v, bool),
+    "integer": lambda v: not isinstance(v, bool) and (isinstance(v, int) or isinstance(v, float) and v.is_integer()),
+    "null": lambda v: v is None,
+    "number": lambda v: not isinstance(v, bool) and isinstance(v, numbers.Number),
+    "object": lambda v: isinstance(v, dict),
+    "string": lambda v: isinstance(v, str)
+}
+
+# Keywords handled by _compile, which are all that genson writes
+_COMPILED_KEYWORDS = {"$schema", "type", "properties", "required", "items", "anyOf"}
+
+
+def _compile(schema):
+    """
+    Compiles the subset of JSON Schema that genson produces into a single function that says whether a document is
+    valid, which is much faster than the general jsonschema validator. Full error details are only worked out by
+    jsonschema for the documents this rejects.
+
+    :param schema: JSON Schema dictionary
+    :return: Function taking a value and returning True if it is valid, or None if the schema uses other keywords
+    """
+    if not isinstance(schema, dict) or not set(schema) <= _COMPILED_KEYWORDS:
+        return None
+
+    checks = list()
+
+    if "type" in schema:
+        types = schema["type"] if isinstance(schema["type"], list) else [schema["type"]]
+        if not set(types) <= set(_TYPE_CHECKS):
+            return None
+        type_checks = [_TYPE_CHECKS[t] for t in types]
+        checks.append(lambda v: any(check(v) for check in type_checks))
+
+    if "anyOf" in schema:
+        alternatives = [_compile(s) for s in schema["anyOf"]]
+        if None in alternatives:
+            return None
+        checks.append(lambda v: any(check(v) for check in alternatives))
+
+    if "properties" in schema:
+        properties = dict()
+        for name, subschema in schema["properties"].items():
+            properties[name] = _compile(subschema)
+            if properties[name] is None:
+                return None
+        property_items = list(properties.items())
+
+        def check_properties(v):
+            if not isinstance(v, dict):
+                return True
+            return all(name not in v or check(v[name]) for name, check in property_items)
+        checks.append(check_properties)
+
+    if "required" in schema:
+        required = list(schema["required"])
+        checks.append(lambda v: not isinstance(v, dict) or all(name in v for name in required))
+
+    if "items" in schema:
+        item_check = _compile(schema["items"])
+        if item_check is None:
+            return None
+        checks.append(lambda v: not isinstance(v, list) or all(item_check(i) for i in v))
+
+    return lambda v: all(check(v) for check in checks)
+
+
+def _json_path(path):
+    return "".join("/*" if isinstance(p, int) else _json_pointer(p) for p in path) or "/"
+
+
+def _document_id(document, position):
+    """
+    Identifies a document in reports by its element_global_id, falling back to its position in the stream when the
+    document is too malformed to have one.
+    """
+    if not isinstance(document, dict):
+        return position
+    if isinstance(document.get("Identifiers"), dict):
+        return document["Identifiers"].get("element_global_id", position)
+    return document.get("_id", position)
+
+
+def empty_report():
+    return {
+        "documents": 0,
+        "invalid_documents": 0,
+        "violations": dict(),
+        "validation_seconds": 0
+    }
+
+
+def merge_reports(reports, max_examples=5):
+    """
+    Combines validation reports from separate batches of documents.
+
+    :param reports: Iterable of report dictionaries
+    :param max_examples: Maximum number of example element_global_id values to keep per path
+    :return: Report dictionary
+    """
+    merged = empty_report()
+    for report in reports:
+        merged["documents"] += report["documents"]
+        merged["invalid_documents"] += report["invalid_documents"]
+        merged["validation_seconds"] += report["validation_seconds"]
+        for path, violation in report["violations"].items():
+            if path not in merged["violations"]:
+                merged["violations"][path] = {
+                    "count": 0,
+                    "validators": dict(),
+                    "message": violation["message"],
+                    "element_global_ids": list()
+                }
+            merged_violation = merged["violations"][path]
+            merged_violation["count"] += violation["count"]
+            for validator, count in violation["validators"].items():
+                merged_violation["validators"][validator] = merged_violation["validators"].get(validator, 0) + count
+            merged_violation["element_global_ids"].extend(
+                violation["element_global_ids"][:max_examples - len(merged_violation["element_global_ids"])]
+            )
+    return merged
+
+
+class DocumentValidator(object):
+    """
+    Unit schema compiled once and applied to any number of documents.
+    """
+    def __init__(self, schema, max_examples=5):
+        """
+        :param schema: JSON Schema dictionary, as returned by get_schema or load_schema
+        :param max_examples: Maximum number of example element_global_id values to keep per path in reports
+        """
+        jsonschema = _jsonschema()
+        if schema.get("$schema", GENERIC_SCHEMA_URI) == GENERIC_SCHEMA_URI:
+            validator_class = jsonschema.Draft7Validator
+        else:
+            validator_class = jsonschema.validators.validator_for(schema)
+        validator_class.check_schema(schema)
+
+        self.schema = schema
+        self.max_examples = max_examples
+        self.validator = validator_class(schema)
+        self.is_valid = _compile(schema) or self.validator.is_valid
+
+    def errors(self, document):
+        """
+        :param document: Unit document
+        :return: List of jsonschema ValidationError objects for the document
+        """
+        return list(self.validator.iter_errors(document))
+
+    def validate(self, document):
+        """
+        Checks a single document, as a gate before it is published.
+
+        :param document: Unit document
+        :raises ValueError: if the document does not match the schema
+        """
+        if self.is_valid(document):
+            return
+        errors = self.errors(document)
+        if len(errors) > 0:
+            details = "; ".join(f"{_json_path(e.absolute_path)}: {e.message}" for e in errors[:self.max_examples])
+            raise ValueError(f"Unit {_document_id(document, None)} failed validation with {len(errors)} errors: "
+                             f"{details}")
+
+    def check(self, documents):
+        """
+        Validates a batch of documents.
+
+        :param documents: Iterable of unit documents
+        :return: Report dictionary with the number of documents and invalid documents, the seconds spent validating
+        and a violations dictionary keyed by JSON path holding the count, the count per schema keyword, the first
+        message and example element_global_id values
+        """
+        start_time = time.perf_counter()
+        report = empty_report()
+        violations = report["violations"]
+
+        for document in documents:
+            report["documents"] += 1
+            if self.is_valid(document):
+                continue
+            errors = self.errors(document)
+            if len(errors) == 0:
+                continue
+
+            report["invalid_documents"] += 1
+            document_id = _document_id(document, report["documents"] - 1)
+            for error in errors:
+                path = _json_path(error.absolute_path)
+                if path not in violations:
+                    violations[path] = {
+                        "count": 0,
+                        "validators": dict(),
+                        "message": error.message,
+                        "element_global_ids": list()
+                    }
+                violation = violations[path]
+                violation["count"] += 1
+                violation["validators"][error.validator] = violation["validators"].get(error.validator, 0) + 1
+                if len(violation["element_global_ids"]) < self.max_examples \
+                        and document_id not in violation["element_global_ids"]:
+                    violation["element_global_ids"].append(document_id)
+
+        report["validation_seconds"] = time.perf_counter() - start_time
+        return report
+
+
+def _init_validator(schema, max_examples):
+    global _worker_validator
+    _worker_validator = DocumentValidator(schema, max_examples)
+
+
+def _check_batch(documents):
+    return _worker_validator.check(documents)
+
+
+def _batches(documents, batch_size):
+    batch = list()
+    for document in documents:
+        batch.append(document)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = list()
+    if len(batch) > 0:
+        yield batch
+
+
+def _finish(report, start_time):
+    report["seconds"] = time.time() - start_time
+    report["documents_per_second"] = report["documents"] / report["seconds"] if report["seconds"] > 0 else 0
+    report["valid"] = report["invalid_documents"] == 0
+    return report
+
+
+def validate_documents(documents, schema, workers=None, batch_size=500, max_examples=5):
+    """
+    Validates a stream of documents, such as those yielded by build_units or read_export.
+
+    :param documents: Iterable of unit documents
+    :param schema: JSON Schema dictionary
+    :param workers: Number of worker processes to validate with; documents are validated in this process when None
+    :param batch_size: Number of documents sent to a worker at a time
+    :param max_examples: Maximum number of example element_global_id values to keep per path
+    :return: Report dictionary as described in DocumentValidator.check, with the total seconds, documents_per_second
+    and whether every document was valid
+    """
+    start_time = time.time()
+
+    if workers is None:
+        validator = DocumentValidator(schema, max_examples)
+        report = merge_reports((validator.check(b) for b in _batches(documents, batch_size)), max_examples)
+    else:
+        with multiprocessing.Pool(workers, initializer=_init_validator, initargs=(schema, max_examples)) as pool:
+            report = merge_reports(pool.imap(_check_batch, _batches(documents, batch_size)), max_examples)
+
+    return _finish(report, start_time)
+
+
+def validate_export(filename, schema, compression=None, workers=None, batch_size=500, max_examples=5):
+    """
+    Validates the unit documents in an export file. The logical root document is not a unit document and is skipped.
+
+    :param filename: Export file written by export_units
+    :param schema: JSON Schema dictionary
+    :param compression: "gzip", "zstd", "none" or None to infer from the filename extension
+    :return: Report dictionary as described in validate_documents
+    """
+    from pyusnvc.export import read_export
+
+    documents = (d for d in read_export(filename, compression) if "Identifiers" in d)
+    return validate_documents(documents, schema, workers, batch_size, max_examples)
+
+
+def validate_units(source_data_filename, version_number, schema, ids=None, workers=None, batch_size=500,
+                   max_examples=5):
+    """
+    Builds unit documents and validates them as they are built. With workers, each worker process builds and
+    validates its own chunks so documents never have to be passed between processes.
+
+    :param source_data_filename: location of source data or a UsnvcSource
+    :param version_number: do some specific processing based on version
+    :param schema: JSON Schema dictionary
+    :param ids: Optional list of element_global_id values to validate; defaults to every unit
+    :return: Report dictionary as described in validate_documents
+    """
+    start_time = time.time()
+
+    if workers is None:
+        from pyusnvc.usnvc import build_all_units, build_units
+
+        if ids is None:
+            documents = build_all_units(source_data_filename, version_number, batch_size=batch_size)
+        else:
+            documents = build_units(ids, source_data_filename, version_number, batch_size=batch_size)
+        validator = DocumentValidator(schema, max_examples)
+        report = merge_reports((validator.check(b) for b in _batches(documents, batch_size)), max_examples)
+    else:
+        from pyusnvc.parallel import validate_units_parallel
+        report = validate_units_parallel(ids, source_data_filename, version_number, schema, workers, max_examples)
+
+    return _finish(report, start_time)
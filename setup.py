@@ -13,11 +13,16 @@ setup(
     data_files=[('pyusnvc', glob.glob('pyusnvc/resources/*') + glob.glob('pyusnvc/*.py'))],
     include_package_data=True,
     install_requires=[
-        'pandas',
         'numpy',
         'sciencebasepy',
         'pycountry',
         'genson',
+        'requests',
     ],
+    extras_require={
+        'pandas': ['pandas'],
+        'arrow': ['pyarrow'],
+        'validation': ['jsonschema'],
+    },
     zip_safe=False
 )
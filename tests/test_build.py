@@ -0,0 +1,86 @@
+"""
+Checks of the document build against a synthetic source database: the row backend gives the same JSON as the pandas
+backend, and the subtree, section projection and sharding paths agree with the full build.
+"""
+
+import pytest
+
+from pyusnvc import usnvc
+from pyusnvc.export import dumps
+from pyusnvc.synthetic import generate_database
+
+# 2.04 stands for any version without an entry in usnvc.SECTION_QUERIES
+VERSIONS = [2.02, 2.03, 2.04]
+
+
+@pytest.fixture(scope="module")
+def source_data_filename(tmp_path_factory):
+    return generate_database(str(tmp_path_factory.mktemp("source") / "synthetic.db"), units=300)
+
+
+def _json(documents):
+    """
+    Serializes documents as the export does, leaving out the time each was processed.
+    """
+    return [dumps({k: v for k, v in d.items() if k != "Date Processed"}) for d in documents]
+
+
+def _build(source_data_filename, version_number, backend):
+    usnvc.set_backend(backend)
+    try:
+        return _json(usnvc.build_units(usnvc.all_keys(source_data_filename), source_data_filename, version_number))
+    finally:
+        usnvc.set_backend("rows")
+
+
+@pytest.mark.parametrize("version_number", VERSIONS)
+def test_row_backend_matches_pandas(source_data_filename, version_number):
+    pytest.importorskip("pandas")
+    assert _build(source_data_filename, version_number, "rows") == \
+        _build(source_data_filename, version_number, "pandas")
+
+
+@pytest.mark.parametrize("version_number", VERSIONS)
+def test_build_unit_matches_build_units(source_data_filename, version_number):
+    ids = usnvc.all_keys(source_data_filename)[::25]
+    assert _json(usnvc.build_unit(i, source_data_filename, version_number) for i in ids) == \
+        _json(usnvc.build_units(ids, source_data_filename, version_number))
+
+
+@pytest.mark.parametrize("version_number", VERSIONS)
+def test_build_subtree_matches_build_unit(source_data_filename, version_number):
+    unit_tree = usnvc.UnitTree.load(source_data_filename)
+    root_id = next(i for i in usnvc.all_keys(source_data_filename)
+                   if unit_tree.parent(i) is not None and len(unit_tree.children(i)) > 0)
+
+    documents = list(usnvc.build_subtree(root_id, source_data_filename, version_number))
+    ids = [d["Identifiers"]["element_global_id"] for d in documents]
+    assert ids[0] == root_id
+    assert set(ids) == set(unit_tree.subtree(root_id))
+    # Every unit comes before its children
+    assert all(ids.index(unit_tree.parent(i)) < ids.index(i) for i in ids[1:])
+    assert _json(documents) == _json(usnvc.build_unit(i, source_data_filename, version_number) for i in ids)
+
+
+@pytest.mark.parametrize("version_number", VERSIONS)
+def test_section_projection(source_data_filename, version_number):
+    ids = usnvc.all_keys(source_data_filename)[::10]
+    full_documents = list(usnvc.build_units(ids, source_data_filename, version_number))
+    for section in usnvc.DOCUMENT_SECTIONS:
+        documents = list(usnvc.build_units(ids, source_data_filename, version_number, sections=[section]))
+        assert _json(documents) == _json(usnvc._project(d, [section]) for d in full_documents), section
+
+
+def test_unknown_section(source_data_filename):
+    with pytest.raises(ValueError):
+        usnvc.build_unit(usnvc.all_keys(source_data_filename)[0], source_data_filename, 2.03, sections=["Nope"])
+
+
+@pytest.mark.parametrize("strategy", usnvc.SHARD_STRATEGIES)
+def test_shards_cover_every_unit_once(source_data_filename, strategy):
+    ids = usnvc.all_keys(source_data_filename)
+    shards = [usnvc.all_keys(source_data_filename, shard=s, num_shards=3, strategy=strategy) for s in range(3)]
+    assert sorted(i for shard in shards for i in shard) == sorted(ids)
+    for s, shard in enumerate(shards):
+        assert list(usnvc.iter_keys(source_data_filename, page_size=7, shard=s, num_shards=3, strategy=strategy)) \
+            == sorted(shard)
@@ -0,0 +1,24 @@
+"""
+Importing pyusnvc has to stay cheap, since short-lived pipeline workers pay for it on every start. Each test imports
+the package in fresh interpreters through benchmark.measure_import.
+"""
+
+import os
+
+from pyusnvc.benchmark import IMPORT_BUDGET_SECONDS, measure_import
+
+# Folder holding the pyusnvc package, so that the fresh interpreters import this copy of it
+REPOSITORY_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def test_import_within_budget(monkeypatch):
+    monkeypatch.chdir(REPOSITORY_FOLDER)
+    result = measure_import("pyusnvc")
+    assert result["seconds"] <= IMPORT_BUDGET_SECONDS, \
+        f"Importing pyusnvc took {result['seconds']:.3f}s, over the {IMPORT_BUDGET_SECONDS}s budget"
+
+
+def test_import_leaves_heavy_dependencies_unloaded(monkeypatch):
+    monkeypatch.chdir(REPOSITORY_FOLDER)
+    result = measure_import("pyusnvc", repeat=1)
+    assert result["loaded"] == [], f"Importing pyusnvc loaded {', '.join(result['loaded'])}"
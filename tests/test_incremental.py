@@ -0,0 +1,98 @@
+"""
+Checks that an incremental rebuild plans every document a full rebuild would change, including the descendants of a
+unit whose hierarchy record changed.
+"""
+
+import shutil
+import sqlite3
+
+import pytest
+
+from pyusnvc import incremental, usnvc
+from pyusnvc.export import dumps
+from pyusnvc.synthetic import generate_database
+
+VERSION_NUMBER = 2.03
+
+
+def _documents(source_data_filename):
+    """
+    :return: Dictionary of element_global_id to serialized document, including the logical root as 0
+    """
+    documents = {0: dumps(usnvc.logical_nvcs_root(source_data_filename))}
+    for document in usnvc.build_all_units(source_data_filename, VERSION_NUMBER):
+        document.pop("Date Processed")
+        documents[document["Identifiers"]["element_global_id"]] = dumps(document)
+    return documents
+
+
+@pytest.fixture(scope="module")
+def releases(tmp_path_factory):
+    """
+    Two releases of a synthetic source: the second has one description edited, one interior unit renamed and one
+    leaf deleted.
+    """
+    folder = tmp_path_factory.mktemp("releases")
+    previous_filename = generate_database(str(folder / "previous.db"), units=300)
+    current_filename = str(folder / "current.db")
+    shutil.copyfile(previous_filename, current_filename)
+
+    unit_tree = usnvc.UnitTree.load(previous_filename)
+    ids = usnvc.all_keys(previous_filename)
+    interior = [i for i in ids if unit_tree.parent(i) is not None
+                and any(len(unit_tree.children(c)) > 0 for c in unit_tree.children(i))]
+    leaves = [i for i in ids if len(unit_tree.children(i)) == 0]
+    renamed_id = interior[len(interior) // 2]
+    deleted_id = leaves[0]
+    edited_id = next(i for i in reversed(leaves) if i not in unit_tree.subtree(renamed_id))
+
+    connection = sqlite3.connect(current_filename)
+    connection.execute("UPDATE UnitDescription SET typeConcept = 'Edited type concept' WHERE ELEMENT_GLOBAL_ID = ?",
+                       [edited_id])
+    connection.execute("UPDATE Unit SET translatedName = 'Renamed unit' WHERE element_global_id = ?", [renamed_id])
+    connection.execute("DELETE FROM Unit WHERE element_global_id = ?", [deleted_id])
+    connection.execute("DELETE FROM UnitDescription WHERE ELEMENT_GLOBAL_ID = ?", [deleted_id])
+    connection.commit()
+    connection.close()
+
+    return {
+        "previous": previous_filename,
+        "current": current_filename,
+        "renamed_id": renamed_id,
+        "renamed_subtree": list(unit_tree.subtree(renamed_id)),
+        "deleted_id": deleted_id,
+        "edited_id": edited_id
+    }
+
+
+def test_plan_matches_full_rebuild(releases):
+    previous_documents = _documents(releases["previous"])
+    current_documents = _documents(releases["current"])
+    changed = {i for i in current_documents
+               if i in previous_documents and current_documents[i] != previous_documents[i]}
+    deleted = set(previous_documents) - set(current_documents)
+
+    changes = incremental.plan_changes(incremental.build_manifest(releases["previous"], VERSION_NUMBER),
+                                       incremental.build_manifest(releases["current"], VERSION_NUMBER))
+
+    # The edits reach the edited unit, the whole renamed subtree and the deleted leaf's parent
+    assert {releases["edited_id"]} | set(releases["renamed_subtree"]) <= changed
+    assert changes["add"] == []
+    assert set(changes["delete"]) == deleted == {releases["deleted_id"]}
+    assert set(changes["update"]) == changed
+
+
+def test_incremental_build_gives_full_rebuild_documents(releases):
+    previous_manifest = incremental.build_manifest(releases["previous"], VERSION_NUMBER)
+    documents = _documents(releases["current"])
+
+    manifest, changes, built_changes = incremental.incremental_build(releases["current"], VERSION_NUMBER,
+                                                                     previous_manifest)
+    for change in built_changes:
+        if change["op"] == "delete":
+            assert change["element_global_id"] not in documents
+            continue
+        document = change["document"]
+        document.pop("Date Processed", None)
+        assert dumps(document) == documents[change["element_global_id"]]
+    assert manifest == incremental.build_manifest(releases["current"], VERSION_NUMBER)